@@ -0,0 +1,75 @@
+import os, subprocess, sys
+
+# Benchmark suite. Usage: python benchmark.py [benchmark name]
+# Runs every benchmark when no name is given and exits non-zero if any budget is exceeded.
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Import time budgets in milliseconds (cumulative, as reported by python -X importtime).
+# These modules are imported by every interactive session and every pool worker.
+import_time_budgets = {
+    "q_store": 5,
+    "game": 40,
+    "plot_scores": 15,
+    "evaluate_sql": 250,  # Dominated by numpy, which the session statistics need
+}
+import_time_runs = 5
+
+# The array engine (fast_engine.py) has to agree with the rules of evaluate_sql.py and, when compiled with Numba,
+# simulate games at least this many times faster than the object engine
+engine_min_speedup = 10
+engine_games = 1000
+
+
+def import_time(module):
+    # Cumulative import time of a module in milliseconds, measured in a fresh interpreter
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=repo_dir, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+    for line in reversed(result.stderr.splitlines()):
+        # Lines look like "import time:       self |   cumulative | module", nested imports are indented
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].strip() == module and not parts[2].startswith("  "):
+            return int(parts[1]) / 1000
+    raise RuntimeError(f"No import time reported for {module}")
+
+
+def benchmark_import_time():
+    passed = True
+    for module, budget in import_time_budgets.items():
+        # Median of several runs, the first run also pays for cold file caches
+        times = sorted(import_time(module) for _ in range(import_time_runs))
+        median = times[len(times) // 2]
+        status = "ok" if median <= budget else "OVER BUDGET"
+        passed = passed and median <= budget
+        print(f"import {module}: {median:.1f} ms (budget {budget} ms) {status}")
+    return passed
+
+
+def benchmark_engine():
+    import evaluate_sql, fast_engine
+    mismatches = fast_engine.check_kernels(evaluate_sql, 5000)
+    print(f"fast_engine kernels: {mismatches} mismatches against evaluate_sql.py {'ok' if not mismatches else 'FAILED'}")
+    object_rate, _ = fast_engine.object_engine_run(evaluate_sql, engine_games)
+    fast_rate, _ = fast_engine.fast_engine_run(engine_games * 10)
+    speedup = fast_rate / object_rate
+    if not fast_engine.numba_available:
+        print(f"fast_engine: {speedup:.1f}x without Numba, speed not checked")
+        return not mismatches
+    status = "ok" if speedup >= engine_min_speedup else "TOO SLOW"
+    print(f"fast_engine: {fast_rate:.0f} games/s, {speedup:.1f}x the object engine "
+          f"(minimum {engine_min_speedup}x) {status}")
+    return not mismatches and speedup >= engine_min_speedup
+
+
+benchmarks = {
+    "import_time": benchmark_import_time,
+    "engine": benchmark_engine,
+}
+
+
+if __name__ == "__main__":
+    selected = sys.argv[1:] or list(benchmarks)
+    results = [benchmarks[name]() for name in selected]
+    sys.exit(0 if all(results) else 1)
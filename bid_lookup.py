@@ -0,0 +1,105 @@
+import itertools, os, sys, time
+from symmetry import canonical_hand
+
+# Precomputed bids for the small hands of the first rounds, which repeat constantly. Every canonical hand (see
+# symmetry.py) of those rounds is bid once per turn position with rollout_bidder.py, using many more rollouts than
+# a bid made during play could afford. The agents then look their bid up and fall back to make_bid for other hands.
+# The table is a SQLite file with one row per hand and position, keyed on the position followed by the card_integers
+# of the canonical hand. Building it is resumable: hands already in the file are skipped.
+# Usage: python bid_lookup.py <bid_table.db> [max round] [rollouts] [workers]
+
+# card_integers of the cards that are dealt, Escapes and Pirates share one value each
+escape, pirate, tigress, skull_king = 1, 59, 61, 62
+first_suit_card, last_suit_card = 3, 58  # 1 of Yellow to 14 of Black
+card_copies = {escape: 5, pirate: 5}
+dealt_cards = [escape] + list(range(first_suit_card, last_suit_card + 1)) + [pirate, tigress, skull_king]
+
+default_max_round = 3
+default_rollouts = 2000
+chunk_size = 2000  # Hands bid between two commits
+
+
+def hand_key(hand, position):
+    # Key of a hand of card_integers played from a turn position
+    canonical, _ = canonical_hand(sorted(hand))
+    return bytes([position] + canonical)
+
+
+def engine_hand(hand):
+    # fast_engine card ids of a hand of card_integers
+    ids, copies = [], {}
+    for card in hand:
+        if card == escape or card == pirate:
+            ids.append((56 if card == escape else 61) + copies.get(card, 0))
+            copies[card] = copies.get(card, 0) + 1
+        else:
+            ids.append({tigress: 66, skull_king: 67}.get(card, card - first_suit_card))
+    return ids
+
+
+def canonical_hands(round_number):
+    # Every distinct canonical hand of a round
+    hands = set()
+    for hand in itertools.combinations_with_replacement(dealt_cards, round_number):
+        if all(hand.count(card) <= copies for card, copies in card_copies.items()):
+            hands.add(tuple(canonical_hand(list(hand))[0]))
+    return sorted(hands)
+
+
+class BidTable:
+    def __init__(self, table_path):
+        import sqlite3
+        conn = sqlite3.connect(table_path)
+        self.bids = dict(conn.execute('SELECT hand, bid FROM Bids'))
+        conn.close()
+        self.rounds = {len(key) - 1 for key in self.bids}
+
+    def __len__(self):
+        return len(self.bids)
+
+    def get_bid(self, hand, position):
+        # Bid for a hand of card_integers, None if the hand is not in the table
+        if len(hand) not in self.rounds:
+            return None
+        return self.bids.get(hand_key(hand, position))
+
+
+bid_tables = {}
+
+
+def load_bid_table(table_path):
+    # Table of the process, loaded on first use. None when there is no table file.
+    if table_path not in bid_tables:
+        bid_tables[table_path] = BidTable(table_path) if os.path.exists(table_path) else None
+    return bid_tables[table_path]
+
+
+def build_bid_table(table_path, max_round=default_max_round, rollouts=default_rollouts, workers=None, players=4):
+    import sqlite3
+    from rollout_bidder import bid_table
+    conn = sqlite3.connect(table_path)
+    conn.execute('CREATE TABLE IF NOT EXISTS Bids (hand BLOB PRIMARY KEY, bid INTEGER, rollouts INTEGER) WITHOUT ROWID')
+    done = {key for key, in conn.execute('SELECT hand FROM Bids')}
+    keys = [key for round_number in range(1, max_round + 1) for hand in canonical_hands(round_number)
+            for key in (bytes([position] + list(hand)) for position in range(players)) if key not in done]
+    print(f"{len(done)} hands already bid, {len(keys)} to go")
+    for start in range(0, len(keys), chunk_size):
+        chunk = keys[start:start + chunk_size]
+        bids = bid_table([(engine_hand(key[1:]), key[0]) for key in chunk], rollouts, workers=workers)
+        conn.executemany('INSERT INTO Bids (hand, bid, rollouts) VALUES (?, ?, ?)',
+                         ((key, bid, rollouts) for key, bid in zip(chunk, bids)))
+        conn.commit()
+        print(f"{min(start + chunk_size, len(keys))}/{len(keys)} hands bid")
+    conn.close()
+
+
+if __name__ == "__main__":
+    table_path = sys.argv[1]
+    max_round = int(sys.argv[2]) if len(sys.argv) > 2 else default_max_round
+    rollouts = int(sys.argv[3]) if len(sys.argv) > 3 else default_rollouts
+    workers = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    start_time = time.perf_counter()
+    build_bid_table(table_path, max_round, rollouts, workers)
+    elapsed_time = time.perf_counter() - start_time
+    print(f"{len(BidTable(table_path))} bids in {table_path} ({os.path.getsize(table_path)} bytes), "
+          f"built in {elapsed_time} seconds.")
@@ -0,0 +1,108 @@
+import sys, time
+import numpy as np
+from fast_engine import deck_size, card_suits, card_id
+
+# Public knowledge of a round for agents that sample the hidden hands: the cards played so far and the suits each
+# player has shown to be void in. Both are bitmasks, played over the card ids of fast_engine.py and voids over the
+# suits (bit suit - 1). play_tricks records every card as it is played.
+# A player who plays a suited card off the leading suit has none of it left, since following suit is only avoided
+# with a special card, so the sampler never deals them a card of that suit.
+
+# Attempts at dealing a row before the remaining rows are dealt without the void constraints
+max_attempts = 20
+
+
+def add_card(mask, card):
+    # Adds a card to a bitmask, an Escape or Pirate takes the first free id of its kind
+    card_id_ = card_id(card)
+    while mask >> card_id_ & 1:
+        card_id_ += 1
+    return mask | 1 << card_id_
+
+
+def mask_cards(mask):
+    return np.array([card for card in range(deck_size) if mask >> card & 1], dtype=np.int64)
+
+
+class CardTracker:
+    def __init__(self, players, round_number):
+        self.seats = {player.name: seat for seat, player in enumerate(players)}
+        self.round_number = round_number
+        self.played = 0
+        self.cards = []  # Cards played, in order
+        self.voids = [0] * len(players)
+
+    def record(self, player, card, leading_suit=None):
+        # leading_suit is the suit name led before this card
+        self.played = add_card(self.played, card)
+        self.cards.append(card)
+        if leading_suit and not card.special and card.suit != leading_suit:
+            self.voids[self.seats[player.name]] |= 1 << (["Yellow", "Purple", "Green", "Black"].index(leading_suit))
+
+    def unseen_cards(self, hand):
+        # Ids of the hand (Card objects), in its order, and ids of the cards that are neither played nor in it
+        known = self.played
+        ids = []
+        for card in hand:
+            with_card = add_card(known, card)
+            ids.append((with_card ^ known).bit_length() - 1)
+            known = with_card
+        return np.array(ids, dtype=np.int64), mask_cards(((1 << deck_size) - 1) & ~known)
+
+    def player_voids(self, players):
+        return [self.voids[self.seats[player.name]] for player in players]
+
+
+def allowed_cards(cards, void_mask):
+    # Which of the cards a player void in the suits of void_mask can hold, special cards are always allowed
+    suits = card_suits[cards]
+    return (suits == 0) | ((void_mask >> np.maximum(suits - 1, 0)) & 1 == 0)
+
+
+def sample_hands(unseen, sizes, voids, samples):
+    # Deals unseen cards to players holding sizes cards and void in the suits of voids, for samples deals at once.
+    # Returns a (samples, sum(sizes)) array, each player's cards in consecutive columns in the order of sizes.
+    # Players are dealt most constrained first, each row taking the allowed cards with the smallest random keys.
+    # Rows that cannot be completed (the constraints left too few cards for a later player) are dealt again.
+    deals = np.zeros((samples, sum(sizes)), dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(sizes)))
+    allowed = [allowed_cards(unseen, void_mask) for void_mask in voids]
+    order = sorted((player for player in range(len(sizes)) if sizes[player]), key=lambda player: allowed[player].sum())
+    rows = np.arange(samples)
+    for attempt in range(max_attempts + 1):
+        keys = np.random.random((len(rows), len(unseen)))
+        taken = np.zeros(keys.shape, dtype=bool)
+        complete = np.ones(len(rows), dtype=bool)
+        for player in order:
+            size = sizes[player]
+            excluded = taken | ~allowed[player] if attempt < max_attempts else taken
+            player_keys = np.where(excluded, np.inf, keys)
+            chosen = np.argpartition(player_keys, size - 1, axis=1)[:, :size]
+            complete &= np.isfinite(np.take_along_axis(player_keys, chosen, axis=1)).all(axis=1)
+            deals[rows, offsets[player]:offsets[player + 1]] = unseen[chosen]
+            np.put_along_axis(taken, chosen, True, axis=1)
+        rows = rows[~complete]
+        if not len(rows):
+            break
+    return deals
+
+
+if __name__ == "__main__":
+    # Usage: python card_tracker.py [samples]
+    # Checks the deals against the constraints and times the sampler on a mid-round situation
+    samples = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    unseen = np.random.permutation(deck_size)[:40]
+    sizes = [7, 6, 6]
+    voids = [0b0001, 0b0110, 0]
+    deals = sample_hands(unseen, sizes, voids, samples)
+    offsets = np.concatenate(([0], np.cumsum(sizes)))
+    violations = sum(int((~allowed_cards(deals[:, offsets[player]:offsets[player + 1]], voids[player])).sum())
+                     for player in range(len(sizes)))
+    duplicates = sum(len(set(row)) != len(row) for row in deals)
+    start_time = time.perf_counter()
+    for _ in range(100):
+        sample_hands(unseen, sizes, voids, samples)
+    elapsed_time = (time.perf_counter() - start_time) / 100
+    print(f"{samples} deals: {violations} void violations, {duplicates} rows with repeated cards, "
+          f"{elapsed_time * 1000:.2f} ms ({elapsed_time / samples * 1e6:.2f} microseconds per deal)")
+    sys.exit(1 if violations or duplicates else 0)
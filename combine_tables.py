@@ -1,38 +1,63 @@
-import json, time
+import json, time, os
 from collections import defaultdict
+from q_store import visits_path
 
 
-def complex_merge_to_dict(dicts):
-    parsed_dicts = defaultdict(lambda: defaultdict(lambda: [0, 0]))  # default to [score, count]
+def complex_merge_to_dict(dicts, visit_dicts=None, base=None, base_visits=None):
+    # Visit-weighted average of every (state, action) across the tables, so the result is what a single table trained
+    # on all the games would hold. visit_dicts holds each table's visit counts, or None for tables trained before
+    # visits were recorded, where a value other than the base table's counts as one visit.
+    # base is the table every run started from (training.py starts from decision.json) and base_visits its visit
+    # counts. They are in every table, so they are subtracted before averaging and counted once in the result.
+    visit_dicts = visit_dicts or [None] * len(dicts)
+    base = base or {}
+    base_visits = base_visits or {}
+    parsed_dicts = defaultdict(lambda: defaultdict(lambda: [0, 0, 0, 0]))  # [weighted score sum, visits, score sum, tables]
     dict_num = 0
     # Step through each dictionary in the list
-    for d in dicts:
+    for d, visits in zip(dicts, visit_dicts):
         dict_num += 1
         for key, val_dict in d.items():
             # Parse the JSON key to a Python dict
             parsed_key = json.dumps(json.loads(key), sort_keys=True)
+            key_visits = visits.get(key, {}) if visits is not None else None
+            base_key_visits = base_visits.get(key, {})
 
             # Merge the dictionaries based on parsed_key
             for action, score in val_dict.items():
-                existing_score, count = parsed_dicts[parsed_key][action]
-
-                if score == 0 and existing_score != 0:
-                    continue  # Skip if new score is zero and there is already a non-zero score
-                elif existing_score == 0:
-                    parsed_dicts[parsed_key][action] = [score, 1]  # Replace zero score
+                if key_visits is not None:
+                    count = max(key_visits.get(action, 0) - base_key_visits.get(action, 0), 0)
                 else:
-                    # Calculate the new average if both scores are non-zero
-                    new_average = (existing_score * count + score) / (count + 1)
-                    parsed_dicts[parsed_key][action] = [new_average, count + 1]
+                    count = 1 if score != base.get(key, {}).get(action, 0) else 0
+                merged = parsed_dicts[parsed_key][action]
+                merged[0] += score * count
+                merged[1] += count
+                merged[2] += score
+                merged[3] += 1
         print(f'Table {dict_num} incorporated')
-    # Prepare the final single dictionary output
-    final_dict = {key: {action: score[0] for action, score in val_dict.items()}
+    # Prepare the final single dictionary output, entries no table has visited keep the plain average
+    final_dict = {key: {action: score[0] / score[1] if score[1] else score[2] / score[3]
+                        for action, score in val_dict.items()}
                   for key, val_dict in parsed_dicts.items()}
+    for key, val_dict in base_visits.items():
+        parsed_key = json.dumps(json.loads(key), sort_keys=True)
+        for action, count in val_dict.items():
+            parsed_dicts[parsed_key][action][1] += count
+    final_visits = {key: {action: score[1] for action, score in val_dict.items() if score[1]}
+                    for key, val_dict in parsed_dicts.items()}
+
+    return final_dict, final_visits
 
-    return final_dict
+
+def load_visits(table_name):
+    if os.path.exists(visits_path(table_name)):
+        with open(visits_path(table_name), 'r') as file:
+            return json.load(file)
+    return None
 
 
 dicts = []
+visit_dicts = []
 
 # Load JSON data
 for i in range(1, 21):
@@ -40,14 +65,23 @@ for i in range(1, 21):
     table_name = f'table{i}'
     with open(f'{table_name}.json', 'r') as file:
         dicts.append(json.load(file))
+    visit_dicts.append(load_visits(table_name))
+
+# Table the runs started from, as in training.py
+base = None
+if os.path.exists('decision.json'):
+    with open('decision.json', 'r') as file:
+        base = json.load(file)
 
 print("Starting merge...")
 start_time = time.perf_counter()
-merged_dicts = complex_merge_to_dict(dicts)
+merged_dicts, merged_visits = complex_merge_to_dict(dicts, visit_dicts, base, load_visits('decision'))
 
 # Save the merged dictionary
 with open(f'combined.json', 'w') as file:
-    json.dump(merged_dicts, file, indent=4)
+    json.dump(merged_dicts, file)
+with open(visits_path('combined'), 'w') as file:
+    json.dump(merged_visits, file)
 
 end_time = time.perf_counter()
 elapsed_time = end_time - start_time
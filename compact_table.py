@@ -0,0 +1,143 @@
+import json, os, struct, sys, time
+from q_store import open_q_store
+from symmetry import canonicalize_state_key
+
+# Shrinks a Q-table for playing and evaluation:
+#   - states are merged into their canonical key, visit-weighted as in combine_tables.py. This covers keys that only
+#     differ in formatting, and states of tables trained before the suits were relabeled (see symmetry.py), whose
+#     actions are moved to the positions of the canonical hand.
+#   - entries still holding the initial value of 0 are dropped, and states left without any entry with them.
+#     With --visited-only, entries that were never updated are dropped too (only for tables with visit counts).
+#     The agents read missing actions as 0 and missing states as unseen (random move), so play is unchanged.
+#   - for .db destinations, values are quantized and each state's values packed into a single row, stored as
+#     value * scale in float16 (default), int16 or float32. int16 defaults to the largest scale that fits the table.
+# Compacted tables are read-only and do not keep visit counts, keep the original table to continue training.
+# Usage: python compact_table.py <table.json|table.db> <compact.db|compact.json> [float16|int16|float32] [scale]
+#        [--visited-only]
+
+value_formats = {"float16": "e", "int16": "h", "float32": "f"}
+format_limits = {"float16": 65504.0, "int16": 32767, "float32": 3.4e38}
+
+
+def collect_states(store):
+    # {canonical state: {action: [weighted value sum, visits, value sum, copies]}}
+    states = {}
+    entries = 0
+    last_state = None
+    for state, action, value, visits in store.items():
+        entries += 1
+        if state != last_state:
+            # Rows of a state are adjacent in every backend, so each key is parsed once
+            last_state = state
+            canonical, order = canonicalize_state_key(state)
+            canonical_actions = {index: position for position, index in enumerate(order)}
+            actions = states.setdefault(canonical, {})
+        action = canonical_actions.get(action, action)
+        merged = actions.get(action)
+        if merged is None:
+            merged = actions[action] = [0, 0, 0, 0]
+        merged[0] += value * visits
+        merged[1] += visits
+        merged[2] += value
+        merged[3] += 1
+    return states, entries
+
+
+def merge_and_prune(states, visited_only=False):
+    # {state: {action: value}} without the entries that read the same as a missing one
+    pruned = {}
+    for state, actions in states.items():
+        kept = {}
+        for action, (weighted_sum, visits, value_sum, copies) in actions.items():
+            value = weighted_sum / visits if visits else value_sum / copies
+            if value != 0 and (visits or not visited_only):
+                kept[action] = value
+        if kept:
+            pruned[state] = kept
+    return pruned
+
+
+def default_scale(table, value_format):
+    if value_format != "int16":
+        return 1.0
+    largest = max((abs(value) for actions in table.values() for value in actions.values()), default=0)
+    return format_limits["int16"] / largest if largest else 1.0
+
+
+def pack_states(table, value_format, scale):
+    # (state, packed values) rows. Values that quantize to 0 are pruned like exact zeros.
+    code = value_formats[value_format]
+    limit = format_limits[value_format]
+    for state, actions in table.items():
+        values = [0] * (max(actions) + 1)
+        for action, value in actions.items():
+            scaled = value * scale
+            if abs(scaled) > limit:
+                raise ValueError(f"{value} does not fit in {value_format} with scale {scale}, use a smaller scale")
+            values[action] = round(scaled) if value_format == "int16" else scaled
+        while values and values[-1] == 0:
+            values.pop()
+        if any(values):
+            yield state, struct.pack(f"<{len(values)}{code}", *values)
+
+
+def write_compact_db(table, db_path, value_format="float16", scale=1.0):
+    import sqlite3
+    conn = sqlite3.connect(db_path)
+    cur = conn.cursor()
+    cur.execute('DROP TABLE IF EXISTS QStates')
+    cur.execute('DROP TABLE IF EXISTS QTableMeta')
+    # WITHOUT ROWID keeps each state key once, in the primary key index itself
+    cur.execute('CREATE TABLE QStates (state TEXT PRIMARY KEY, qvalues BLOB) WITHOUT ROWID')
+    cur.execute('CREATE TABLE QTableMeta (key TEXT PRIMARY KEY, value TEXT)')
+    cur.executemany('INSERT INTO QTableMeta (key, value) VALUES (?, ?)',
+                    (("format", value_formats[value_format]), ("scale", repr(scale))))
+    cur.executemany('INSERT INTO QStates (state, qvalues) VALUES (?, ?)', pack_states(table, value_format, scale))
+    conn.commit()
+    cur.execute('SELECT COUNT(*) FROM QStates')
+    states = cur.fetchone()[0]
+    conn.execute('VACUUM')
+    conn.close()
+    return states
+
+
+def write_compact_json(table, json_path):
+    with open(json_path, 'w') as file:
+        json.dump({state: {f"{action}": value for action, value in actions.items()}
+                   for state, actions in table.items()}, file)
+    return len(table)
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    source, destination = args[0], args[1]
+    value_format = args[2] if len(args) > 2 else "float16"
+    visited_only = '--visited-only' in sys.argv
+    if value_format not in value_formats:
+        raise ValueError(f"Unknown value format {value_format}, use one of {', '.join(value_formats)}")
+    if os.path.abspath(source) == os.path.abspath(destination):
+        raise ValueError("The compacted table has to be written to a different file")
+    if destination.endswith('.db') and os.path.exists(destination):
+        os.remove(destination)  # Start from an empty database rather than one holding an old QTable
+
+    start_time = time.perf_counter()
+    store = open_q_store(source)
+    states, entries = collect_states(store)
+    store.close()
+    table = merge_and_prune(states, visited_only)
+    kept_entries = sum(len(actions) for actions in table.values())
+
+    if destination.endswith('.db'):
+        scale = float(args[3]) if len(args) > 3 else default_scale(table, value_format)
+        kept_states = write_compact_db(table, destination, value_format, scale)
+        print(f"Values stored as {value_format} with scale {scale}")
+    elif destination.endswith('.json'):
+        kept_states = write_compact_json(table, destination)
+    else:
+        raise ValueError(f"Unknown Q-table format: {destination}")
+
+    elapsed_time = time.perf_counter() - start_time
+    source_size, destination_size = os.path.getsize(source), os.path.getsize(destination)
+    print(f"{len(states)} states and {entries} entries before, {kept_states} states and {kept_entries} entries after")
+    print(f"{source} ({source_size} bytes) compacted to {destination} ({destination_size} bytes), "
+          f"{destination_size / source_size:.1%} of the original size, in {elapsed_time} seconds.")
@@ -3,6 +3,10 @@ from plot_scores import *
 from concurrent.futures import ProcessPoolExecutor, as_completed
 import multiprocessing
 import traceback
+from q_store import JSONQStore, best_action
+from bid_lookup import load_bid_table
+from symmetry import canonicalize
+from trick import Trick
 
 # Print game logs
 print_logs = False
@@ -11,6 +15,9 @@ print_logs = False
 sessions = 10
 games = 10000
 
+# Bids precomputed by bid_lookup.py, used when the file exists. Other hands are bid by make_bid.
+bid_table_path = 'bid_table.db'
+
 # Integer representation of each unique card
 card_integers = {
     "Escape": 1,
@@ -86,8 +93,7 @@ suit_integers = {
 }
 
 # Initialize q-table
-with open('decision.json', 'r') as file:
-    q_table = json.load(file)
+q_table = JSONQStore('decision.json')
 
 class Card:
     def __init__(self, suit=None, rank=None, special=None):
@@ -232,7 +238,7 @@ class AIAgent(Player):
 
         return legal_indices
 
-    def make_bid(self):
+    def make_bid(self, position=None):
         # This can be further refined
         self.bid = len([card for card in self.hand if card.rank is not None and card.rank > 10])
         self.bid += len([card for card in self.hand if card.special == "Tigress" or card.special == "Pirate" or card.special == "Skull King"])
@@ -245,19 +251,33 @@ class TrainedAIAgent(AIAgent):
     def __init__(self, name):
         super().__init__(name)
 
-    def get_state(self, trick=[]):
+    def make_bid(self, position=None):
+        # Precomputed bid for the hand if there is one, make_bid's count otherwise
+        bid_table = load_bid_table(bid_table_path)
+        if bid_table is not None and position is not None:
+            bid = bid_table.get_bid([card_integers[f"{card}"] for card in self.hand], position)
+            if bid is not None:
+                self.bid = bid
+                return self.bid
+        return super().make_bid()
+
+    def get_state(self, trick=Trick()):
         # hand should already be in a sorted state, this is good because order of cards in hand does not matter
         # Combining all the features into one state representation, each element should be normalized
+        # Yellow, Purple and Green are relabeled into the canonical order the table was trained with (see symmetry.py),
+        # action_order maps the actions of the canonical hand back to the legal hand
+        hand = [card_integers[f"{card}"] for card in self.get_legal_hand(trick.leading_suit)]
+        winning_card = card_integers[f"{trick.winner[1]}"] if trick else 0
+        hand, winning_card, _, action_order = canonicalize(hand, winning_card)
         state = {
-            "Hand": [card_integers[f"{card}"] / len(card_integers) for card in
-                     self.get_legal_hand(determine_leading_suit(trick))],
+            "Hand": [card / len(card_integers) for card in hand],
             # Needs normalized representation, would require assigning a unique integer to each unique card
-            "Winning Card": [card_integers[f"{determine_winner(trick)[1]}"] / len(card_integers) if trick else 0],
+            "Winning Card": [winning_card / len(card_integers) if trick else 0],
             "Tricks to Bid": [
                 1 if self.bid - self.tricks_taken > 0 else 0.5 if self.bid - self.tricks_taken == 0 else 0]
         }
 
-        return state
+        return state, action_order
 
 
     def get_legal_hand(self, leading_suit=None):
@@ -273,7 +293,8 @@ class TrainedAIAgent(AIAgent):
 
 
     def play_card(self, players, trick, leading_suit=None):
-        state_str = json.dumps(self.get_state(trick), sort_keys=True)
+        state, action_order = self.get_state(trick)
+        state_str = json.dumps(state, sort_keys=True)
 
         # Retrieve the list of legal actions for the current state.
         legal_hand = self.get_legal_hand(leading_suit)
@@ -282,16 +303,19 @@ class TrainedAIAgent(AIAgent):
             if card.special == "Tigress":
                 legal_actions += 1
 
-        if state_str not in q_table:
+        # Values of the legal actions, which are the first legal_actions actions of the state.
+        # Actions pruned by compact_table.py still hold their initial value of 0
+        action_values = q_table.get_action_array(state_str, legal_actions)
+        if action_values is None:
             # Select a random legal actions
             action = random.randint(0, legal_actions-1)
         else:
-            # Find the max Q-value among legal actions for the current state
-            max_q_value = max([q_table[state_str][f"{i}"] for i in range(legal_actions)])
-            max_actions = [i for i in range(legal_actions) if q_table[state_str][f"{i}"] == max_q_value]
+            # Find the max Q-value among legal actions for the current state, randomly selecting one of the max actions
+            action = best_action(action_values)
 
-            # Randomly select one of the max actions
-            action = random.choice(max_actions)
+        # The Q-table is indexed by the canonical hand, the card is taken from the legal hand
+        if action < len(action_order):
+            action = action_order[action]
 
         # check if tigress was played as a pirate or escape, and edit the corresponding card accordingly
         card_to_play = None
@@ -347,9 +371,10 @@ def deal_cards(players, round_number):
 
 def gather_bids(players, round_number):
     bids = {}
-    for player in players:
+    leader = (round_number % len(players) - 1) % len(players)  # Seat leading the first trick, see determine_turn_order
+    for seat, player in enumerate(players):
         if isinstance(player, AIAgent):
-            player.bid = player.make_bid()  # The AI's bidding logic
+            player.bid = player.make_bid((seat - leader) % len(players))  # The AI's bidding logic
         else:
             while True:  # keep asking for bid until a valid input is given
                 try:
@@ -377,19 +402,19 @@ def gather_bids(players, round_number):
 
 def play_tricks(players, round_number):
     for _ in range(round_number):
-        current_trick = []
+        current_trick = Trick()
 
         for player in players:
             player.is_trick_leader = False
-            leading_suit = determine_leading_suit(current_trick)
+            leading_suit = current_trick.leading_suit
             card_played = player.play_card(players, current_trick, leading_suit if leading_suit else None)
             current_trick.append((player, card_played))
             if print_logs:
                 print(f"{player.name} plays {card_played}")
 
         # Determine the winner of the trick
-        winner = determine_winner(current_trick)
-        bonus_points = determine_bonus_points(current_trick)
+        winner = current_trick.winner
+        bonus_points = current_trick.bonus_points
         winner[0].tricks_taken += 1
         winner[0].bonus_points += bonus_points
         winner[0].is_trick_leader = True
@@ -1,9 +1,14 @@
-import random, json, time, sqlite3
+import random, json, time, os, sys
 from concurrent.futures import ProcessPoolExecutor, as_completed
 import multiprocessing
 import traceback
-import pandas as pd
-import matplotlib.pyplot as plt
+import numpy as np
+from q_store import get_q_store, warm_q_store, open_q_store, best_action
+from hashed_q import HashedQFunction, agent_codes, agent_actions
+from shared_q_table import SharedQStore, attach_shared_q_store
+from bid_lookup import load_bid_table
+from symmetry import canonicalize
+from trick import Trick
 
 # Print game logs
 print_logs = False
@@ -12,6 +17,17 @@ print_logs = False
 sessions = 100
 games = 10000
 
+# Score distribution histogram, final scores are clipped into the outer bins
+score_min = -550  # Every bid missed by the maximum amount
+score_bin_width = 10
+score_bins = 200
+
+# Directory the results files are written to
+results_dir = 'results'
+
+# Bids precomputed by bid_lookup.py, used when the file exists. Other hands are bid by make_bid.
+bid_table_path = 'bid_table.db'
+
 # Integer representation of each unique card
 card_integers = {
     "Escape": 1,
@@ -115,6 +131,8 @@ class Player:
         self.is_trick_leader = False
         self.round_record = [0 for _ in range(10)]
         self.round_scores = [0 for _ in range(11)]
+        self.tracks_cards = False  # Agents that sample the other hands get a CardTracker (card_tracker.py)
+        self.card_tracker = None
 
     def display_hand(self):
         hand_message = f"\n{self.name}'s hand contains:\n"
@@ -232,7 +250,7 @@ class AIAgent(Player):
 
         return legal_indices
 
-    def make_bid(self):
+    def make_bid(self, position=None):
         # This can be further refined
         self.bid = len([card for card in self.hand if card.rank is not None and card.rank > 10])
         self.bid += len([card for card in self.hand if card.special == "Tigress" or card.special == "Pirate" or card.special == "Skull King"])
@@ -242,22 +260,44 @@ class AIAgent(Player):
 
 
 class TrainedAIAgent(AIAgent):
-    def __init__(self, name):
+    def __init__(self, name, rollout_bids=False, db_path=None):
         super().__init__(name)
+        self.rollout_bids = rollout_bids  # Bid by simulating the round (rollout_bidder.py) instead of make_bid
+        self.db_path = db_path  # Q-table of this agent, instead of the one the session is run with
+
+    def make_bid(self, position=None):
+        # Precomputed bid for the hand if there is one, then a rollout bid or make_bid's count
+        bid_table = load_bid_table(bid_table_path)
+        if bid_table is not None and position is not None:
+            bid = bid_table.get_bid([card_integers[f"{card}"] for card in self.hand], position)
+            if bid is not None:
+                self.bid = bid
+                return self.bid
+        if not self.rollout_bids or position is None:
+            return super().make_bid()
+        # Imported here so that sessions without rollout bids do not load Numba
+        from fast_engine import hand_ids
+        from rollout_bidder import rollout_bid
+        self.bid, _ = rollout_bid(hand_ids(self.hand), position)
+        return self.bid
 
-    def get_state(self, trick=[]):
+    def get_state(self, trick=Trick()):
         # hand should already be in a sorted state, this is good because order of cards in hand does not matter
         # Combining all the features into one state representation, each element should be normalized
+        # Yellow, Purple and Green are relabeled into the canonical order the table was trained with (see symmetry.py),
+        # action_order maps the actions of the canonical hand back to the legal hand
+        hand = [card_integers[f"{card}"] for card in self.get_legal_hand(trick.leading_suit)]
+        winning_card = card_integers[f"{trick.winner[1]}"] if trick else 0
+        hand, winning_card, _, action_order = canonicalize(hand, winning_card)
         state = {
-            "Hand": [card_integers[f"{card}"] / len(card_integers) for card in
-                     self.get_legal_hand(determine_leading_suit(trick))],
+            "Hand": [card / len(card_integers) for card in hand],
             # Needs normalized representation, would require assigning a unique integer to each unique card
-            "Winning Card": [card_integers[f"{determine_winner(trick)[1]}"] / len(card_integers) if trick else 0],
+            "Winning Card": [winning_card / len(card_integers) if trick else 0],
             "Tricks to Bid": [
                 1 if self.bid - self.tricks_taken > 0 else 0.5 if self.bid - self.tricks_taken == 0 else 0]
         }
 
-        return state
+        return state, action_order
 
 
     def get_legal_hand(self, leading_suit=None):
@@ -273,10 +313,18 @@ class TrainedAIAgent(AIAgent):
 
 
     def play_card(self, players, trick, leading_suit=None, db_path='q_table.db'):
-
-        conn = sqlite3.connect(db_path)
-        cur = conn.cursor()
-        state_str = json.dumps(self.get_state(trick), sort_keys=True)
+        decision = self.decision(trick, leading_suit)
+        state_str, legal_actions = decision[0], decision[1]
+        # Values of the legal actions, which are the first legal_actions actions of the state. Legal actions missing
+        # from the table were pruned by compact_table.py because they still held their initial value of 0
+        action_values = get_q_store(self.db_path or db_path).get_action_array(state_str, legal_actions)
+        return self.play_decision(decision, action_values)
+
+    def decision(self, trick, leading_suit=None):
+        # State key and number of legal actions to look up, with what play_decision() needs to play the chosen action.
+        # Split from play_card so that the lookups of many games can be batched (see policy_service.py).
+        state, action_order = self.get_state(trick)
+        state_str = json.dumps(state, sort_keys=True)
 
         # Retrieve the list of legal actions for the current state.
         legal_hand = self.get_legal_hand(leading_suit)
@@ -284,27 +332,20 @@ class TrainedAIAgent(AIAgent):
         for card in legal_hand:
             if card.special == "Tigress":
                 legal_actions += 1
+        return state_str, legal_actions, action_order, legal_hand
 
-        cur.execute('SELECT action, value FROM QTable WHERE state=?', (state_str,))
-        action_values = cur.fetchall()
-        conn.close()
-
-        if not action_values:  # If no entry in the database
+    def play_decision(self, decision, action_values):
+        state_str, legal_actions, action_order, legal_hand = decision
+        if action_values is None:  # If no entry in the database
             # Select a random action from the set of legal actions
             action = random.randint(0, legal_actions-1)
         else:
-            # Filter actions to include only those that are legal
-            action_dict = {action: value for action, value in action_values if int(action) < legal_actions}
+            # Max Q-value among the legal actions, randomly selecting one of the max actions
+            action = best_action(action_values)
 
-            if not action_dict:
-                # If no legal actions are found in the database, select randomly from legal actions
-                action = random.randint(0, legal_actions - 1)
-            else:
-                # Find the max Q-value among the filtered legal actions
-                max_q_value = max(action_dict.values())
-                max_actions = [action for action, value in action_dict.items() if value == max_q_value]
-                # Randomly select one of the max actions
-                action = int(random.choice(max_actions))
+        # The Q-table is indexed by the canonical hand, the card is taken from the legal hand
+        if action < len(action_order):
+            action = action_order[action]
 
         # check if tigress was played as a pirate or escape, and edit the corresponding card accordingly
         card_to_play = None
@@ -324,6 +365,36 @@ class TrainedAIAgent(AIAgent):
         return card_to_play
 
 
+# Hashed Q-functions read by HashedAIAgents, by weights file, loaded once per process
+hashed_q_functions = {}
+
+
+def load_hashed_q_function(path):
+    q_function = hashed_q_functions.get(path)
+    if q_function is None:
+        q_function = hashed_q_functions[path] = HashedQFunction()
+        q_function.load(path)
+    return q_function
+
+
+class HashedAIAgent(TrainedAIAgent):
+    # Plays greedily from the weights saved by training.py --hashed ({table}.hashed.npz, see hashed_q.py), given as
+    # db_path or as the session's table. The cards of the earlier tricks are taken from its CardTracker.
+    def __init__(self, name, rollout_bids=False, db_path=None):
+        super().__init__(name, rollout_bids, db_path)
+        self.tracks_cards = True
+
+    def play_card(self, players, trick, leading_suit=None, db_path='q_table.db'):
+        q_function = load_hashed_q_function(self.db_path or db_path)
+        tracker = self.card_tracker
+        played = [card_integers[f"{card}"] for card in tracker.cards[:len(tracker.cards) - len(trick)]]
+        legal_hand = self.get_legal_hand(leading_suit)
+        actions = agent_actions(legal_hand, card_integers)
+        codes = agent_codes(self, players, trick, leading_suit, tracker.round_number, played, card_integers)
+        action_values = q_function.values(q_function.indices(codes, actions)).tolist()
+        return self.play_decision((None, len(actions), [], legal_hand), action_values)
+
+
 def sort_hand(card):
     # Define an order for colors and specials
     color_order = {"Yellow": 0, "Purple": 1, "Green": 2, "Black": 3}
@@ -360,9 +431,10 @@ def deal_cards(players, round_number):
 
 def gather_bids(players, round_number):
     bids = {}
-    for player in players:
+    leader = (round_number % len(players) - 1) % len(players)  # Seat leading the first trick, see determine_turn_order
+    for seat, player in enumerate(players):
         if isinstance(player, AIAgent):
-            player.bid = player.make_bid()  # The AI's bidding logic
+            player.bid = player.make_bid((seat - leader) % len(players))  # The AI's bidding logic
         else:
             while True:  # keep asking for bid until a valid input is given
                 try:
@@ -389,20 +461,29 @@ def gather_bids(players, round_number):
 
 
 def play_tricks(players, round_number, db_path='q_table.db'):
+    card_tracker = None
+    if any(player.tracks_cards for player in players):
+        from card_tracker import CardTracker
+        card_tracker = CardTracker(players, round_number)
+        for player in players:
+            player.card_tracker = card_tracker
+
     for _ in range(round_number):
-        current_trick = []
+        current_trick = Trick()
 
         for player in players:
             player.is_trick_leader = False
-            leading_suit = determine_leading_suit(current_trick)
+            leading_suit = current_trick.leading_suit
             card_played = player.play_card(players, current_trick, leading_suit if leading_suit else None, db_path=db_path)
             current_trick.append((player, card_played))
+            if card_tracker is not None:
+                card_tracker.record(player, card_played, leading_suit)
             if print_logs:
                 print(f"{player.name} plays {card_played}")
 
         # Determine the winner of the trick
-        winner = determine_winner(current_trick)
-        bonus_points = determine_bonus_points(current_trick)
+        winner = current_trick.winner
+        bonus_points = current_trick.bonus_points
         winner[0].tricks_taken += 1
         winner[0].bonus_points += bonus_points
         winner[0].is_trick_leader = True
@@ -499,7 +580,7 @@ def score_round(players, round_number):
             print(f"{player.name}'s Score: {player.score}")
         player.tricks_taken = 0
         player.bonus_points = 0
-        player.round_scores[round_number-1] = player.score-player_score_start
+        player.round_scores[round_number-1] += player.score-player_score_start
 
 
 def determine_turn_order(players, round_number=None):
@@ -551,204 +632,144 @@ def determine_final_winner(players):
     return winners
 
 
-def plot_scores(average_scores):
-    # Convert dictionary to DataFrame
-    scores_df = pd.DataFrame(list(average_scores.items()), columns=['Player', 'Score']).set_index('Player')
-    average_scores = scores_df['Score']
-
-    # Calculate the percentage improvements
-    percent_improvements = {}
-    for player in average_scores.index:
-        other_players = average_scores.drop(player)
-        improvements = (average_scores[player] - other_players) / other_players * 100
-        percent_improvements[player] = improvements.mean()
-
-    # Plotting
-    ax = average_scores.plot(kind='bar', color='skyblue', figsize=(8, 6))
-    plt.title('Average Number of Games Won by Each Player')
-    plt.xlabel('Player')
-    plt.ylabel('Average Games Won')
-    plt.xticks(rotation=0)
-
-    # Annotate each bar with the numerical value and the average percentage improvement inside the bar
-    for bar in ax.patches:
-        height = bar.get_height()
-
-        # Display the average score on the bar
-        ax.text(bar.get_x() + bar.get_width() / 2, height + 0.5, f'{height:.2f}',
-                ha='center', va='bottom')
-
-        # Display the average percentage improvement inside the bar
-        player = average_scores.index[ax.patches.index(bar)]
-        improvement = percent_improvements[player]
-        ax.text(bar.get_x() + bar.get_width() / 2, height - 15, f'{improvement:.2f}%',
-                ha='center', va='top', color='red', fontsize=9)
-
-    plt.show()
-
-
-def plot_rounds(rounds_results, total_games=sessions*games):
-    # Convert to DataFrame
-    df = pd.DataFrame(rounds_results)
-
-    # Title with total games
-    title = f"Number of Bids Met by Round (Total Games Played: {total_games})"
-
-    # Plotting
-    fig, ax = plt.subplots(figsize=(12, 8))
-
-    # Bar width
-    bar_width = 0.2
-
-    # Rounds (x-axis positions)
-    rounds = df.index + 1
-
-    # For each player, plot a bar for each round
-    for i, player in enumerate(df.columns):
-        ax.bar(rounds + i * bar_width, df[player], width=bar_width, label=player)
-
-    # Setting the x-axis ticks to be at the center of the groups of bars
-    ax.set_xticks(rounds + bar_width * (len(df.columns) - 1) / 2)
-    ax.set_xticklabels(rounds)
-
-    ax.set_xlabel('Round Number')
-    ax.set_ylabel('Number of Bids Met')
-    ax.set_title(title)
-    ax.legend(title='Player')
-
-    plt.show()
-
-
-def plot_rounds_points(rounds_points, total_games=sessions*games):
-    # Convert to DataFrame
-    df = pd.DataFrame(rounds_points)
-
-    # Divide each value by the total games for the corresponding player
-    normalized_df = df.div(total_games)  # Scales by total games
-
-    # Title with total games
-    title = f"Number of Points Earned by Round (Total Games Played: {total_games})"
-
-    # Plotting
-    fig, ax = plt.subplots(figsize=(12, 8))
-
-    # Bar width
-    bar_width = 0.2
-
-    # Rounds (x-axis positions)
-    rounds = normalized_df.index + 1
-
-    # For each player, plot a bar for each round
-    for i, player in enumerate(normalized_df.columns):
-        ax.bar(rounds + i * bar_width, normalized_df[player], width=bar_width, label=player)
-
-    # Setting the x-axis ticks to be at the center of the groups of bars
-    ax.set_xticks(rounds + bar_width * (len(normalized_df.columns) - 1) / 2)
-
-    # Modify x-axis tick labels
-    tick_labels = list(map(str, rounds))
-    tick_labels[-1] = "Total"  # Change the last tick label to "Total"
-    ax.set_xticklabels(tick_labels)
+def new_session_stats(num_players):
+    # Preallocated accumulators, indexed by seat. Sessions are combined by adding the arrays together.
+    return {
+        "games_played": np.zeros(1, dtype=np.int64),
+        "games_won": np.zeros(num_players, dtype=np.int64),
+        "rounds_won": np.zeros((num_players, 10), dtype=np.int64),  # Bids met per round
+        "rounds_scores": np.zeros((num_players, 11), dtype=np.int64),  # Points per round, final score in the last column
+        "score_histogram": np.zeros((num_players, score_bins), dtype=np.int64),
+    }
 
-    ax.set_xlabel('Round Number')
-    ax.set_ylabel('Number of Points Earned')
-    ax.set_title(title)
-    ax.legend(title='Player')
 
-    plt.show()
+def merge_session_stats(total_stats, session_stats):
+    for key in total_stats:
+        total_stats[key] += session_stats[key]
+    return total_stats
 
 
 def run_session(players, session_number, games, db_path='q_table.db'):
     try:
         print(f"Session {session_number} started")
-        games_won = {player.name: 0 for player in players}
-        rounds_won = {player.name: [0 for _ in range(10)] for player in players}
-        rounds_scores = {player.name: [0 for _ in range(11)] for player in players}
+        stats = new_session_stats(len(players))
+        player_index = {player.name: i for i, player in enumerate(players)}
+        seats = np.arange(len(players))
+        final_scores = np.zeros(len(players), dtype=np.int64)
+
+        # score_round writes directly into the session accumulators through these row views
+        for i, player in enumerate(players):
+            player.round_record = stats["rounds_won"][i]
+            player.round_scores = stats["rounds_scores"][i]
+
         for i in range(games):
-            print(f'Session {session_number}, game {i+1} has started')
+            if print_logs:
+                print(f'Session {session_number}, game {i+1} has started')
             for round_number in range(1, 11):
                 play_round(players, round_number, db_path=db_path)
-            for player in players:
-                player.round_scores[10] = player.score
-                rounds_scores[player.name] = player.round_scores
-                print(player.round_scores)
-                player.round_scores = [0 for _ in range(11)]
-                rounds_won[player.name] = player.round_record
-                player.round_record = [0 for _ in range(10)]
+            for j, player in enumerate(players):
+                final_scores[j] = player.score
+            stats["rounds_scores"][:, 10] += final_scores
+            score_bin = np.clip((final_scores - score_min) // score_bin_width, 0, score_bins - 1)
+            stats["score_histogram"][seats, score_bin] += 1
             winners = determine_final_winner(players)
             for winner in winners:
-                games_won[winner] += 1
-        return games_won, rounds_won, rounds_scores
+                stats["games_won"][player_index[winner]] += 1
+        stats["games_played"] += games
+        return stats
     except Exception as e:
         print(f"Exception in session {session_number}: {e}")
         traceback.print_exc()
         raise
 
 
-def run_sessions(players, sessions=10, games=10000):
+def run_sessions(players, sessions=10, games=10000, db_path='q_table.db', shared_memory=False):
     print(f"Running sessions for {', '.join(player.name for player in players)}...")
-    session_win_results = []
-    session_rounds_results = []
-    session_rounds_points = []
-
-    with ProcessPoolExecutor() as executor:
+    names = [player.name for player in players]
+    final_stats = new_session_stats(len(players))
+    completed_sessions = 0
+
+    # Workers open the Q-table once at startup rather than once per card
+    uses_q_table = any(isinstance(player, TrainedAIAgent) and not isinstance(player, HashedAIAgent)
+                       for player in players)
+    initializer, initargs, shared_table = None, (), None
+    # Compiled policies are memory mapped, so the workers already share one copy of them
+    if uses_q_table and shared_memory and not db_path.endswith('.policy'):
+        # Load the table once into shared memory, every worker then reads the same copy without SQLite
+        source_table = open_q_store(db_path)
+        shared_table = SharedQStore.from_store(source_table)
+        source_table.close()
+        initializer, initargs = attach_shared_q_store, (shared_table.handle(), db_path)
+    elif uses_q_table:
+        initializer, initargs = warm_q_store, (db_path,)
+
+    with ProcessPoolExecutor(initializer=initializer, initargs=initargs) as executor:
         # Submit all sessions to the executor
-        future_to_session = {executor.submit(run_session, players, session, games): session for session in
+        future_to_session = {executor.submit(run_session, players, session, games, db_path): session for session in
                              range(1, sessions + 1)}
 
         for future in as_completed(future_to_session):
             session_number = future_to_session[future]
             try:
-                win_result = future.result()[0]
-                rounds_result = future.result()[1]
-                rounds_points_result = future.result()[2]
-                print(f"Session {session_number} completed with results: {win_result}")
-                session_win_results.append(win_result)
-                session_rounds_results.append(rounds_result)
-                session_rounds_points.append(rounds_points_result)
+                session_stats = future.result()
+                print(f"Session {session_number} completed with results: {dict(zip(names, session_stats['games_won'].tolist()))}")
+                merge_session_stats(final_stats, session_stats)
+                completed_sessions += 1
             except Exception as exc:
                 print(f"Session {session_number} generated an exception: {exc}")
 
-    # Combine results from all sessions
-    final_win_results = {player.name: 0 for player in players}
-    final_rounds_results = {player.name: [0 for _ in range(10)] for player in players}
-    final_rounds_points = {player.name: [0 for _ in range(11)] for player in players}
-    for result in session_win_results:
-        for name, wins in result.items():
-            final_win_results[name] += wins
-    for name in final_win_results:
-        final_win_results[name] /= sessions
-    for result in session_rounds_results:
-        for name, round_wins in result.items():
-            final_rounds_results[name] = [a + b for a, b in zip(final_rounds_results[name], round_wins)]
-    for result in session_rounds_points:
-        for name, round_points in result.items():
-            final_rounds_points[name] = [a + b for a, b in zip(final_rounds_points[name], round_points)]
-
-    # Operations after all sessions
-    plot_scores(final_win_results)
-    plot_rounds(final_rounds_results)
-    plot_rounds_points(final_rounds_points)
+    if shared_table is not None:
+        shared_table.close()
+
+    # Operations after all sessions, plots are rendered separately from the results file by plot_scores.py
+    results_path = f"{results_dir}/results_{'_'.join(names)}.json"
+    save_results(results_path, names, final_stats, completed_sessions)
+    print(f"Results written to {results_path}, render them with: python plot_scores.py {results_path}")
+    return final_stats
+
+
+def save_results(file_path, names, stats, completed_sessions):
+    results = {
+        "players": names,
+        "sessions": completed_sessions,
+        "total_games": int(stats["games_played"][0]),
+        "average_games_won": (stats["games_won"] / max(completed_sessions, 1)).tolist(),
+        "rounds_won": stats["rounds_won"].tolist(),
+        "rounds_scores": stats["rounds_scores"].tolist(),
+        "score_histogram": stats["score_histogram"].tolist(),
+        "score_min": score_min,
+        "score_bin_width": score_bin_width,
+    }
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    with open(file_path, 'w') as file:
+        json.dump(results, file)
 
 if __name__ == "__main__":
     start_time = time.perf_counter()
 
     multiprocessing.set_start_method('spawn')
+    # Usage: python evaluate_sql.py [table.db|table.policy|table.hashed.npz] [--shared-memory] [--rollout-bids]
+    # Weights saved by training.py --hashed are played by a HashedAIAgent
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    db_path = args[0] if args else 'q_table.db'
+    agent_class = HashedAIAgent if db_path.endswith('.hashed.npz') else TrainedAIAgent
+    shared_memory = '--shared-memory' in sys.argv
+    rollout_bids = '--rollout-bids' in sys.argv
 
     players = [AIAgent("AI1"), AIAgent("AI2"), AIAgent("AI3"), AIAgent("AI4")]
-    run_sessions(players, sessions, games)
+    run_sessions(players, sessions, games, db_path, shared_memory=shared_memory)
 
-    players = [AIAgent("AI1"), AIAgent("AI2"), AIAgent("AI3"), TrainedAIAgent("TAI")]
-    run_sessions(players, sessions, games)
+    players = [AIAgent("AI1"), AIAgent("AI2"), AIAgent("AI3"), agent_class("TAI", rollout_bids)]
+    run_sessions(players, sessions, games, db_path, shared_memory=shared_memory)
 
-    players = [AIAgent("AI1"), AIAgent("AI2"), TrainedAIAgent("TAI"), AIAgent("AI4")]
-    run_sessions(players, sessions, games)
+    players = [AIAgent("AI1"), AIAgent("AI2"), agent_class("TAI", rollout_bids), AIAgent("AI4")]
+    run_sessions(players, sessions, games, db_path, shared_memory=shared_memory)
 
-    players = [AIAgent("AI1"), TrainedAIAgent("TAI"), AIAgent("AI3"), AIAgent("AI4")]
-    run_sessions(players, sessions, games)
+    players = [AIAgent("AI1"), agent_class("TAI", rollout_bids), AIAgent("AI3"), AIAgent("AI4")]
+    run_sessions(players, sessions, games, db_path, shared_memory=shared_memory)
 
-    players = [TrainedAIAgent("TAI"), AIAgent("AI2"), AIAgent("AI3"), AIAgent("AI4")]
-    run_sessions(players, sessions, games)
+    players = [agent_class("TAI", rollout_bids), AIAgent("AI2"), AIAgent("AI3"), AIAgent("AI4")]
+    run_sessions(players, sessions, games, db_path, shared_memory=shared_memory)
 
     end_time = time.perf_counter()
     elapsed_time = end_time - start_time
@@ -0,0 +1,312 @@
+import sys, time
+import numpy as np
+
+# Array version of the game rules for simulations that do not need the Card and Player objects, such as rollouts
+# with the default AIAgent policy. Cards are ids into the arrays below, a trick is the arrays of the kinds, suits and
+# ranks of its cards in the order they were played.
+# The kernels are compiled with Numba when it is installed and run as plain Python otherwise, which is only meant for
+# checking results. python fast_engine.py checks the kernels against the rules of the game scripts and compares the
+# simulation speed of the two engines.
+
+try:
+    from numba import njit
+    numba_available = True
+except ImportError:
+    numba_available = False
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda function: function
+
+# Card kinds, a Tigress in a trick is stored as the kind it was played as
+SUITED, ESCAPE, PIRATE, TIGRESS, SKULL_KING = 0, 1, 2, 3, 4
+# suit_integers of the training scripts, 0 for special cards
+YELLOW, PURPLE, GREEN, BLACK = 1, 2, 3, 4
+
+# Ids 0 to 55 are the suited cards (Yellow, Purple, Green and Black from 1 to 14), followed by the 5 Escapes,
+# 5 Pirates, the Tigress and the Skull King
+deck_size = 68
+card_kinds = np.array([SUITED] * 56 + [ESCAPE] * 5 + [PIRATE] * 5 + [TIGRESS, SKULL_KING], dtype=np.int64)
+card_suits = np.array([suit for suit in (YELLOW, PURPLE, GREEN, BLACK) for _ in range(14)] + [0] * 12, dtype=np.int64)
+card_ranks = np.array(list(range(1, 15)) * 4 + [0] * 12, dtype=np.int64)
+# Rank of each kind among the special cards, as in determine_winner
+special_ranks = np.array([0, 1, 2, 0, 3], dtype=np.int64)
+
+num_players = 4
+num_rounds = 10
+
+
+@njit(cache=True)
+def leading_suit(kinds, suits, count):
+    # Suit of the first suited card, 0 while only special cards have been played
+    for i in range(count):
+        if kinds[i] == SUITED:
+            return suits[i]
+    return 0
+
+
+@njit(cache=True)
+def trick_winner(kinds, suits, ranks, count):
+    # Position in the trick of the winning card, -1 for an empty trick
+    winning_suit = leading_suit(kinds, suits, count)
+    highest_special = -1
+    highest_suit_card = -1
+    only_escapes = True
+    for i in range(count):
+        if kinds[i] != ESCAPE:
+            only_escapes = False
+        if kinds[i] != SUITED:
+            if highest_special < 0 or special_ranks[kinds[i]] > special_ranks[kinds[highest_special]]:
+                highest_special = i
+        elif suits[i] == winning_suit:
+            if highest_suit_card < 0 or ranks[i] > ranks[highest_suit_card]:
+                highest_suit_card = i
+        elif suits[i] == BLACK and suits[highest_suit_card] != BLACK:
+            highest_suit_card = i
+            winning_suit = BLACK
+
+    if highest_special >= 0:
+        if kinds[highest_special] == ESCAPE and not only_escapes:
+            return highest_suit_card if highest_suit_card >= 0 else highest_special
+        return highest_special
+    return highest_suit_card
+
+
+@njit(cache=True)
+def trick_bonus(kinds, suits, ranks, count):
+    king_played = False
+    pirates = 0
+    bonus_points = 0
+    for i in range(count):
+        if kinds[i] == SKULL_KING:
+            king_played = True
+        elif kinds[i] == PIRATE:
+            pirates += 1
+        if ranks[i] == 14:
+            bonus_points += 10 if suits[i] != BLACK else 20
+    if king_played:
+        bonus_points += pirates * 30  # For each pirate captured by the king
+    return bonus_points
+
+
+@njit(cache=True)
+def is_legal(hand, hand_size, index, lead_suit):
+    # determine_legality for the card at hand[index]
+    card = hand[index]
+    if lead_suit == 0 or card_suits[card] == lead_suit or card_kinds[card] != SUITED:
+        return True
+    for i in range(hand_size):
+        if card_suits[hand[i]] == lead_suit:
+            return False
+    return True
+
+
+@njit(cache=True)
+def round_score(bid, tricks_taken, bonus_points, round_number):
+    # Change in score at the end of a round, as in score_round
+    if bid == 0:
+        if tricks_taken == 0:
+            return 10 * round_number + bonus_points
+        return -10 * round_number
+    if bid == tricks_taken:
+        return 20 * bid + bonus_points
+    return -10 * abs(bid - tricks_taken)
+
+
+@njit(cache=True)
+def heuristic_bid(hand, hand_size):
+    # AIAgent.make_bid: ranks above 10, Tigress, Pirates and the Skull King
+    bid = 0
+    for i in range(hand_size):
+        card = hand[i]
+        if card_ranks[card] > 10 or card_kinds[card] == PIRATE or card_kinds[card] == TIGRESS \
+                or card_kinds[card] == SKULL_KING:
+            bid += 1
+    return bid
+
+
+@njit(cache=True)
+def default_choice(hand, hand_size, lead_suit):
+    # AIAgent.choose_card: a random card of the leading suit or special card if there is one, else any random card.
+    # Without a leading suit only the special cards are candidates.
+    candidates = 0
+    for i in range(hand_size):
+        card = hand[i]
+        if card_kinds[card] != SUITED or (lead_suit != 0 and card_suits[card] == lead_suit):
+            candidates += 1
+    if candidates == 0:
+        return np.random.randint(hand_size)
+    pick = np.random.randint(candidates)
+    for i in range(hand_size):
+        card = hand[i]
+        if card_kinds[card] != SUITED or (lead_suit != 0 and card_suits[card] == lead_suit):
+            if pick == 0:
+                return i
+            pick -= 1
+    return -1
+
+
+@njit(cache=True)
+def play_round(hands, hand_sizes, bids, round_number, leader, tricks_taken, bonus_points):
+    # Plays out every trick of a round with the default policy, starting from the given hands and trick leader
+    kinds = np.zeros(num_players, dtype=np.int64)
+    suits = np.zeros(num_players, dtype=np.int64)
+    ranks = np.zeros(num_players, dtype=np.int64)
+    seats = np.zeros(num_players, dtype=np.int64)
+    for _ in range(hand_sizes[leader]):
+        for position in range(num_players):
+            seat = (leader + position) % num_players
+            index = default_choice(hands[seat], hand_sizes[seat], leading_suit(kinds, suits, position))
+            card = hands[seat, index]
+            hand_sizes[seat] -= 1
+            hands[seat, index] = hands[seat, hand_sizes[seat]]
+            kind = card_kinds[card]
+            if kind == TIGRESS:
+                kind = PIRATE if np.random.randint(2) == 0 else ESCAPE
+            kinds[position], suits[position], ranks[position], seats[position] = kind, card_suits[card], card_ranks[card], seat
+        winner = seats[trick_winner(kinds, suits, ranks, num_players)]
+        tricks_taken[winner] += 1
+        bonus_points[winner] += trick_bonus(kinds, suits, ranks, num_players)
+        leader = winner
+
+
+@njit(cache=True)
+def play_game(scores):
+    # One game of 10 rounds between default AIAgents, the final scores are added to scores
+    hands = np.zeros((num_players, num_rounds), dtype=np.int64)
+    hand_sizes = np.zeros(num_players, dtype=np.int64)
+    bids = np.zeros(num_players, dtype=np.int64)
+    tricks_taken = np.zeros(num_players, dtype=np.int64)
+    bonus_points = np.zeros(num_players, dtype=np.int64)
+    for round_number in range(1, num_rounds + 1):
+        deck = np.random.permutation(deck_size)
+        for seat in range(num_players):
+            hands[seat, :round_number] = deck[seat * round_number:(seat + 1) * round_number]
+            hand_sizes[seat] = round_number
+            bids[seat] = heuristic_bid(hands[seat], round_number)
+        tricks_taken[:] = 0
+        bonus_points[:] = 0
+        play_round(hands, hand_sizes, bids, round_number, (round_number - 1) % num_players, tricks_taken, bonus_points)
+        for seat in range(num_players):
+            scores[seat] += round_score(bids[seat], tricks_taken[seat], bonus_points[seat], round_number)
+
+
+@njit(cache=True)
+def simulate_games(games, seed):
+    # Total final score of each seat over the games
+    np.random.seed(seed)
+    scores = np.zeros(num_players, dtype=np.int64)
+    for _ in range(games):
+        play_game(scores)
+    return scores
+
+
+def card_id(card):
+    # Id of a Card object from the game scripts (an Escape or Pirate maps to the first id of its kind)
+    if card.special == "Escape":
+        return 56
+    if card.special == "Pirate":
+        return 61
+    if card.special == "Tigress":
+        return 66
+    if card.special == "Skull King":
+        return 67
+    return (card.suit and ["Yellow", "Purple", "Green", "Black"].index(card.suit)) * 14 + card.rank - 1
+
+
+def hand_ids(cards):
+    # Distinct ids of the cards of a hand, repeated Escapes and Pirates take the following ids of their kind
+    ids = []
+    for card in cards:
+        card_id_ = card_id(card)
+        while card_id_ in ids:
+            card_id_ += 1
+        ids.append(card_id_)
+    return np.array(ids, dtype=np.int64)
+
+
+def trick_arrays(trick):
+    # Kinds, suits and ranks of a list of (player, card) pairs
+    kinds, suits, ranks = [], [], []
+    for player, card in trick:
+        card_id_ = card_id(card)
+        kind = card_kinds[card_id_]
+        if kind == TIGRESS:
+            kind = PIRATE if card.played_as == "Pirate" else ESCAPE
+        kinds.append(kind)
+        suits.append(card_suits[card_id_])
+        ranks.append(card_ranks[card_id_])
+    return np.array(kinds, dtype=np.int64), np.array(suits, dtype=np.int64), np.array(ranks, dtype=np.int64)
+
+
+def check_kernels(rules, tricks=20000):
+    # Number of disagreements between the kernels and the rule functions of a game script (e.g. evaluate_sql)
+    import random
+    colors = ["Yellow", "Purple", "Green", "Black"]
+    specials = [("Escape", 5), ("Pirate", 5), ("Tigress", 1), ("Skull King", 1)]
+    kernels = [(trick_winner, trick_bonus, is_legal, round_score)]
+    if numba_available:
+        kernels.append((trick_winner.py_func, trick_bonus.py_func, is_legal.py_func, round_score.py_func))
+    mismatches = 0
+    for _ in range(tricks):
+        deck = [rules.Card(color, rank) for color in colors for rank in range(1, 15)] + \
+               [rules.Card(None, None, special) for special, count in specials for _ in range(count)]
+        random.shuffle(deck)
+        trick = []
+        for player in range(random.randint(1, num_players)):
+            card = deck.pop()
+            if card.special == "Tigress":
+                card.played_as = random.choice(["Pirate", "Escape"])
+            trick.append((f"Player {player + 1}", card))
+        kinds, suits, ranks = trick_arrays(trick)
+        player = rules.Player("Player")
+        player.hand = [deck.pop() for _ in range(random.randint(1, num_rounds))]
+        hand = np.array([card_id(card) for card in player.hand], dtype=np.int64)
+        lead = rules.determine_leading_suit(trick)
+        lead_suit = colors.index(lead) + 1 if lead else 0
+        bid, tricks_taken, bonus, round_number = (random.randint(0, 10), random.randint(0, 10),
+                                                  random.choice([0, 10, 30]), random.randint(1, 10))
+        for winner_kernel, bonus_kernel, legal_kernel, score_kernel in kernels:
+            if trick[winner_kernel(kinds, suits, ranks, len(trick))] != rules.determine_winner(trick):
+                mismatches += 1
+            if bonus_kernel(kinds, suits, ranks, len(trick)) != rules.determine_bonus_points(trick):
+                mismatches += 1
+            for index, card in enumerate(player.hand):
+                if legal_kernel(hand, len(hand), index, lead_suit) != player.determine_legality(card, lead):
+                    mismatches += 1
+            player.bid, player.tricks_taken, player.bonus_points, player.score = bid, tricks_taken, bonus, 0
+            rules.score_round([player], round_number)
+            if score_kernel(bid, tricks_taken, bonus, round_number) != player.score:
+                mismatches += 1
+    return mismatches
+
+
+def object_engine_run(rules, games):
+    # Games per second of the game script's engine with four default AIAgents, and the average final score of each seat
+    players = [rules.AIAgent(f"AI{i + 1}") for i in range(num_players)]
+    start_time = time.perf_counter()
+    stats = rules.run_session(players, 0, games)
+    return games / (time.perf_counter() - start_time), stats["rounds_scores"][:, 10] / games
+
+
+def fast_engine_run(games, seed=1):
+    simulate_games(1, 0)  # Compile before timing
+    start_time = time.perf_counter()
+    scores = simulate_games(games, seed)
+    return games / (time.perf_counter() - start_time), scores / games
+
+
+if __name__ == "__main__":
+    # Usage: python fast_engine.py [games]
+    import evaluate_sql as rules
+    games = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    mismatches = check_kernels(rules)
+    print(f"Kernels {'compiled with Numba' if numba_available else 'running as plain Python'}, "
+          f"{mismatches} mismatches against the rules of evaluate_sql.py")
+    object_rate, object_scores = object_engine_run(rules, games)
+    fast_rate, fast_scores = fast_engine_run(games * 10 if numba_available else games)
+    print(f"Object engine: {object_rate:.0f} games/s, average scores {np.round(object_scores, 1)}")
+    print(f"Array engine: {fast_rate:.0f} games/s, average scores {np.round(fast_scores, 1)}")
+    print(f"Speedup: {fast_rate / object_rate:.1f}x")
+    sys.exit(1 if mismatches else 0)
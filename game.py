@@ -1,13 +1,19 @@
-import random, json, sqlite3, sys
-import traceback
+import random, json, sys
+from q_store import get_q_store, close_q_stores, best_action
+from bid_lookup import load_bid_table
+from symmetry import canonicalize
+from trick import Trick
 
-# Initialize q_table filename
+# Initialize q_table filename, a policy compiled by policy_table.py can be given with its .policy extension
 db_name = sys.argv[1] if len(sys.argv) > 1 else "q_table"
-db_path = f'{db_name}.db'
+db_path = db_name if db_name.endswith('.policy') else f'{db_name}.db'
 
 # Print game logs
 print_logs = True
 
+# Bids precomputed by bid_lookup.py, used when the file exists. Other hands are bid by make_bid.
+bid_table_path = 'bid_table.db'
+
 # Integer representation of each unique card
 card_integers = {
     "Escape": 1,
@@ -226,7 +232,7 @@ class AIAgent(Player):
 
         return legal_indices
 
-    def make_bid(self):
+    def make_bid(self, position=None):
         # This can be further refined
         self.bid = len([card for card in self.hand if card.rank is not None and card.rank > 10])
         self.bid += len([card for card in self.hand if card.special == "Tigress" or card.special == "Pirate" or card.special == "Skull King"])
@@ -239,19 +245,33 @@ class TrainedAIAgent(AIAgent):
     def __init__(self, name):
         super().__init__(name)
 
-    def get_state(self, trick=[]):
+    def make_bid(self, position=None):
+        # Precomputed bid for the hand if there is one, make_bid's count otherwise
+        bid_table = load_bid_table(bid_table_path)
+        if bid_table is not None and position is not None:
+            bid = bid_table.get_bid([card_integers[f"{card}"] for card in self.hand], position)
+            if bid is not None:
+                self.bid = bid
+                return self.bid
+        return super().make_bid()
+
+    def get_state(self, trick=Trick()):
         # hand should already be in a sorted state, this is good because order of cards in hand does not matter
         # Combining all the features into one state representation, each element should be normalized
+        # Yellow, Purple and Green are relabeled into the canonical order the table was trained with (see symmetry.py),
+        # action_order maps the actions of the canonical hand back to the legal hand
+        hand = [card_integers[f"{card}"] for card in self.get_legal_hand(trick.leading_suit)]
+        winning_card = card_integers[f"{trick.winner[1]}"] if trick else 0
+        hand, winning_card, _, action_order = canonicalize(hand, winning_card)
         state = {
-            "Hand": [card_integers[f"{card}"] / len(card_integers) for card in
-                     self.get_legal_hand(determine_leading_suit(trick))],
+            "Hand": [card / len(card_integers) for card in hand],
             # Needs normalized representation, would require assigning a unique integer to each unique card
-            "Winning Card": [card_integers[f"{determine_winner(trick)[1]}"] / len(card_integers) if trick else 0],
+            "Winning Card": [winning_card / len(card_integers) if trick else 0],
             "Tricks to Bid": [
                 1 if self.bid - self.tricks_taken > 0 else 0.5 if self.bid - self.tricks_taken == 0 else 0]
         }
 
-        return state
+        return state, action_order
 
 
     def get_legal_hand(self, leading_suit=None):
@@ -268,9 +288,8 @@ class TrainedAIAgent(AIAgent):
 
     def play_card(self, players, trick, leading_suit=None, db_path='q_table.db'):
 
-        conn = sqlite3.connect(db_path)
-        cur = conn.cursor()
-        state_str = json.dumps(self.get_state(trick), sort_keys=True)
+        state, action_order = self.get_state(trick)
+        state_str = json.dumps(state, sort_keys=True)
 
         # Retrieve the list of legal actions for the current state.
         legal_hand = self.get_legal_hand(leading_suit)
@@ -279,26 +298,20 @@ class TrainedAIAgent(AIAgent):
             if card.special == "Tigress":
                 legal_actions += 1
 
-        cur.execute('SELECT action, value FROM QTable WHERE state=?', (state_str,))
-        action_values = cur.fetchall()
-        conn.close()
+        # Values of the legal actions, which are the first legal_actions actions of the state. Legal actions missing
+        # from the table were pruned by compact_table.py because they still held their initial value of 0
+        action_values = get_q_store(db_path).get_action_array(state_str, legal_actions)
 
-        if not action_values:  # If no entry in the database
+        if action_values is None:  # If no entry in the database
             # Select a random action from the set of legal actions
             action = random.randint(0, legal_actions-1)
         else:
-            # Filter actions to include only those that are legal
-            action_dict = {action: value for action, value in action_values if int(action) < legal_actions}
+            # Max Q-value among the legal actions, randomly selecting one of the max actions
+            action = best_action(action_values)
 
-            if not action_dict:
-                # If no legal actions are found in the database, select randomly from legal actions
-                action = random.randint(0, legal_actions - 1)
-            else:
-                # Find the max Q-value among the filtered legal actions
-                max_q_value = max(action_dict.values())
-                max_actions = [action for action, value in action_dict.items() if value == max_q_value]
-                # Randomly select one of the max actions
-                action = int(random.choice(max_actions))
+        # The Q-table is indexed by the canonical hand, the card is taken from the legal hand
+        if action < len(action_order):
+            action = action_order[action]
 
         # check if tigress was played as a pirate or escape, and edit the corresponding card accordingly
         card_to_play = None
@@ -354,9 +367,10 @@ def deal_cards(players, round_number):
 
 def gather_bids(players, round_number):
     bids = {}
-    for player in players:
+    leader = (round_number % len(players) - 1) % len(players)  # Seat leading the first trick, see determine_turn_order
+    for seat, player in enumerate(players):
         if isinstance(player, AIAgent):
-            player.bid = player.make_bid()  # The AI's bidding logic
+            player.bid = player.make_bid((seat - leader) % len(players))  # The AI's bidding logic
         else:
             while True:  # keep asking for bid until a valid input is given
                 try:
@@ -384,19 +398,19 @@ def gather_bids(players, round_number):
 
 def play_tricks(players, round_number, db_path='q_table.db'):
     for _ in range(round_number):
-        current_trick = []
+        current_trick = Trick()
 
         for player in players:
             player.is_trick_leader = False
-            leading_suit = determine_leading_suit(current_trick)
+            leading_suit = current_trick.leading_suit
             card_played = player.play_card(players, current_trick, leading_suit if leading_suit else None, db_path=db_path)
             current_trick.append((player, card_played))
             if print_logs:
                 print(f"{player.name} plays {card_played}")
 
         # Determine the winner of the trick
-        winner = determine_winner(current_trick)
-        bonus_points = determine_bonus_points(current_trick)
+        winner = current_trick.winner
+        bonus_points = current_trick.bonus_points
         winner[0].tricks_taken += 1
         winner[0].bonus_points += bonus_points
         winner[0].is_trick_leader = True
@@ -548,11 +562,17 @@ def run_session(players, db_path='q_table.db'):
             play_round(players, round_number, db_path=db_path)
         determine_final_winner(players)
     except Exception as e:
+        import traceback
         print(f"Exception in session: {e}")
         traceback.print_exc()
         raise
 
 
 if __name__ == "__main__":
+    # Open the table before the first hand is dealt so the first AI move is not slowed down
+    get_q_store(db_path)
     players = [Player("Player", True), TrainedAIAgent("TAI1"), TrainedAIAgent("TAI2"), TrainedAIAgent("TAI3")]
-    run_session(players, db_path)
+    try:
+        run_session(players, db_path)
+    finally:
+        close_q_stores()
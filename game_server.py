@@ -0,0 +1,279 @@
+import asyncio, itertools, json, random, sys, time
+from collections import deque
+import evaluate_sql
+from evaluate_sql import Player, TrainedAIAgent, deal_cards, determine_turn_order, score_round
+from policy_service import PolicyService
+from q_store import get_q_store
+from trick import Trick
+
+# Game server for human players against the trained agent, with no dependencies outside the standard library.
+# Every table is a game held in memory between one human seat and three AI seats, which all play from the one Q-table
+# or compiled policy opened by the server. AI seats move as soon as it is their turn, within the request of the human
+# move before them. Tables that see no request for idle_timeout seconds are closed.
+# With --batched the AI seats of all tables read the store through one PolicyService (policy_service.py), which
+# answers the lookups of many tables with one query. A table then waits for its lookups between AI moves, and its
+# lock keeps a second request for it from interleaving with the one in progress.
+# JSON over HTTP/1.1 with keep-alive:
+#   POST   /tables                {"seat": 0-3}                         new table, the human seat is random by default
+#   GET    /tables/<id>                                                 state of the table for the human player
+#   POST   /tables/<id>/bid       {"bid": n}
+#   POST   /tables/<id>/play      {"card": index in hand, "as": "Pirate" or "Escape" for the Tigress}
+#   DELETE /tables/<id>
+#   GET    /stats                                                       tables, moves and AI move latency
+# Usage: python game_server.py [table.db|table.policy] [port] [--batched]
+
+host = '127.0.0.1'
+default_port = 8765
+idle_timeout = 600  # Seconds
+reap_interval = 30
+max_tables = 10000
+latency_samples = 10000  # AI move latencies kept for the percentiles of /stats
+
+num_players = 4
+num_rounds = 10
+
+
+class GameError(Exception):
+    # Invalid request for the state of a table, answered with 400
+    pass
+
+
+class Table:
+    def __init__(self, table_id, human_seat, db_path, stats, service=None):
+        self.table_id = table_id
+        self.db_path = db_path
+        self.stats = stats
+        self.service = service
+        self.lock = asyncio.Lock()
+        self.players = [Player("You", is_human=True) if seat == human_seat else
+                        TrainedAIAgent(f"AI{seat + 1}", db_path=db_path) for seat in range(num_players)]
+        self.human = self.players[human_seat]
+        self.round_number = 0
+        self.events = []  # What happened since the human's last request
+        self.last_active = time.monotonic()
+        self.start_round()
+
+    def start_round(self):
+        self.round_number += 1
+        deal_cards(self.players, self.round_number)
+        leader = (self.round_number % num_players - 1) % num_players
+        for seat, player in enumerate(self.players):
+            if player is not self.human:
+                player.bid = player.make_bid((seat - leader) % num_players)
+        self.phase = 'bidding'
+        self.order, self.trick = [], Trick()
+
+    async def bid(self, bid):
+        if self.phase != 'bidding':
+            raise GameError("Bids are only taken at the start of a round")
+        if not isinstance(bid, int) or not 0 <= bid <= self.round_number:
+            raise GameError(f"Bid a number between 0 and {self.round_number}")
+        self.human.bid = bid
+        self.events.append("Bids: " + ", ".join(f"{player.name} {player.bid}" for player in self.players))
+        self.order = determine_turn_order(self.players, self.round_number)
+        self.turn = 0
+        self.phase = 'playing'
+        await self.advance()
+
+    def legal_cards(self):
+        if self.phase != 'playing' or self.order[self.turn] is not self.human:
+            return []
+        leading_suit = self.trick.leading_suit
+        return [i for i, card in enumerate(self.human.hand) if self.human.determine_legality(card, leading_suit)]
+
+    async def play(self, index, played_as=None):
+        if index not in self.legal_cards():
+            raise GameError("Not your turn" if self.phase != 'playing' or self.order[self.turn] is not self.human
+                            else "Illegal card, follow the leading suit or play a special card")
+        card = self.human.hand[index]
+        if card.special == 'Tigress':
+            if played_as not in ('Pirate', 'Escape'):
+                raise GameError("Play the Tigress as a Pirate or an Escape")
+            card.played_as = played_as
+        self.human.hand.remove(card)
+        self.add_card(self.human, card)
+        await self.advance()
+
+    async def advance(self):
+        # AI seats play until it is the human's turn or the game is over
+        while self.phase == 'playing' and self.order[self.turn] is not self.human:
+            player = self.order[self.turn]
+            leading_suit = self.trick.leading_suit
+            start_time = time.perf_counter()
+            if self.service is None:
+                card = player.play_card(self.order, self.trick, leading_suit if leading_suit else None, self.db_path)
+            else:
+                decision = player.decision(self.trick, leading_suit if leading_suit else None)
+                card = player.play_decision(decision, await self.service.get_action_array(decision[0], decision[1]))
+            self.stats.record_ai_move(time.perf_counter() - start_time)
+            self.add_card(player, card)
+
+    def add_card(self, player, card):
+        self.trick.append((player, card))
+        self.events.append(f"{player.name} plays {card}")
+        self.turn += 1
+        if self.turn < len(self.order):
+            return
+        winner = self.trick.winner[0]
+        winner.tricks_taken += 1
+        winner.bonus_points += self.trick.bonus_points
+        for other in self.order:
+            other.is_trick_leader = other is winner
+        self.events.append(f"{winner.name} wins the trick")
+        self.order, self.trick, self.turn = determine_turn_order(self.order), Trick(), 0
+        if not self.human.hand:
+            score_round(self.players, self.round_number)
+            self.events.append("Scores: " + ", ".join(f"{p.name} {p.score}" for p in self.players))
+            if self.round_number == num_rounds:
+                self.phase = 'finished'
+            else:
+                self.start_round()
+
+    def state(self):
+        events, self.events = self.events, []
+        return {
+            "table": self.table_id,
+            "phase": self.phase,
+            "round": self.round_number,
+            "hand": [f"{card}" for card in self.human.hand],
+            "legal": self.legal_cards(),
+            "bids": {player.name: player.bid for player in self.players} if self.phase != 'bidding' else {},
+            "trick": [[player.name, f"{card}"] for player, card in self.trick],
+            "tricks_taken": {player.name: player.tricks_taken for player in self.players},
+            "scores": {player.name: player.score for player in self.players},
+            "events": events,
+        }
+
+
+class ServerStats:
+    def __init__(self):
+        self.ai_moves = 0
+        self.latencies = deque(maxlen=latency_samples)
+
+    def record_ai_move(self, seconds):
+        self.ai_moves += 1
+        self.latencies.append(seconds)
+
+    def summary(self, tables):
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return latencies[min(int(p * len(latencies)), len(latencies) - 1)] * 1000 if latencies else 0.0
+        return {"tables": tables, "ai_moves": self.ai_moves,
+                "ai_move_ms_p50": percentile(0.5), "ai_move_ms_p99": percentile(0.99)}
+
+
+class GameServer:
+    def __init__(self, db_path, batched=False):
+        self.db_path = db_path
+        self.tables = {}
+        self.table_ids = itertools.count(1)
+        self.stats = ServerStats()
+        store = get_q_store(db_path)  # Opened once, every AI seat reads the same store
+        self.service = PolicyService(store) if batched else None
+
+    async def route(self, method, path, body):
+        # (status, response) of a request
+        parts = path.strip('/').split('/')
+        if method == 'GET' and parts == ['stats']:
+            summary = self.stats.summary(len(self.tables))
+            if self.service is not None:
+                summary.update(self.service.summary())
+            return 200, summary
+        if parts[0] != 'tables':
+            return 404, {"error": "Not found"}
+        if len(parts) == 1 and method == 'POST':
+            if len(self.tables) >= max_tables:
+                return 503, {"error": "Too many tables"}
+            seat = body.get("seat", random.randrange(num_players))
+            if seat not in range(num_players):
+                return 400, {"error": "seat is 0 to 3"}
+            table = Table(next(self.table_ids), seat, self.db_path, self.stats, self.service)
+            self.tables[table.table_id] = table
+            return 201, table.state()
+        table = self.tables.get(int(parts[1])) if len(parts) > 1 and parts[1].isdigit() else None
+        if table is None:
+            return 404, {"error": "No such table"}
+        table.last_active = time.monotonic()
+        action = parts[2] if len(parts) > 2 else None
+        if method == 'GET' and action is None:
+            return 200, table.state()
+        if method == 'DELETE' and action is None:
+            del self.tables[table.table_id]
+            return 200, {"table": table.table_id, "phase": "closed"}
+        if method == 'POST' and action == 'bid':
+            async with table.lock:
+                await table.bid(body.get("bid"))
+                return 200, table.state()
+        if method == 'POST' and action == 'play':
+            async with table.lock:
+                await table.play(body.get("card"), body.get("as"))
+                return 200, table.state()
+        return 404, {"error": "Not found"}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                framed = False  # Whether the request was read to its end, the connection is closed after it if not
+                try:
+                    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                    while True:
+                        line = await reader.readline()
+                        if line in (b'\r\n', b'\n', b''):
+                            break
+                        name, _, value = line.decode('latin-1').partition(':')
+                        headers[name.strip().lower()] = value.strip()
+                    length = int(headers.get('content-length', 0))
+                    raw_body = await reader.readexactly(length) if length else b''
+                    framed = True
+                    body = json.loads(raw_body) if raw_body else {}
+                    status, response = await self.route(method, path, body if isinstance(body, dict) else {})
+                except GameError as e:
+                    status, response = 400, {"error": str(e)}
+                except (ValueError, TypeError) as e:
+                    status, response = 400, {"error": f"Bad request: {e}"}
+                payload = json.dumps(response).encode()
+                close = not framed or headers.get('connection', '').lower() == 'close'
+                writer.write(f"HTTP/1.1 {status} {'OK' if status < 400 else 'Error'}\r\n"
+                             f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+                             f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n".encode() + payload)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def reap_idle_tables(self):
+        while True:
+            await asyncio.sleep(reap_interval)
+            now = time.monotonic()
+            for table_id in [table_id for table_id, table in self.tables.items()
+                             if now - table.last_active > idle_timeout]:
+                del self.tables[table_id]
+
+    async def serve(self, port=default_port):
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        reaper = asyncio.create_task(self.reap_idle_tables())
+        print(f"Serving {self.db_path} on http://{host}:{port}" + (" with batched lookups" if self.service else ""))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            reaper.cancel()
+
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    db_path = args[0] if len(args) > 0 else 'q_table.db'
+    port = int(args[1]) if len(args) > 1 else default_port
+    evaluate_sql.print_logs = False
+    try:
+        asyncio.run(GameServer(db_path, '--batched' in sys.argv).serve(port))
+    except KeyboardInterrupt:
+        pass
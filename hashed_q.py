@@ -0,0 +1,128 @@
+import sys, time
+import numpy as np
+
+# Linear Q-function over hashed features, for training with richer state features than the table key can afford
+# (training.py --hashed). Q(state, action) is the sum of the weights of the state's features, each crossed with the
+# card the action plays. Features are hashed into a fixed array of 2 ** bits weights, so memory does not grow with
+# the states seen and an update touches only the few dozen weights of one (state, action).
+# A feature is a kind and a small value, packed as kind << 8 | value, then joined with the action card and hashed by
+# multiplying with a 64-bit odd constant and keeping the top bits (Fibonacci hashing).
+
+default_bits = 20  # 4 MB of float32 weights
+default_learning_rate = 0.5  # Step towards the target, shared by the features of an update, at 1 the batched updates diverge
+hash_multiplier = np.uint64(0x9E3779B97F4A7C15)
+action_bits = np.uint64(6)  # card_integers go up to 62
+
+# Feature kinds
+bias, hand_card, winning_card, leading_suit, tricks_needed, round_number, trick_position, opponents_needed, \
+    played_card, score_margin, needed_winning = range(11)
+suit_names = [None, "Yellow", "Purple", "Green", "Black"]
+
+
+def state_codes(hand, winning, suit, needed, round_number_, position, others_needed, played, margin):
+    # Feature codes of a state, from card_integers values: the whole hand, the winning card of the trick (0 when
+    # leading), the leading suit (0 to 4), tricks still needed for the bid, the round, cards already in the trick,
+    # tricks the other players still need, cards played in the earlier tricks of the round, and the score margin over
+    # the best other player
+    codes = [bias << 8, winning_card << 8 | winning, leading_suit << 8 | suit,
+             tricks_needed << 8 | min(max(needed, -3), 10) + 3, round_number << 8 | round_number_,
+             trick_position << 8 | position, opponents_needed << 8 | min(others_needed, 30),
+             score_margin << 8 | min(max(margin // 50, -10), 10) + 10,
+             needed_winning << 8 | (1 + (needed > 0) - (needed < 0)) << 6 | winning]
+    codes.extend(hand_card << 8 | card for card in hand)
+    codes.extend(played_card << 8 | card for card in played)
+    return np.array(codes, dtype=np.uint64)
+
+
+def agent_codes(agent, players, trick, leading_suit, round_number_, played, card_integers):
+    # Feature codes of the state an agent of training.py or evaluate_sql.py plays a card in, played holds the
+    # card_integers of the cards of the earlier tricks of the round
+    winning = card_integers[f"{trick.winner[1]}"] if trick else 0
+    others = [player for player in players if player is not agent]
+    return state_codes([card_integers[f"{card}"] for card in agent.hand], winning, suit_names.index(leading_suit),
+                       agent.bid - agent.tricks_taken, round_number_, len(trick),
+                       sum(max(player.bid - player.tricks_taken, 0) for player in others), played,
+                       agent.score - max(player.score for player in others))
+
+
+def agent_actions(hand, card_integers):
+    # Card of each action, the Tigress played as an Escape is the last one
+    actions = [card_integers[f"{card}"] for card in hand]
+    if card_integers["Tigress"] in actions:
+        actions.append(card_integers["Tigress as Escape"])
+    return actions
+
+
+class HashedQFunction:
+    def __init__(self, bits=default_bits, learning_rate=default_learning_rate):
+        self.weights = np.zeros(1 << bits, dtype=np.float32)
+        self.shift = np.uint64(64 - bits)
+        self.learning_rate = learning_rate
+        self.updates = 0
+
+    def indices(self, codes, actions):
+        # (actions, features) weight indices of each action card crossed with each feature of the state
+        keys = (codes[None, :] << action_bits | np.asarray(actions, dtype=np.uint64)[:, None]) * hash_multiplier
+        return (keys >> self.shift).astype(np.intp)
+
+    def values(self, indices):
+        return self.weights[indices].sum(axis=1)
+
+    def update(self, indices, target):
+        # Moves Q(state, action) of one row of indices towards the target
+        step = self.learning_rate * (target - float(self.weights[indices].sum())) / len(indices)
+        np.add.at(self.weights, indices, step)
+        self.updates += 1
+
+    def update_batch(self, rows, targets):
+        # Same as update() for a batch of rows of any lengths, all computed from the weights before the batch
+        if not rows:
+            return
+        flat = np.concatenate(rows)
+        lengths = np.array([len(row) for row in rows])
+        row_ids = np.repeat(np.arange(len(rows)), lengths)
+        values = np.bincount(row_ids, weights=self.weights[flat], minlength=len(rows))
+        steps = self.learning_rate * (np.asarray(targets) - values) / lengths
+        np.add.at(self.weights, flat, steps[row_ids].astype(np.float32))
+        self.updates += len(rows)
+
+    def save(self, path, games_completed=0):
+        with open(path, 'wb') as file:
+            np.savez(file, weights=self.weights, games_completed=games_completed, updates=self.updates)
+
+    def load(self, path):
+        # Returns the games completed by the run that saved the weights
+        with np.load(path) as data:
+            if len(data["weights"]) != len(self.weights):
+                raise ValueError(f"{path} holds {len(data['weights'])} weights, expected {len(self.weights)}")
+            self.weights[:] = data["weights"]
+            self.updates = int(data["updates"])
+            return int(data["games_completed"])
+
+
+if __name__ == "__main__":
+    # Usage: python hashed_q.py [updates]
+    # Times single and batched updates on random states, memory stays at the size of the weights
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rng = np.random.default_rng(0)
+    q_function = HashedQFunction()
+    rows = []
+    for _ in range(count):
+        hand = rng.choice(np.arange(1, 63), size=rng.integers(1, 11), replace=False).tolist()
+        codes = state_codes(hand, int(rng.integers(0, 63)), int(rng.integers(0, 5)), int(rng.integers(-2, 5)),
+                            int(rng.integers(1, 11)), int(rng.integers(0, 4)), int(rng.integers(0, 10)),
+                            rng.choice(np.arange(1, 63), size=rng.integers(0, 30), replace=False).tolist(),
+                            int(rng.integers(-500, 500)))
+        rows.append(q_function.indices(codes, [hand[0]])[0])
+    targets = rng.normal(0, 5, count)
+    start_time = time.perf_counter()
+    for row, target in zip(rows, targets):
+        q_function.update(row, target)
+    single_time = time.perf_counter() - start_time
+    start_time = time.perf_counter()
+    for start in range(0, count, 1000):
+        q_function.update_batch(rows[start:start + 1000], targets[start:start + 1000])
+    batch_time = time.perf_counter() - start_time
+    print(f"{count} updates of {np.mean([len(row) for row in rows]):.0f} features: "
+          f"{count / single_time:.0f}/s one at a time, {count / batch_time:.0f}/s in batches of 1000, "
+          f"{q_function.weights.nbytes} bytes of weights")
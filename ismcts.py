@@ -0,0 +1,299 @@
+import json, sys, time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from fast_engine import njit, deck_size, num_players, card_kinds, card_suits, card_ranks, TIGRESS, PIRATE, ESCAPE, \
+    leading_suit, trick_winner, trick_bonus, is_legal, round_score, default_choice, trick_arrays
+from card_tracker import sample_hands
+from evaluate_sql import TrainedAIAgent
+from q_store import get_q_store
+
+# Agent playing its cards by information set Monte Carlo tree search over the rest of the round.
+# Every iteration deals the cards it has not seen to the opponents at random, consistently with the suits they have
+# shown to be void in (a determinization, see card_tracker.py), plays the round out
+# with fast_engine.py and scores it for the agent. The tree holds the agent's own moves: children are only considered
+# when they are legal in the iteration's determinization, and are ranked by UCB1 over the number of times they were
+# available rather than the number of visits of their parent. Opponents play the default AIAgent policy, which is what
+# they are in evaluate_sql.py, and so does the agent once it leaves the tree.
+# Nodes come from a preallocated pool that is reused for every move, its size is the node budget of a move.
+
+# Actions are the card ids of fast_engine.py, the Tigress id plays it as a Pirate and tigress_escape as an Escape
+tigress_card = 66
+tigress_escape = deck_size
+action_count = deck_size + 1
+
+default_time_budget = 0.01  # Seconds per move
+default_node_budget = 20000
+default_iterations = 100000  # Upper bound on the iterations of a move, the time budget usually stops it first
+batch_iterations = 64  # Iterations run between two checks of the time budget
+exploration = 0.7
+prior_weight = 1.0  # Bonus of the Q-table's best actions at the root, fading with their visits
+
+
+class NodePool:
+    # Tree nodes as arrays, node 0 is the root
+    def __init__(self, capacity):
+        self.action = np.zeros(capacity, dtype=np.int64)
+        self.first_child = np.zeros(capacity, dtype=np.int64)
+        self.next_sibling = np.zeros(capacity, dtype=np.int64)
+        self.visits = np.zeros(capacity, dtype=np.int64)
+        self.available = np.zeros(capacity, dtype=np.int64)
+        self.value = np.zeros(capacity)
+        self.count = np.zeros(1, dtype=np.int64)
+
+    def reset(self):
+        self.first_child[0] = -1
+        self.count[0] = 1
+
+    def arrays(self):
+        return self.action, self.first_child, self.next_sibling, self.visits, self.available, self.value, self.count
+
+    def root_visits(self):
+        # Visits of each action at the root
+        visits = np.zeros(action_count, dtype=np.int64)
+        child = self.first_child[0]
+        while child >= 0:
+            visits[self.action[child]] = self.visits[child]
+            child = self.next_sibling[child]
+        return visits
+
+
+@njit(cache=True)
+def legal_actions(hand, hand_size, lead_suit, actions):
+    # Fills actions with the legal actions of a hand and returns their number
+    count = 0
+    for i in range(hand_size):
+        if is_legal(hand, hand_size, i, lead_suit):
+            actions[count] = hand[i]
+            count += 1
+            if card_kinds[hand[i]] == TIGRESS:
+                actions[count] = tigress_escape
+                count += 1
+    return count
+
+
+@njit(cache=True)
+def select_action(node, actions, count, prior, action, first_child, next_sibling, visits, available, value, node_count):
+    # Action to play from a tree node and the node it leads to, -1 once the iteration has left the tree.
+    # Expands an untried legal action while there is room in the pool, otherwise picks the best legal child by UCB1.
+    tried = np.zeros(count, dtype=np.bool_)
+    best_child, best_score = -1, -np.inf
+    child = first_child[node]
+    while child >= 0:
+        for i in range(count):
+            if actions[i] == action[child]:
+                tried[i] = True
+                available[child] += 1
+                score = value[child] / visits[child] + exploration * np.sqrt(np.log(available[child]) / visits[child])
+                if node == 0:
+                    score += prior_weight * prior[action[child]] / (1 + visits[child])
+                if score > best_score:
+                    best_child, best_score = child, score
+        child = next_sibling[child]
+
+    untried = 0
+    for i in range(count):
+        if not tried[i]:
+            untried += 1
+    if untried > 0 and node_count[0] < len(action):
+        pick = np.random.randint(untried)
+        for i in range(count):
+            if not tried[i]:
+                if pick == 0:
+                    new = node_count[0]
+                    node_count[0] += 1
+                    action[new], first_child[new], next_sibling[new] = actions[i], -1, first_child[node]
+                    visits[new], available[new], value[new] = 0, 1, 0.0
+                    first_child[node] = new
+                    return actions[i], new
+                pick -= 1
+    if best_child >= 0 and untried == 0:
+        return action[best_child], best_child
+    return actions[np.random.randint(count)], -1
+
+
+@njit(cache=True, nogil=True)
+def search(hand, sizes, kinds0, suits0, ranks0, seats0, position, bid, tricks_taken, bonus_points, round_number,
+           prior, deals, action, first_child, next_sibling, visits, available, value, node_count):
+    # Runs one iteration per row of deals from the agent's turn at position in the current trick. Seats are numbered
+    # in the order of the current trick, sizes holds the number of cards in each seat's hand and a row of deals the
+    # cards of the other seats one after the other.
+    hands = np.zeros((num_players, len(hand) + 1), dtype=np.int64)
+    hand_sizes = np.zeros(num_players, dtype=np.int64)
+    kinds = np.zeros(num_players, dtype=np.int64)
+    suits = np.zeros(num_players, dtype=np.int64)
+    ranks = np.zeros(num_players, dtype=np.int64)
+    seats = np.zeros(num_players, dtype=np.int64)
+    actions = np.zeros(len(hand) + 1, dtype=np.int64)
+    path = np.zeros(len(hand), dtype=np.int64)
+    scale = 10.0 * round_number
+    for iteration in range(len(deals)):
+        dealt = 0
+        for seat in range(num_players):
+            if seat == position:
+                hands[seat, :len(hand)] = hand
+            else:
+                hands[seat, :sizes[seat]] = deals[iteration, dealt:dealt + sizes[seat]]
+                dealt += sizes[seat]
+            hand_sizes[seat] = sizes[seat]
+        kinds[:position], suits[:position] = kinds0[:position], suits0[:position]
+        ranks[:position], seats[:position] = ranks0[:position], seats0[:position]
+
+        node, depth, tricks, bonus, leader, start = 0, 0, tricks_taken, bonus_points, 0, position
+        while hand_sizes[position] > 0:
+            for trick_position in range(start, num_players):
+                seat = (leader + trick_position) % num_players
+                lead_suit = leading_suit(kinds, suits, trick_position)
+                if seat == position and node >= 0:
+                    count = legal_actions(hands[seat], hand_sizes[seat], lead_suit, actions)
+                    chosen, node = select_action(node, actions, count, prior, action, first_child, next_sibling,
+                                                 visits, available, value, node_count)
+                    if node >= 0:
+                        path[depth] = node
+                        depth += 1
+                    card = tigress_card if chosen == tigress_escape else chosen
+                    index = 0
+                    for i in range(hand_sizes[seat]):
+                        if hands[seat, i] == card:
+                            index = i
+                    kind = ESCAPE if chosen == tigress_escape else card_kinds[card]
+                    if kind == TIGRESS:
+                        kind = PIRATE
+                else:
+                    index = default_choice(hands[seat], hand_sizes[seat], lead_suit)
+                    kind = card_kinds[hands[seat, index]]
+                    if kind == TIGRESS:
+                        kind = PIRATE if np.random.randint(2) == 0 else ESCAPE
+                card = hands[seat, index]
+                hand_sizes[seat] -= 1
+                hands[seat, index] = hands[seat, hand_sizes[seat]]
+                kinds[trick_position], suits[trick_position] = kind, card_suits[card]
+                ranks[trick_position], seats[trick_position] = card_ranks[card], seat
+            winner = seats[trick_winner(kinds, suits, ranks, num_players)]
+            if winner == position:
+                tricks += 1
+                bonus += trick_bonus(kinds, suits, ranks, num_players)
+            leader, start = winner, 0
+
+        reward = round_score(bid, tricks, bonus, round_number) / scale
+        for i in range(depth):
+            visits[path[i]] += 1
+            value[path[i]] += reward
+
+
+def default_action(hand, kinds, suits, position):
+    # Card the default AIAgent policy plays from hand, a Tigress is played as a Pirate
+    return int(hand[default_choice(hand, len(hand), leading_suit(kinds, suits, position))])
+
+
+class SearchAIAgent(TrainedAIAgent):
+    # Usage: SearchAIAgent("ISMCTS", time_budget=0.01, node_budget=20000, workers=1, q_prior=False)
+    # workers > 1 runs that many independent searches in threads (root parallelization) and adds up their visits,
+    # q_prior favours the best actions of the Q-table at the root
+    def __init__(self, name, time_budget=default_time_budget, node_budget=default_node_budget,
+                 iterations=default_iterations, workers=1, q_prior=False, rollout_bids=False, db_path=None):
+        super().__init__(name, rollout_bids, db_path)
+        self.time_budget = time_budget
+        self.node_budget = node_budget
+        self.iterations = iterations
+        self.workers = workers
+        self.q_prior = q_prior
+        self.tracks_cards = True  # play_tricks gives the agent a CardTracker every round
+        self.pools = None
+
+    def __getstate__(self):
+        # Pools are allocated in the process that plays
+        state = self.__dict__.copy()
+        state["pools"] = None
+        return state
+
+    def root_prior(self, trick, hand, ids, db_path):
+        # 1 for the actions the Q-table rates best in this state, 0 for the others and for unseen states
+        prior = np.zeros(action_count)
+        if not self.q_prior:
+            return prior
+        state, action_order = self.get_state(trick)
+        legal_hand = self.get_legal_hand(trick.leading_suit)
+        size = len(legal_hand) + any(card.special == "Tigress" for card in legal_hand)
+        values = get_q_store(self.db_path or db_path).get_action_array(json.dumps(state, sort_keys=True), size)
+        if values is None:
+            return prior
+        best = max(values)
+        for action, action_value in enumerate(values):
+            if action_value == best:
+                if action == len(legal_hand):
+                    prior[tigress_escape] = 1
+                else:
+                    prior[ids[hand.index(legal_hand[action_order[action]])]] = 1
+        return prior
+
+    def run_search(self, pool, arguments, unseen, opponent_sizes, voids):
+        pool.reset()
+        deadline = time.perf_counter() + self.time_budget
+        done = 0
+        # The first batch runs whatever the time budget, so the root has visits to choose from
+        while done < self.iterations and (done == 0 or time.perf_counter() < deadline):
+            deals = sample_hands(unseen, opponent_sizes, voids, min(batch_iterations, self.iterations - done))
+            search(*arguments, deals, *pool.arrays())
+            done += len(deals)
+        return pool.root_visits()
+
+    def play_card(self, players, trick, leading_suit=None, db_path='q_table.db'):
+        position = len(trick)
+        if self.pools is None:
+            self.pools = [NodePool(self.node_budget) for _ in range(self.workers)]
+        ids, unseen = self.card_tracker.unseen_cards(self.hand)
+        opponents = [player for player in players if player is not self]
+        opponent_sizes = [len(player.hand) for player in opponents]
+        voids = self.card_tracker.player_voids(opponents)
+        sizes = np.array([len(player.hand) for player in players], dtype=np.int64)
+        kinds, suits, ranks = (np.zeros(num_players, dtype=np.int64) for _ in range(3))
+        if trick:
+            kinds[:position], suits[:position], ranks[:position] = trick_arrays(trick)
+        arguments = (ids, sizes, kinds, suits, ranks, np.arange(num_players), position, self.bid, self.tricks_taken,
+                     self.bonus_points, self.card_tracker.round_number, self.root_prior(trick, self.hand, ids, db_path))
+        if self.workers > 1:
+            with ThreadPoolExecutor(self.workers) as executor:
+                visits = sum(executor.map(lambda pool: self.run_search(pool, arguments, unseen, opponent_sizes, voids),
+                                          self.pools))
+        else:
+            visits = self.run_search(self.pools[0], arguments, unseen, opponent_sizes, voids)
+
+        if visits.max() > 0:
+            action = int(np.argmax(visits))
+        else:
+            # No iteration reached the root's children (no iterations allowed), play as the default AIAgent
+            action = default_action(ids, kinds, suits, position)
+        if action == tigress_escape:
+            card = next(card for card in self.hand if card.special == "Tigress")
+            card.played_as = "Escape"
+        else:
+            card = self.hand[list(ids).index(action)]
+            if card.special == "Tigress":
+                card.played_as = "Pirate"
+        self.hand.remove(card)
+        return card
+
+
+if __name__ == "__main__":
+    # Usage: python ismcts.py [games] [milliseconds per move] [workers] [table.db|table.policy]
+    # Plays the search agent against three default AIAgents, rotating it through the seats
+    import random
+    import evaluate_sql
+    games = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    time_budget = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else default_time_budget
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 1
+    db_path = sys.argv[4] if len(sys.argv) > 4 else None
+    totals = np.zeros(2)
+    for seat in range(num_players):
+        for agent in (SearchAIAgent("ISMCTS", time_budget, workers=workers, q_prior=db_path is not None),
+                      evaluate_sql.AIAgent("AI")):
+            players = [evaluate_sql.AIAgent(f"AI{i + 1}") for i in range(num_players - 1)]
+            players.insert(seat, agent)
+            random.seed(seat)
+            start_time = time.perf_counter()
+            stats = evaluate_sql.run_session(players, seat, games // num_players, db_path or 'q_table.db')
+            average = stats["rounds_scores"][seat, 10] / (games // num_players)
+            totals[int(isinstance(agent, SearchAIAgent))] += average / num_players
+            print(f"{agent.name} in seat {seat + 1}: average score {average:.1f}, "
+                  f"{stats['games_won'][seat]} wins, {time.perf_counter() - start_time:.1f} seconds")
+    print(f"Average score: ISMCTS {totals[1]:.1f}, default AIAgent {totals[0]:.1f}")
@@ -1,5 +1,6 @@
 import sqlite3
-import json
+import json, os
+from q_store import visits_path
 
 
 def create_database(db_path='q_table.db'):
@@ -13,6 +14,7 @@ def create_database(db_path='q_table.db'):
         state TEXT,
         action TEXT,
         value REAL,
+        visits INTEGER NOT NULL DEFAULT 0,
         PRIMARY KEY (state, action)
     )
     ''')
@@ -23,12 +25,18 @@ def create_database(db_path='q_table.db'):
 def import_json_to_db(json_path, db_path='q_table.db'):
     conn = sqlite3.connect(db_path)
     cur = conn.cursor()
+    # Visit counts are imported too when the table has a visits file next to it
+    visits = {}
+    if os.path.exists(visits_path(json_path)):
+        with open(visits_path(json_path), 'r') as file:
+            visits = json.load(file)
     with open(json_path, 'r') as file:
         data = json.load(file)
         for state, actions in data.items():
+            state_visits = visits.get(state, {})
             for action, value in actions.items():
-                cur.execute('INSERT OR IGNORE INTO QTable (state, action, value) VALUES (?, ?, ?)',
-                            (state, action, value))
+                cur.execute('INSERT OR IGNORE INTO QTable (state, action, value, visits) VALUES (?, ?, ?, ?)',
+                            (state, action, value, state_visits.get(action, 0)))
     conn.commit()
     conn.close()
 
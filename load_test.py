@@ -0,0 +1,87 @@
+import asyncio, json, random, sys, time
+
+# Load test for game_server.py: clients play whole games at once over keep-alive connections, bidding and playing
+# random legal cards, and the moves per second and request latencies are reported along with the server's AI move
+# latency.
+# Usage: python load_test.py [clients] [games per client] [host:port]
+
+
+class Client:
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+        self.reader = self.writer = None
+
+    async def request(self, method, path, body=None):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        payload = json.dumps(body).encode() if body is not None else b''
+        self.writer.write(f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\nContent-Type: application/json\r\n"
+                          f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload)
+        await self.writer.drain()
+        status = int((await self.reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            if name.lower() == 'content-length':
+                length = int(value)
+        response = json.loads(await self.reader.readexactly(length))
+        if status >= 400:
+            raise RuntimeError(f"{method} {path} failed with {status}: {response}")
+        return response
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def play_games(client, games, latencies):
+    moves = 0
+    for _ in range(games):
+        start_time = time.perf_counter()
+        state = await client.request('POST', '/tables', {})
+        latencies.append(time.perf_counter() - start_time)
+        table = state["table"]
+        while state["phase"] != 'finished':
+            start_time = time.perf_counter()
+            if state["phase"] == 'bidding':
+                state = await client.request('POST', f'/tables/{table}/bid', {"bid": random.randint(0, state["round"])})
+            else:
+                index = random.choice(state["legal"])
+                move = {"card": index}
+                if state["hand"][index] == "Tigress":
+                    move["as"] = random.choice(["Pirate", "Escape"])
+                state = await client.request('POST', f'/tables/{table}/play', move)
+                moves += 1
+            latencies.append(time.perf_counter() - start_time)
+        await client.request('DELETE', f'/tables/{table}')
+    return moves
+
+
+async def run_load_test(clients, games, host, port):
+    connections = [Client(host, port) for _ in range(clients)]
+    latencies = []
+    before = await connections[0].request('GET', '/stats')
+    start_time = time.perf_counter()
+    moves = sum(await asyncio.gather(*(play_games(client, games, latencies) for client in connections)))
+    elapsed_time = time.perf_counter() - start_time
+    after = await connections[0].request('GET', '/stats')
+    for client in connections:
+        client.close()
+
+    latencies.sort()
+    ai_moves = after["ai_moves"] - before["ai_moves"]
+    print(f"{clients} clients played {clients * games} games in {elapsed_time:.1f} seconds")
+    print(f"Moves: {moves} human and {ai_moves} AI, {(moves + ai_moves) / elapsed_time:.0f} moves/s")
+    print(f"Request latency: p50 {latencies[len(latencies) // 2] * 1000:.2f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.2f} ms")
+    print(f"AI move latency: p50 {after['ai_move_ms_p50']:.3f} ms, p99 {after['ai_move_ms_p99']:.3f} ms")
+
+
+if __name__ == "__main__":
+    clients = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    games = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    host, port = (sys.argv[3].split(':') if len(sys.argv) > 3 else ('127.0.0.1', '8765'))
+    asyncio.run(run_load_test(clients, games, host, int(port)))
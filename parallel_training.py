@@ -0,0 +1,184 @@
+import json, os, sys, time, zlib, queue
+import multiprocessing
+import traceback
+import training
+from q_store import visits_path
+
+# Trains a single Q-table with several worker processes instead of merging independently trained tables.
+# Each state belongs to one shard owner process, chosen by a stable hash of the state key. Workers play games
+# against a local replica of the table and send their Q-learning targets (reward + GAMMA * max future Q) to the
+# owners, which apply the update to the authoritative value and broadcast the result back to every replica.
+# Usage: python parallel_training.py [games] [table file] [workers] [shards]
+
+# Table every run starts from, as in training.py
+initial_table_path = 'decision.json'
+
+
+def shard_of(state, shards):
+    # Stable across processes, unlike hash()
+    return zlib.crc32(state.encode()) % shards
+
+
+class ShardedAIAgent(training.AIAgent):
+    def __init__(self, name, pending_updates):
+        super().__init__(name)
+        self.pending_updates = pending_updates
+
+    def update_q_value(self, reward):
+        # Update the local replica immediately, and queue the target for the state's owner
+        super().update_q_value(reward)
+        target = reward + training.GAMMA * self.max_future_q
+        num_actions = len(training.q_table[self.old_state])
+        self.pending_updates.append((self.old_state, f"{self.old_state_action}", target, num_actions))
+
+
+def load_initial_table():
+    if os.path.exists(initial_table_path):
+        with open(initial_table_path, 'r') as file:
+            return json.load(file)
+    return {}
+
+
+def load_initial_visits():
+    if os.path.exists(visits_path(initial_table_path)):
+        with open(visits_path(initial_table_path), 'r') as file:
+            return json.load(file)
+    return {}
+
+
+def run_shard_owner(shard_id, shards, update_queue, worker_queues, result_queue):
+    try:
+        shard_table = {state: actions for state, actions in load_initial_table().items()
+                       if shard_of(state, shards) == shard_id}
+        shard_visits = {state: actions for state, actions in load_initial_visits().items()
+                        if shard_of(state, shards) == shard_id}
+        # Workers still playing, a finished worker sends its id instead of a list of updates and gets no more
+        # broadcasts. Its replica is no longer read, so do not wait for what was sent before when exiting either.
+        active_workers = list(range(len(worker_queues)))
+        for worker_queue in worker_queues:
+            worker_queue.cancel_join_thread()
+
+        while True:
+            updates = update_queue.get()
+            if updates is None:
+                break
+            if isinstance(updates, int):
+                active_workers.remove(updates)
+                continue
+            applied = []
+            for state, action, target, num_actions in updates:
+                actions = shard_table.get(state)
+                if actions is None:
+                    actions = shard_table[state] = {f"{i}": 0 for i in range(num_actions)}
+                # Q-learning formula, applied to the authoritative value
+                new_q = (1 - training.ALPHA) * actions.get(action, 0) + training.ALPHA * target
+                actions[action] = new_q
+                state_visits = shard_visits.setdefault(state, {})
+                state_visits[action] = state_visits.get(action, 0) + 1
+                applied.append((state, action, new_q, len(actions)))
+            for worker_id in active_workers:
+                worker_queues[worker_id].put(applied)
+
+        result_queue.put((shard_table, shard_visits))
+    except Exception as e:
+        print(f"Exception in shard owner {shard_id}: {e}")
+        traceback.print_exc()
+        raise
+
+
+def apply_owner_updates(inbox):
+    # Overwrite the local replica with the authoritative values broadcast by the owners
+    while True:
+        try:
+            applied = inbox.get_nowait()
+        except queue.Empty:
+            break
+        for state, action, value, num_actions in applied:
+            actions = training.q_table.get(state)
+            if actions is None:
+                actions = training.q_table[state] = {f"{i}": 0 for i in range(num_actions)}
+            actions[action] = value
+
+
+def run_worker(worker_id, worker_games, shard_queues, inbox):
+    try:
+        training.q_table = load_initial_table()
+        shards = len(shard_queues)
+        pending_updates = []
+        players = [ShardedAIAgent(f"AI{i + 1}", pending_updates) for i in range(4)]
+        for i in range(worker_games):
+            start_time = time.perf_counter()
+            apply_owner_updates(inbox)
+            for round_number in range(1, 11):
+                training.play_round(players, round_number)
+
+            # Send this game's targets to the owners, one message per shard
+            shard_updates = [[] for _ in range(shards)]
+            for update in pending_updates:
+                shard_updates[shard_of(update[0], shards)].append(update)
+            for shard_queue, updates in zip(shard_queues, shard_updates):
+                if updates:
+                    shard_queue.put(updates)
+            pending_updates.clear()
+            # Checkpoints are not taken by the workers and visits are counted by the owners
+            training.changed_entries.clear()
+            training.visit_counts.clear()
+
+            elapsed_time = time.perf_counter() - start_time
+            print(f"Worker {worker_id} game {i + 1} took {elapsed_time} seconds")
+        for shard_queue in shard_queues:
+            shard_queue.put(worker_id)
+    except Exception as e:
+        print(f"Exception in worker {worker_id}: {e}")
+        traceback.print_exc()
+        raise
+
+
+def train(games, workers, shards):
+    shard_queues = [multiprocessing.Queue() for _ in range(shards)]
+    worker_queues = [multiprocessing.Queue() for _ in range(workers)]
+    result_queue = multiprocessing.Queue()
+
+    owners = [multiprocessing.Process(target=run_shard_owner,
+                                      args=(shard_id, shards, shard_queues[shard_id], worker_queues, result_queue))
+              for shard_id in range(shards)]
+    # Spread the games as evenly as possible over the workers
+    worker_processes = [multiprocessing.Process(target=run_worker,
+                                                args=(worker_id, games // workers + (worker_id < games % workers),
+                                                      shard_queues, worker_queues[worker_id]))
+                        for worker_id in range(workers)]
+    for process in owners + worker_processes:
+        process.start()
+
+    for process in worker_processes:
+        process.join()
+    for shard_queue in shard_queues:
+        shard_queue.put(None)
+
+    # Shards hold disjoint sets of states, so the final table is their union
+    q_table, visit_counts = {}, {}
+    for _ in range(shards):
+        shard_table, shard_visits = result_queue.get()
+        q_table.update(shard_table)
+        visit_counts.update(shard_visits)
+    for process in owners:
+        process.join()
+    return q_table, visit_counts
+
+
+if __name__ == "__main__":
+    multiprocessing.set_start_method('spawn')
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    games = int(args[0]) if len(args) > 0 else 20000
+    table_file = args[1] if len(args) > 1 else "decision"
+    num_workers = int(args[2]) if len(args) > 2 else os.cpu_count()
+    num_shards = int(args[3]) if len(args) > 3 else max(1, num_workers // 2)
+    start_time = time.perf_counter()
+    q_table, visit_counts = train(games, num_workers, num_shards)
+    with open(f'{table_file}.json', 'w') as file:
+        json.dump(q_table, file)
+    with open(visits_path(table_file), 'w') as file:
+        json.dump(visit_counts, file)
+    elapsed_time = time.perf_counter() - start_time
+    print(f"Trained {games} games on {num_workers} workers and {num_shards} shards in {elapsed_time} seconds, "
+          f"{len(q_table)} states saved to {table_file}.json")
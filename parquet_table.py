@@ -0,0 +1,108 @@
+import os, sys, time
+from itertools import islice
+from q_store import open_q_store
+
+# Converts Q-tables to and from Parquet, with one (state, action, value, visits) row per entry.
+# States are dictionary encoded, so each state string is stored once per row group instead of once per action.
+# Usage: python parquet_table.py <table.json|table.db> <table.parquet>   (export)
+#        python parquet_table.py <table.parquet> <table.json|table.db>   (import)
+
+batch_size = 1000000
+
+
+def load_arrow():
+    # Deferred so the optional pyarrow dependency is only needed for Parquet conversions
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    return pa, pq
+
+
+def q_table_schema(pa):
+    return pa.schema([
+        ("state", pa.dictionary(pa.int32(), pa.string())),
+        ("action", pa.int8()),
+        ("value", pa.float64()),
+        ("visits", pa.int64()),
+    ])
+
+
+def build_record_batch(pa, schema, rows):
+    state_index = {}
+    indices, actions, values, visits = [], [], [], []
+    for state, action, value, count in rows:
+        index = state_index.get(state)
+        if index is None:
+            index = state_index[state] = len(state_index)
+        indices.append(index)
+        actions.append(action)
+        values.append(value)
+        visits.append(count)
+
+    states = pa.DictionaryArray.from_arrays(pa.array(indices, pa.int32()), pa.array(list(state_index), pa.string()))
+    return pa.RecordBatch.from_arrays([states, pa.array(actions, pa.int8()), pa.array(values, pa.float64()),
+                                       pa.array(visits, pa.int64())], schema=schema)
+
+
+def export_parquet(store, parquet_path, compression='zstd'):
+    pa, pq = load_arrow()
+    schema = q_table_schema(pa)
+    rows = store.items()
+    entries = 0
+    with pq.ParquetWriter(parquet_path, schema, compression=compression) as writer:
+        while True:
+            chunk = list(islice(rows, batch_size))
+            if not chunk:
+                break
+            writer.write_batch(build_record_batch(pa, schema, chunk))
+            entries += len(chunk)
+    return entries
+
+
+def read_parquet_rows(parquet_path):
+    # Yields (state, action, value, visits) rows, decoding each distinct state string once per batch
+    pa, pq = load_arrow()
+    parquet_file = pq.ParquetFile(parquet_path, read_dictionary=["state"])
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+        states = batch.column("state")
+        if pa.types.is_dictionary(states.type):
+            dictionary = states.dictionary.to_pylist()
+            states = [dictionary[index] for index in states.indices.to_pylist()]
+        else:
+            states = states.to_pylist()
+        actions = batch.column("action").to_pylist()
+        values = batch.column("value").to_pylist()
+        if "visits" in batch.schema.names:
+            visits = batch.column("visits").to_pylist()
+        else:
+            visits = [0] * len(states)
+        yield from zip(states, actions, values, visits)
+
+
+def import_parquet(parquet_path, store):
+    entries = 0
+    rows = read_parquet_rows(parquet_path)
+    while True:
+        chunk = list(islice(rows, batch_size))
+        if not chunk:
+            break
+        store.set_many(chunk)
+        entries += len(chunk)
+    store.save()
+    return entries
+
+
+if __name__ == "__main__":
+    source, destination = sys.argv[1], sys.argv[2]
+    start_time = time.perf_counter()
+    if destination.endswith('.parquet'):
+        store = open_q_store(source)
+        entries = export_parquet(store, destination)
+    elif source.endswith('.parquet'):
+        store = open_q_store(destination, read_only=False)
+        entries = import_parquet(source, store)
+    else:
+        raise ValueError("One of the two tables must be a .parquet file")
+    store.close()
+    elapsed_time = time.perf_counter() - start_time
+    print(f"Converted {entries} entries from {source} ({os.path.getsize(source)} bytes) to {destination} "
+          f"({os.path.getsize(destination)} bytes) in {elapsed_time} seconds.")
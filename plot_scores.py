@@ -1,12 +1,66 @@
-import pandas as pd
-import matplotlib.pyplot as plt
+import json, os, sys
 
-def plot_scores():
-    # Assuming the JSON data is stored in 'data.json'
-    df = pd.read_json('scores.json')
+# Reporting stage. Simulations write a results file and this script renders it to PNGs and an HTML index,
+# so pandas and matplotlib are only imported here and never block on a window.
+# Usage: python plot_scores.py <results file (.json/.csv/.parquet)> [output directory]
 
-    # Calculate the mean for each player (column)
-    average_scores = df.mean()
+default_output_dir = 'reports'
+
+
+def load_plotting():
+    # Deferred so that importing this module (and any pool worker that does) stays cheap
+    import matplotlib
+    matplotlib.use('Agg')  # Non-interactive backend, renders straight to files
+    import matplotlib.pyplot as plt
+    import pandas as pd
+    return pd, plt
+
+
+def save_figure(plt, name, output_dir=default_output_dir):
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, f"{name}.png")
+    plt.savefig(path, format='png', dpi=150)
+    plt.close('all')
+    print(f"Saved {path}")
+    return path
+
+
+def write_html_index(image_paths, title, output_dir=default_output_dir, name='index'):
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, f"{name}.html")
+    images = "\n".join(f'<img src="{os.path.basename(image)}" style="max-width: 100%;">' for image in image_paths)
+    with open(path, 'w') as file:
+        file.write(f"<html><head><title>{title}</title></head><body><h1>{title}</h1>\n{images}\n</body></html>\n")
+    print(f"Saved {path}")
+    return path
+
+
+def load_results(file_path):
+    # JSON results are nested dictionaries, CSV and Parquet results are one row per game
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension == '.json':
+        with open(file_path, 'r') as file:
+            return json.load(file)
+    pd, plt = load_plotting()
+    if extension == '.csv':
+        return pd.read_csv(file_path)
+    if extension == '.parquet':
+        return pd.read_parquet(file_path)
+    raise ValueError(f"Unsupported results file: {file_path}")
+
+
+def plot_scores(average_scores=None, output_dir=default_output_dir, name='scores'):
+    pd, plt = load_plotting()
+    if average_scores is None:
+        # Assuming the JSON data is stored in 'scores.json'
+        df = pd.read_json('scores.json')
+
+        # Calculate the mean for each player (column)
+        average_scores = df.mean()
+    else:
+        # Convert dictionary to DataFrame
+        scores_df = pd.DataFrame(list(average_scores.items()), columns=['Player', 'Score']).set_index('Player')
+        average_scores = scores_df['Score']
 
     # Calculate the percentage improvements
     percent_improvements = {}
@@ -36,7 +90,159 @@ def plot_scores():
         ax.text(bar.get_x() + bar.get_width() / 2, height - 15, f'{improvement:.2f}%',
                 ha='center', va='top', color='red', fontsize=9)
 
-    plt.show()
+    return save_figure(plt, name, output_dir)
+
+
+def plot_rounds(rounds_results, total_games, output_dir=default_output_dir, name='rounds'):
+    pd, plt = load_plotting()
+    # Convert to DataFrame
+    df = pd.DataFrame(rounds_results)
+
+    # Title with total games
+    title = f"Number of Bids Met by Round (Total Games Played: {total_games})"
+
+    # Plotting
+    fig, ax = plt.subplots(figsize=(12, 8))
+
+    # Bar width
+    bar_width = 0.2
+
+    # Rounds (x-axis positions)
+    rounds = df.index + 1
+
+    # For each player, plot a bar for each round
+    for i, player in enumerate(df.columns):
+        ax.bar(rounds + i * bar_width, df[player], width=bar_width, label=player)
+
+    # Setting the x-axis ticks to be at the center of the groups of bars
+    ax.set_xticks(rounds + bar_width * (len(df.columns) - 1) / 2)
+    ax.set_xticklabels(rounds)
+
+    ax.set_xlabel('Round Number')
+    ax.set_ylabel('Number of Bids Met')
+    ax.set_title(title)
+    ax.legend(title='Player')
+
+    return save_figure(plt, name, output_dir)
+
+
+def plot_rounds_points(rounds_points, total_games, output_dir=default_output_dir, name='rounds_points'):
+    pd, plt = load_plotting()
+    # Convert to DataFrame
+    df = pd.DataFrame(rounds_points)
+
+    # Divide each value by the total games for the corresponding player
+    normalized_df = df.div(total_games)  # Scales by total games
+
+    # Title with total games
+    title = f"Number of Points Earned by Round (Total Games Played: {total_games})"
+
+    # Plotting
+    fig, ax = plt.subplots(figsize=(12, 8))
+
+    # Bar width
+    bar_width = 0.2
+
+    # Rounds (x-axis positions)
+    rounds = normalized_df.index + 1
+
+    # For each player, plot a bar for each round
+    for i, player in enumerate(normalized_df.columns):
+        ax.bar(rounds + i * bar_width, normalized_df[player], width=bar_width, label=player)
+
+    # Setting the x-axis ticks to be at the center of the groups of bars
+    ax.set_xticks(rounds + bar_width * (len(normalized_df.columns) - 1) / 2)
+
+    # Modify x-axis tick labels
+    tick_labels = list(map(str, rounds))
+    tick_labels[-1] = "Total"  # Change the last tick label to "Total"
+    ax.set_xticklabels(tick_labels)
+
+    ax.set_xlabel('Round Number')
+    ax.set_ylabel('Number of Points Earned')
+    ax.set_title(title)
+    ax.legend(title='Player')
+
+    return save_figure(plt, name, output_dir)
+
+
+def plot_score_histogram(score_histogram, score_min, score_bin_width, output_dir=default_output_dir, name='score_histogram'):
+    pd, plt = load_plotting()
+    fig, ax = plt.subplots(figsize=(12, 8))
+
+    for player, counts in score_histogram.items():
+        bin_starts = [score_min + i * score_bin_width for i in range(len(counts))]
+        ax.step(bin_starts, counts, where='post', label=player)
+
+    ax.set_xlabel('Final Score')
+    ax.set_ylabel('Number of Games')
+    ax.set_title('Final Score Distribution')
+    ax.legend(title='Player')
+
+    return save_figure(plt, name, output_dir)
+
+
+def plot_data_with_fit(data, title, output_dir=default_output_dir):
+    import numpy as np
+    pd, plt = load_plotting()
+    # Unzip the data into separate lists
+    games, times = zip(*data)
+
+    # Convert lists into numpy arrays for numerical operations
+    games = np.array(games)
+    times = np.array(times)
+
+    # Create a scatter plot
+    plt.figure(figsize=(10, 5))
+    plt.scatter(games, times, color='b', label='Data Points')
+
+    # Fit a line to the data
+    p = np.poly1d(np.polyfit(games, times, 1))  # Polynomial of degree 1 (linear)
+
+    # Plot the line of best fit
+    plt.plot(games, p(games), 'r-', label=f'Line of Best Fit: {p}')
+
+    # Add titles and labels
+    plt.title(title)
+    plt.xlabel('Game Number')
+    plt.ylabel(title)
+    plt.legend()
+
+    return save_figure(plt, title, output_dir)
+
+
+def report_evaluation(results, output_dir=default_output_dir):
+    players = results["players"]
+    prefix = "_".join(players)
+    images = [
+        plot_scores(dict(zip(players, results["average_games_won"])), output_dir, f"{prefix}_scores"),
+        plot_rounds(dict(zip(players, results["rounds_won"])), results["total_games"], output_dir, f"{prefix}_rounds"),
+        plot_rounds_points(dict(zip(players, results["rounds_scores"])), results["total_games"], output_dir,
+                           f"{prefix}_rounds_points"),
+        plot_score_histogram(dict(zip(players, results["score_histogram"])), results["score_min"],
+                             results["score_bin_width"], output_dir, f"{prefix}_score_histogram"),
+    ]
+    return write_html_index(images, f"Evaluation of {', '.join(players)}", output_dir, prefix)
+
+
+def report_training(results, output_dir=default_output_dir):
+    results = results.sort_values('game')
+    images = [
+        plot_data_with_fit(list(zip(results['game'], results['elapsed_time'])), 'Elapsed Time', output_dir),
+        plot_data_with_fit(list(zip(results['game'], results['new_states'])), 'New States', output_dir),
+    ]
+    return write_html_index(images, "Training", output_dir)
+
+
+def report(file_path, output_dir=default_output_dir):
+    results = load_results(file_path)
+    if isinstance(results, dict):
+        return report_evaluation(results, output_dir)
+    return report_training(results, output_dir)
+
 
 if __name__ == "__main__":
-    plot_scores()
\ No newline at end of file
+    if len(sys.argv) > 1:
+        report(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else default_output_dir)
+    else:
+        plot_scores()
@@ -0,0 +1,135 @@
+import asyncio, sys, time
+
+# Batched Q-table lookups for the AI seats of many games running in one event loop (game_server.py --batched).
+# A seat awaits get_action_array() instead of reading the store itself. Requests are held for up to window seconds
+# after the last one came in, and never more than max_latency after the first one, then the distinct states of the
+# batch are read with one get_action_arrays() call on the store and every waiting seat gets its values. A batch is
+# sent at once when it reaches max_batch distinct states.
+# Early-round states repeat across games, so a batch usually holds fewer states than requests.
+
+default_window = 0.0  # Seconds, 0 batches the requests made within one pass of the event loop
+default_max_latency = 0.002
+default_max_batch = 256
+
+
+class PolicyService:
+    def __init__(self, store, window=default_window, max_latency=default_max_latency, max_batch=default_max_batch):
+        self.store = store
+        self.window = window
+        self.max_latency = max_latency
+        self.max_batch = max_batch
+        self.pending = {}  # {state: [(future, size)]}
+        self.first_request = self.last_request = None  # Loop times of the oldest and newest pending requests
+        self.timer = None
+        self.requests = 0
+        self.states = 0  # Distinct states read, summed over the batches
+        self.batches = 0
+
+    def get_action_array(self, state_str, size):
+        # Future of the store's get_action_array(state_str, size)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.setdefault(state_str, []).append((future, size))
+        self.requests += 1
+        self.last_request = loop.time()
+        if self.first_request is None:
+            self.first_request = self.last_request
+            self.timer = loop.call_at(self.last_request + self.window, self.expire)
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        return future
+
+    def expire(self):
+        # One timer per batch, pushed back while requests keep coming in
+        deadline = min(self.last_request + self.window, self.first_request + self.max_latency)
+        loop = asyncio.get_running_loop()
+        if deadline > loop.time():
+            self.timer = loop.call_at(deadline, self.expire)
+        else:
+            self.flush()
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        pending, self.pending = self.pending, {}
+        self.timer = self.first_request = None
+        if not pending:
+            return
+        # One read per state, at the largest size asked for, every request gets its own prefix
+        states = list(pending)
+        try:
+            arrays = self.store.get_action_arrays([(state, max(size for _, size in pending[state])) for state in states])
+        except Exception as e:
+            for waiting in pending.values():
+                for future, _ in waiting:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        self.batches += 1
+        self.states += len(states)
+        for state, values in zip(states, arrays):
+            for future, size in pending[state]:
+                if not future.done():  # Cancelled when its connection was lost
+                    future.set_result(values[:size] if values is not None else None)
+
+    def summary(self):
+        return {"policy_requests": self.requests, "policy_batches": self.batches,
+                "policy_states_per_batch": self.states / self.batches if self.batches else 0.0,
+                "policy_requests_per_batch": self.requests / self.batches if self.batches else 0.0}
+
+
+def record_lookups(db_path, games):
+    # The (state, size) lookups of the AI seats of each game, in the order they were made
+    import evaluate_sql
+    from evaluate_sql import TrainedAIAgent
+
+    class RecordingAgent(TrainedAIAgent):
+        def decision(self, trick, leading_suit=None):
+            decision = super().decision(trick, leading_suit)
+            lookups.append((decision[0], decision[1]))
+            return decision
+
+    evaluate_sql.print_logs = False
+    recorded = []
+    for _ in range(games):
+        lookups = []
+        players = [RecordingAgent(f"AI{seat + 1}", db_path=db_path) for seat in range(4)]
+        for round_number in range(1, 11):
+            evaluate_sql.play_round(players, round_number)
+        recorded.append(lookups)
+    return recorded
+
+
+async def replay(service, games):
+    async def play(lookups):
+        for state_str, size in lookups:
+            await service.get_action_array(state_str, size)
+    await asyncio.gather(*(play(lookups) for lookups in games))
+
+
+if __name__ == "__main__":
+    # Usage: python policy_service.py <table> [games]
+    # Replays the lookups of that many concurrent games against the store directly and through the service
+    from q_store import open_q_store
+    db_path = sys.argv[1]
+    games = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    recorded = record_lookups(db_path, games)
+    lookups = [lookup for game in recorded for lookup in game]
+    store = open_q_store(db_path)
+
+    start_time = time.perf_counter()
+    direct = [store.get_action_array(state_str, size) for state_str, size in lookups]
+    direct_time = time.perf_counter() - start_time
+    print(f"Direct: {len(lookups)} lookups in {direct_time:.3f} seconds, "
+          f"{len(lookups) / direct_time:.0f} lookups/s, {len(lookups)} store reads")
+
+    service = PolicyService(store)
+    start_time = time.perf_counter()
+    asyncio.run(replay(service, recorded))
+    service_time = time.perf_counter() - start_time
+    summary = service.summary()
+    print(f"Service: {len(lookups)} lookups in {service_time:.3f} seconds, {len(lookups) / service_time:.0f} lookups/s, "
+          f"{summary['policy_batches']} batches of {summary['policy_requests_per_batch']:.1f} requests and "
+          f"{summary['policy_states_per_batch']:.1f} states")
+    batched = store.get_action_arrays(lookups)
+    print(f"Batched results match the direct lookups: {batched == direct}")
@@ -0,0 +1,163 @@
+import hashlib, json, mmap, os, struct, sys, time
+from array import array
+from q_store import batch_arrays, open_q_store, dense_values
+from symmetry import card_count
+
+# Compiles a Q-table into the only thing a trained agent needs to play: the best legal actions of each state.
+# The file is an open addressing hash table with linear probing, memory mapped when loaded:
+#   header  magic, capacity, number of states
+#   keys    uint64 [capacity]  64-bit hash of the state key, 0 marks an empty slot
+#                              The state keys themselves are not stored. compile_policy fails if two states of the table
+#                              hash the same, so what remains is an unseen state sharing the hash of a compiled one and
+#                              playing its policy, a chance of about states / 2 ** 64 per lookup (5e-14 at 1M states).
+#   ties    uint16 [capacity]  bit i set when action i has the highest value among the legal actions
+# States where every legal action ties (e.g. never updated) are left out, the agents' random move for an unseen state
+# draws the same way as a random choice among all of them. Compiled policies hold no Q-values and cannot be trained.
+# Usage: python policy_table.py <table.json|table.db> <table.policy>
+
+magic = b"SKPOLICY"
+header_format = "<8sQQ"
+header_size = struct.calcsize(header_format)
+tigress_card = 61  # card_integers["Tigress"], which adds the Tigress played as an Escape as a last action
+max_load_factor = 0.5
+
+
+def policy_key(state_str):
+    # Same 64-bit key as shared_q_table.state_hash
+    key = int.from_bytes(hashlib.blake2b(state_str.encode(), digest_size=8).digest(), 'little')
+    return key or 1  # 0 is reserved for empty slots
+
+
+def legal_action_count(state):
+    # Actions of a state as stored by the agents: one per card of the hand, and the Tigress played as an Escape
+    hand = [round(card * card_count) for card in state["Hand"]]
+    return len(hand) + (tigress_card in hand)
+
+
+def tied_actions(values):
+    # Bit mask of the actions with the highest value
+    best = max(values)
+    return sum(1 << action for action, value in enumerate(values) if value == best)
+
+
+def group_states(store):
+    # (state, [(action, value)]) of every state, rows of a state are adjacent in every backend
+    state, pairs = None, []
+    for row_state, action, value, visits in store.items():
+        if row_state != state:
+            if pairs:
+                yield state, pairs
+            state, pairs = row_state, []
+        pairs.append((action, value))
+    if pairs:
+        yield state, pairs
+
+
+def state_policies(store):
+    # (state, ties) of every state where the agent's choice is not a plain random move
+    for state, pairs in group_states(store):
+        size = legal_action_count(json.loads(state))
+        ties = tied_actions(dense_values(pairs, size))
+        if ties != (1 << size) - 1:
+            yield state, ties
+
+
+def compile_policy(store, policy_path):
+    policies = list(state_policies(store))
+    capacity = 1 << max(int(len(policies) / max_load_factor), 1).bit_length()
+    mask = capacity - 1
+    keys, ties = [0] * capacity, [0] * capacity
+    for state, state_ties in policies:
+        key = policy_key(state)
+        slot = key & mask
+        while keys[slot] != 0:
+            if keys[slot] == key:
+                raise ValueError(f"{state} has the same 64-bit key as another state, it cannot be compiled")
+            slot = (slot + 1) & mask
+        keys[slot], ties[slot] = key, state_ties
+
+    keys, ties = array('Q', keys), array('H', ties)
+    if sys.byteorder == 'big':
+        keys.byteswap()
+        ties.byteswap()
+    with open(policy_path, 'wb') as file:
+        file.write(struct.pack(header_format, magic, capacity, len(policies)))
+        file.write(keys.tobytes())
+        file.write(ties.tobytes())
+    return len(policies)
+
+
+class PolicyTable:
+    # Read-only stand-in for a Q-store: get_action_array() gives 1 to the tied best actions and 0 to the others,
+    # so best_action() picks among the same actions, with the same random draw, as it would from the Q-values
+    def __init__(self, policy_path):
+        self.policy_path = policy_path
+        with open(policy_path, 'rb') as file:
+            self.mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        file_magic, capacity, self.count = struct.unpack_from(header_format, self.mm)
+        if file_magic != magic:
+            raise ValueError(f"{policy_path} is not a compiled policy")
+        if sys.byteorder == 'big':
+            raise ValueError("Compiled policies are little-endian")
+        self.mask = capacity - 1
+        view = memoryview(self.mm)
+        self.keys = view[header_size:header_size + 8 * capacity].cast('Q')
+        self.ties = view[header_size + 8 * capacity:header_size + 10 * capacity].cast('H')
+        view.release()
+
+    def warm(self):
+        return self
+
+    def __len__(self):
+        return self.count
+
+    def get_tied_actions(self, state_str):
+        # Bit mask of the best actions, None when every legal action is as good as the others
+        key = policy_key(state_str)
+        keys, mask = self.keys, self.mask
+        slot = key & mask
+        while True:
+            slot_key = keys[slot]
+            if slot_key == key:
+                return self.ties[slot]
+            if slot_key == 0:
+                return None
+            slot = (slot + 1) & mask
+
+    def get_action_array(self, state_str, size):
+        ties = self.get_tied_actions(state_str)
+        if ties is None:
+            return None
+        return [1.0 if ties >> action & 1 else 0.0 for action in range(size)]
+
+    def get_action_arrays(self, requests):
+        return batch_arrays(self.get_action_array, requests)
+
+    def get_action_values(self, state_str):
+        ties = self.get_tied_actions(state_str)
+        if ties is None:
+            return []
+        return list(enumerate(self.get_action_array(state_str, ties.bit_length())))
+
+    def items(self):
+        raise ValueError(f"{self.policy_path} is a compiled policy, it holds no Q-values")
+
+    def save(self):
+        pass
+
+    def close(self):
+        self.keys.release()
+        self.ties.release()
+        self.mm.close()
+
+
+if __name__ == "__main__":
+    source, destination = sys.argv[1], sys.argv[2]
+    start_time = time.perf_counter()
+    store = open_q_store(source)
+    states = compile_policy(store, destination)
+    store.close()
+    elapsed_time = time.perf_counter() - start_time
+    source_size, destination_size = os.path.getsize(source), os.path.getsize(destination)
+    print(f"Compiled {states} states from {source} ({source_size} bytes) to {destination} ({destination_size} bytes), "
+          f"{destination_size / source_size:.1%} of the original size, in {elapsed_time} seconds.")
@@ -0,0 +1,581 @@
+import os, struct
+
+# Q-table storage backends shared by the evaluation scripts, game.py and the conversion tools.
+# Opening a store is the expensive part, so each process keeps one handle per table through get_q_store().
+# Every backend lists its entries through items() as (state, action, value, visits) rows and accepts the same rows
+# through set_many(). get_many() reads the (value, visits) of a batch of (state, action) pairs.
+# get_action_array() returns the values of a state's first actions as a dense list indexed by action, which is what
+# the agents pick their move from with best_action(). States have at most 11 actions, at that size NumPy arrays are
+# slower than lists for the lookup and the argmax. get_action_arrays() does the same for a batch of (state, size)
+# requests, the SQLite backends in one query per batch_query_size states.
+# visits counts how many Q-learning updates an entry has received, 0 means it was initialized but never updated.
+# TieredQTable is not a backend but the table training.py trains in memory, spilling to a SQLite table (see below).
+
+# One open store per table path in this process
+open_stores = {}
+
+# States per query of get_action_arrays(), under SQLite's limit on query parameters
+batch_query_size = 500
+
+
+def dense_values(pairs, size):
+    # Values of actions 0 to size - 1 from (int action, value) pairs, 0 for the missing actions
+    values = [0.0] * size
+    for action, value in pairs:
+        if action < size:
+            values[action] = value
+    return values
+
+
+def pad_values(values, size):
+    # Prefix of a dense list, actions past the stored ones read as 0
+    return values[:size] if len(values) >= size else values + [0.0] * (size - len(values))
+
+
+def batch_arrays(get_action_array, requests):
+    # get_action_arrays() of the backends without a batched query
+    return [get_action_array(state_str, size) for state_str, size in requests]
+
+
+def best_action(values):
+    # Index of the highest value, ties broken at random. Draws from random exactly like random.choice over the
+    # tied actions did, so seeded runs pick the same moves.
+    import random  # Deferred, random alone would take most of this module's import time budget
+    best = max(values)
+    tied = [action for action, value in enumerate(values) if value == best]
+    return tied[random.randrange(len(tied))]
+
+
+def visits_path(json_path):
+    # JSON tables keep their visit counts in a separate {state: {action: visits}} file next to the table,
+    # so the table itself stays readable by older scripts
+    return f"{json_path[:-len('.json')] if json_path.endswith('.json') else json_path}.visits.json"
+
+
+def ensure_visits_column(cur):
+    # Tables created before visit counts were recorded get the column added, with 0 for every existing entry
+    columns = [row[1] for row in cur.execute("PRAGMA table_info(QTable)").fetchall()]
+    if columns and "visits" not in columns:
+        cur.execute("ALTER TABLE QTable ADD COLUMN visits INTEGER NOT NULL DEFAULT 0")
+
+
+class SQLiteQStore:
+    def __init__(self, db_path='q_table.db', read_only=True):
+        import sqlite3  # Deferred, only needed once a trained agent actually plays
+        self.db_path = db_path
+        self.read_only = read_only
+        if read_only:
+            # Fails loudly on a missing file instead of silently creating an empty database
+            self.conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.cur = self.conn.cursor()
+        if not read_only:
+            self.cur.execute('''
+            CREATE TABLE IF NOT EXISTS QTable (
+                state TEXT,
+                action TEXT,
+                value REAL,
+                visits INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (state, action)
+            )
+            ''')
+            ensure_visits_column(self.cur)
+            self.conn.commit()
+        columns = [row[1] for row in self.cur.execute("PRAGMA table_info(QTable)").fetchall()]
+        self.visits_column = "visits" if "visits" in columns else "0"
+
+    def warm(self):
+        # Load the schema and the root pages of the primary key index before the first real lookup
+        self.cur.execute("PRAGMA mmap_size=268435456")
+        self.cur.execute('SELECT action, value FROM QTable WHERE state=?', ("",))
+        self.cur.fetchall()
+        return self
+
+    def get_action_values(self, state_str):
+        # List of (action, value) pairs stored for the state, empty if the state has never been seen
+        self.cur.execute('SELECT action, value FROM QTable WHERE state=?', (state_str,))
+        return [(int(action), value) for action, value in self.cur.fetchall()]
+
+    def get_action_array(self, state_str, size):
+        # Values of actions 0 to size - 1, None if the state has never been seen
+        self.cur.execute('SELECT CAST(action AS INTEGER), value FROM QTable WHERE state=?', (state_str,))
+        rows = self.cur.fetchall()
+        return dense_values(rows, size) if rows else None
+
+    def get_action_arrays(self, requests):
+        # get_action_array() of each (state, size) request, the rows of all states read with one query per chunk
+        states = list({state_str for state_str, _ in requests})
+        pairs = {}
+        for start in range(0, len(states), batch_query_size):
+            chunk = states[start:start + batch_query_size]
+            self.cur.execute(f'SELECT state, CAST(action AS INTEGER), value FROM QTable '
+                             f'WHERE state IN ({",".join("?" * len(chunk))})', chunk)
+            for state_str, action, value in self.cur.fetchall():
+                pairs.setdefault(state_str, []).append((action, value))
+        return [dense_values(pairs[state_str], size) if state_str in pairs else None for state_str, size in requests]
+
+    def get_many(self, pairs):
+        # (value, visits) of each (state, action) pair, (0, 0) for entries that do not exist
+        entries = []
+        for state, action in pairs:
+            self.cur.execute(f'SELECT value, {self.visits_column} FROM QTable WHERE state=? AND action=?',
+                             (state, str(action)))
+            row = self.cur.fetchone()
+            entries.append(row if row else (0, 0))
+        return entries
+
+    def items(self, batch_size=100000):
+        # Ordered by the primary key so rows of the same state are adjacent
+        cur = self.conn.cursor()
+        cur.execute(f'SELECT state, action, value, {self.visits_column} FROM QTable ORDER BY state, action')
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            for state, action, value, visits in rows:
+                yield state, int(action), value, visits
+
+    def set_many(self, rows):
+        self.cur.executemany('INSERT OR REPLACE INTO QTable (state, action, value, visits) VALUES (?, ?, ?, ?)',
+                             ((state, str(action), value, visits) for state, action, value, visits in rows))
+        self.conn.commit()
+
+    def save(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+class JSONQStore:
+    # The {state: {action: value}} dictionary written by training.py and combine_tables.py,
+    # with visit counts in a {state: {action: visits}} dictionary of the same shape
+    def __init__(self, json_path=None, q_table=None, visits=None):
+        import json  # Deferred like sqlite3, game.py and the pool workers only read SQLite tables
+        self.json_path = json_path
+        if q_table is None:
+            q_table = {}
+            if json_path and os.path.exists(json_path):
+                with open(json_path, 'r') as file:
+                    q_table = json.load(file)
+        if visits is None:
+            visits = {}
+            if json_path and os.path.exists(visits_path(json_path)):
+                with open(visits_path(json_path), 'r') as file:
+                    visits = json.load(file)
+        self.q_table = q_table
+        self.visits = visits
+        self.arrays = {}  # Dense values of the states read through get_action_array, converted on first use
+
+    def warm(self):
+        # Loaded in full when opened
+        return self
+
+    def get_action_values(self, state_str):
+        return [(int(action), value) for action, value in self.q_table.get(state_str, {}).items()]
+
+    def get_action_array(self, state_str, size):
+        values = self.arrays.get(state_str)
+        if values is None:
+            actions = self.q_table.get(state_str)
+            if actions is None:
+                return None
+            pairs = [(int(action), value) for action, value in actions.items()]
+            values = self.arrays[state_str] = dense_values(pairs, max(pairs)[0] + 1 if pairs else 0)
+        return pad_values(values, size)
+
+    def get_action_arrays(self, requests):
+        return batch_arrays(self.get_action_array, requests)
+
+    def get_many(self, pairs):
+        q_table, visits = self.q_table, self.visits
+        return [(q_table.get(state, {}).get(f"{action}", 0), visits.get(state, {}).get(f"{action}", 0))
+                for state, action in pairs]
+
+    def items(self):
+        visits = self.visits
+        for state, actions in self.q_table.items():
+            state_visits = visits.get(state, {})
+            for action, value in actions.items():
+                yield state, int(action), value, state_visits.get(action, 0)
+
+    def set_many(self, rows):
+        q_table, visits = self.q_table, self.visits
+        for state, action, value, count in rows:
+            self.arrays.pop(state, None)
+            actions = q_table.get(state)
+            if actions is None:
+                actions = q_table[state] = {}
+            actions[f"{action}"] = value
+            if count:
+                state_visits = visits.get(state)
+                if state_visits is None:
+                    state_visits = visits[state] = {}
+                state_visits[f"{action}"] = count
+
+    def save(self, json_path=None):
+        import json
+        json_path = json_path or self.json_path
+        with open(json_path, 'w') as file:
+            json.dump(self.q_table, file)
+        with open(visits_path(json_path), 'w') as file:
+            json.dump(self.visits, file)
+
+    def close(self):
+        pass
+
+
+class CompactQStore:
+    # Read-only table written by compact_table.py: one row per state holding the values of all its actions packed into
+    # a float16, int16 or float32 array, stored as value * scale. Pruned actions are stored as, and read back as, 0.
+    # Visit counts are not kept.
+    def __init__(self, db_path='q_table.db'):
+        import sqlite3
+        self.db_path = db_path
+        self.conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+        self.cur = self.conn.cursor()
+        meta = dict(self.cur.execute('SELECT key, value FROM QTableMeta').fetchall())
+        self.value_format = meta["format"]
+        self.item_size = struct.calcsize(self.value_format)
+        self.scale = float(meta["scale"])
+
+    def warm(self):
+        self.cur.execute("PRAGMA mmap_size=268435456")
+        self.cur.execute('SELECT qvalues FROM QStates WHERE state=?', ("",))
+        self.cur.fetchall()
+        return self
+
+    def decode(self, blob):
+        values = struct.unpack(f"<{len(blob) // self.item_size}{self.value_format}", blob)
+        if self.scale != 1:
+            return [value / self.scale for value in values]
+        return list(values)
+
+    def get_values(self, state_str):
+        self.cur.execute('SELECT qvalues FROM QStates WHERE state=?', (state_str,))
+        row = self.cur.fetchone()
+        return self.decode(row[0]) if row else None
+
+    def get_action_values(self, state_str):
+        values = self.get_values(state_str)
+        return list(enumerate(values)) if values else []
+
+    def get_action_array(self, state_str, size):
+        # Only the legal prefix of the packed row is decoded
+        self.cur.execute('SELECT qvalues FROM QStates WHERE state=?', (state_str,))
+        row = self.cur.fetchone()
+        if row is None:
+            return None
+        count = min(len(row[0]) // self.item_size, size)
+        values = struct.unpack_from(f"<{count}{self.value_format}", row[0])
+        if self.scale != 1:
+            values = [value / self.scale for value in values]
+        return pad_values(list(values), size)
+
+    def get_action_arrays(self, requests):
+        states = list({state_str for state_str, _ in requests})
+        blobs = {}
+        for start in range(0, len(states), batch_query_size):
+            chunk = states[start:start + batch_query_size]
+            self.cur.execute(f'SELECT state, qvalues FROM QStates WHERE state IN ({",".join("?" * len(chunk))})', chunk)
+            blobs.update(self.cur.fetchall())
+        return [pad_values(self.decode(blobs[state_str])[:size], size) if state_str in blobs else None
+                for state_str, size in requests]
+
+    def get_many(self, pairs):
+        entries = []
+        for state, action in pairs:
+            values = self.get_values(state)
+            entries.append((values[action], 0) if values and action < len(values) else (0, 0))
+        return entries
+
+    def items(self):
+        # Only the stored non-zero values, as if the table had been pruned row by row
+        cur = self.conn.cursor()
+        for state, blob in cur.execute('SELECT state, qvalues FROM QStates ORDER BY state'):
+            for action, value in enumerate(self.decode(blob)):
+                if value != 0:
+                    yield state, action, value, 0
+
+    def save(self):
+        pass
+
+    def close(self):
+        self.conn.close()
+
+
+class TieredQTable:
+    # Q-table for training with a bounded amount of memory, used by training.py --tiered in place of its dict.
+    # It reads and writes like the {state: {action: value}} dict of training.py. Recently used states are kept in
+    # memory, and once their estimated size passes memory_budget bytes the least recently used evict_fraction of them
+    # is written to a SQLite Q-table in one batch and dropped. Evicted states are read back on their next access.
+    # States taken out with [] or get() may be changed in place, so they are written back when evicted.
+    # A Bloom filter of the states written to SQLite answers most lookups of states that were never seen without
+    # a query, training.py makes many of them when it estimates the future value.
+    def __init__(self, db_path, memory_budget=256 * 2 ** 20, evict_fraction=0.25, filter_bits=2 ** 27):
+        from collections import OrderedDict  # Deferred like random in best_action
+        self.cold = SQLiteQStore(db_path, read_only=False)
+        self.hot = OrderedDict()  # {state: [values, visits, estimated bytes, changed]}, least recently used first
+        self.memory_budget = memory_budget
+        self.evict_fraction = evict_fraction
+        self.filter = bytearray(filter_bits // 8)
+        self.filter_mask = filter_bits - 1
+        self.memory = 0
+        self.evictions = 0  # States evicted
+        self.eviction_batches = 0
+        self.faults = 0  # States read back from SQLite
+        self.false_positives = 0  # Queries for states the filter let through that were not in SQLite
+        self.count = 0  # States in either tier
+        for (state,) in self.cold.conn.execute('SELECT DISTINCT state FROM QTable'):
+            self.add_to_filter(state)
+            self.count += 1
+        self.visit_counts = TieredVisits(self)
+
+    def filter_positions(self, state):
+        # Double hashing of the string hash, which Python caches on the string
+        h = hash(state)
+        step = (h >> 32) | 1
+        return h & self.filter_mask, (h + step) & self.filter_mask, (h + 2 * step) & self.filter_mask
+
+    def add_to_filter(self, state):
+        for position in self.filter_positions(state):
+            self.filter[position >> 3] |= 1 << (position & 7)
+
+    def may_be_cold(self, state):
+        # filter_positions() unrolled, most lookups of unseen states stop at the first bit
+        h, mask, bits = hash(state), self.filter_mask, self.filter
+        step = (h >> 32) | 1
+        return bool(bits[(h & mask) >> 3] >> (h & 7) & 1 and bits[((h + step) & mask) >> 3] >> ((h + step) & 7) & 1
+                    and bits[((h + 2 * step) & mask) >> 3] >> ((h + 2 * step) & 7) & 1)
+
+    def entry(self, state, changed):
+        entry = self.hot.get(state)
+        if entry is not None:
+            self.hot.move_to_end(state)
+            entry[3] = entry[3] or changed
+            return entry
+        if not self.may_be_cold(state):
+            return None
+        rows = self.cold.cur.execute(f'SELECT action, value, {self.cold.visits_column} FROM QTable WHERE state=?',
+                                     (state,)).fetchall()
+        if not rows:
+            self.false_positives += 1
+            return None
+        self.faults += 1
+        return self.insert(state, {action: value for action, value, _ in rows},
+                           {action: visits for action, _, visits in rows if visits}, changed)
+
+    def insert(self, state, values, visits, changed):
+        # Rough size of the strings, dicts and floats of a state, as measured with tracemalloc on training tables
+        size = 330 + len(state) + 60 * len(values)
+        entry = self.hot[state] = [values, visits, size, changed]
+        self.memory += size
+        if self.memory > self.memory_budget:
+            self.evict()
+        return entry
+
+    def evict(self):
+        target = self.memory_budget * (1 - self.evict_fraction)
+        rows = []
+        while self.memory > target and len(self.hot) > 1:
+            state, (values, visits, size, changed) = self.hot.popitem(last=False)
+            self.memory -= size
+            self.evictions += 1
+            if changed:
+                rows.extend((state, action, value, visits.get(action, 0)) for action, value in values.items())
+                self.add_to_filter(state)
+        self.cold.set_many(rows)
+        self.eviction_batches += 1
+
+    def flush(self):
+        # Writes the changed states to SQLite, they stay in memory
+        rows = []
+        for state, entry in self.hot.items():
+            if entry[3]:
+                values, visits = entry[0], entry[1]
+                rows.extend((state, action, value, visits.get(action, 0)) for action, value in values.items())
+                self.add_to_filter(state)
+                entry[3] = False
+        self.cold.set_many(rows)
+
+    def stats(self):
+        return {"states": self.count, "hot_states": len(self.hot), "hot_bytes": self.memory,
+                "filter_bytes": len(self.filter), "evictions": self.evictions, "eviction_batches": self.eviction_batches,
+                "faults": self.faults, "false_positives": self.false_positives}
+
+    def __contains__(self, state):
+        if state in self.hot:
+            return True
+        return self.may_be_cold(state) and self.entry(state, False) is not None
+
+    def __getitem__(self, state):
+        entry = self.entry(state, True)
+        if entry is None:
+            raise KeyError(state)
+        return entry[0]
+
+    def __setitem__(self, state, values):
+        entry = self.entry(state, True)
+        if entry is None:
+            self.count += 1
+            self.insert(state, values, {}, True)
+        else:
+            entry[0] = values
+
+    def get(self, state, default=None):
+        entry = self.entry(state, True)
+        return entry[0] if entry is not None else default
+
+    def setdefault(self, state, default=None):
+        entry = self.entry(state, True)
+        if entry is None:
+            self[state] = default
+            return default
+        return entry[0]
+
+    def update(self, table):
+        for state, values in table.items():
+            self[state] = values
+
+    def __len__(self):
+        return self.count
+
+    def items(self):
+        # (state, {action: value}) of both tiers
+        self.flush()
+        state, values = None, {}
+        for row_state, action, value, _ in self.cold.items():
+            if row_state != state:
+                if state is not None:
+                    yield state, values
+                state, values = row_state, {}
+            values[f"{action}"] = value
+        if state is not None:
+            yield state, values
+
+    def close(self):
+        self.flush()
+        self.cold.close()
+
+
+class TieredVisits:
+    # The visit counts of a TieredQTable, read and written like training.py's {state: {action: visits}} dict.
+    # Visits are kept with the state's values, so they can only be set for states already in the table.
+    def __init__(self, table):
+        self.table = table
+
+    def get(self, state, default=None):
+        entry = self.table.entry(state, True)
+        return entry[1] if entry is not None else default
+
+    def __setitem__(self, state, visits):
+        entry = self.table.entry(state, True)
+        if entry is None:
+            raise KeyError(state)
+        entry[1] = visits
+
+    def setdefault(self, state, default=None):
+        entry = self.table.entry(state, True)
+        if entry is None:
+            raise KeyError(state)
+        return entry[1]
+
+
+def is_compact_table(db_path):
+    # Compacted tables are SQLite files too, told apart by their QStates table
+    import sqlite3
+    if not os.path.exists(db_path):
+        return False
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        return conn.execute("SELECT 1 FROM sqlite_master WHERE name='QStates'").fetchone() is not None
+    finally:
+        conn.close()
+
+
+def open_q_store(path, read_only=True):
+    # Backend chosen by file extension
+    if path.endswith('.json'):
+        return JSONQStore(path)
+    if path.endswith('.db'):
+        if is_compact_table(path):
+            if not read_only:
+                raise ValueError(f"{path} is a compacted table, which is read-only")
+            return CompactQStore(path)
+        return SQLiteQStore(path, read_only=read_only)
+    if path.endswith('.policy'):
+        from policy_table import PolicyTable  # Written by policy_table.py, holds the best actions but no Q-values
+        return PolicyTable(path)
+    if path.endswith('.npz'):
+        from value_network import ValueNetwork  # Written by value_network.py, values from a network instead of a table
+        return ValueNetwork.load(path)
+    raise ValueError(f"Unknown Q-table format: {path}")
+
+
+def get_q_store(db_path='q_table.db'):
+    store = open_stores.get(db_path)
+    if store is None:
+        store = open_q_store(db_path).warm()
+        open_stores[db_path] = store
+    return store
+
+
+def warm_q_store(db_path='q_table.db'):
+    # ProcessPoolExecutor initializer, so workers open the table before their first game instead of during it
+    get_q_store(db_path)
+
+
+def close_q_stores():
+    for store in open_stores.values():
+        store.close()
+    open_stores.clear()
+
+
+if __name__ == "__main__":
+    # Usage: python q_store.py [operations]
+    # Checks a TieredQTable small enough to evict all the time against a dict given the same random operations, then
+    # reopens its file and checks what was written to it
+    import random, sys, tempfile
+    operations = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    random.seed(3)
+    mismatches = 0
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, 'tiered.db')
+        table = TieredQTable(db_path, memory_budget=50000)
+        reference, reference_visits = {}, {}
+        states = [f'state-{i}-' + 'x' * random.randint(0, 80) for i in range(3000)]
+        for _ in range(operations):
+            state = random.choice(states)
+            operation = random.random()
+            if operation < 0.3:
+                mismatches += (state in table) != (state in reference)
+            elif operation < 0.5:
+                if state not in reference:
+                    actions = {f"{i}": 0 for i in range(random.randint(1, 6))}
+                    reference[state] = dict(actions)
+                    table[state] = dict(actions)
+            elif state in reference and operation < 0.9:
+                # Q-value update as training.py does it, in place in the dict taken out of the table
+                action = random.choice(list(reference[state]))
+                value = random.random()
+                mismatches += table[state][action] != reference[state][action]
+                reference[state][action] = value
+                table[state][action] = value
+                state_visits = reference_visits.setdefault(state, {})
+                state_visits[action] = state_visits.get(action, 0) + 1
+                state_visits = table.visit_counts.setdefault(state, {})
+                state_visits[action] = state_visits.get(action, 0) + 1
+            elif state in reference:
+                mismatches += table[state] != reference[state]
+        stats = table.stats()
+        mismatches += len(table) != len(reference) or dict(table.items()) != reference
+        mismatches += sum(table.visit_counts.get(state, {}) != reference_visits.get(state, {}) for state in reference)
+        table.close()
+        reopened = TieredQTable(db_path, memory_budget=50000)
+        mismatches += len(reopened) != len(reference) or dict(reopened.items()) != reference
+        mismatches += sum(reopened.visit_counts.get(state, {}) != reference_visits.get(state, {}) for state in reference)
+        reopened.close()
+    print(f"{operations} random operations on {len(reference)} states, {stats['evictions']} evictions and "
+          f"{stats['faults']} faults, {mismatches} mismatches against a dict")
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,126 @@
+import numpy as np
+
+# Experience replay for the trainers. Transitions are recorded into a NumPy structured array instead of being applied
+# one at a time, then applied to a Q-store in batches. Every new transition is applied once, in the order it was
+# recorded, together with a sample of older transitions (uniform, or proportional to their last TD error).
+# Repeated updates of the same (state, action) in one batch are folded into a single write that gives exactly the
+# result of applying them one after another.
+# A replayed transition keeps the max_future_q recorded when it was played. It is the best value of every state the
+# next decision could be in, which the buffer does not keep, so replayed targets use the table as it was then and
+# lag behind its current values, more so the older the transition.
+
+transition_dtype = np.dtype([
+    ("state", np.int32),  # Index into ReplayBuffer.states
+    ("action", np.int16),
+    ("reward", np.float64),
+    ("max_future_q", np.float64),
+    ("priority", np.float64),
+])
+
+
+class ReplayBuffer:
+    def __init__(self, capacity=100000, replay_size=256, prioritized=False, priority_exponent=0.6, seed=None):
+        self.capacity = capacity
+        self.replay_size = replay_size  # Older transitions replayed with every batch of new ones
+        self.prioritized = prioritized
+        self.priority_exponent = priority_exponent
+        self.transitions = np.zeros(capacity, dtype=transition_dtype)
+        self.size = 0  # Filled slots
+        self.position = 0  # Next slot to write, the buffer wraps around once full
+        self.new_start = 0  # First transition not applied yet
+        self.new_count = 0
+        self.states = []  # State keys, stored once each while a transition in the buffer refers to them
+        self.state_ids = {}
+        self.state_refs = []  # Transitions in the buffer referring to each state id
+        self.free_ids = []  # Ids of states no longer referred to, reused for new states
+        self.max_priority = 1.0
+        self.rng = np.random.default_rng(seed)
+
+    def state_id(self, state_str):
+        state_id = self.state_ids.get(state_str)
+        if state_id is None:
+            if self.free_ids:
+                state_id = self.free_ids.pop()
+                self.states[state_id] = state_str
+            else:
+                state_id = len(self.states)
+                self.states.append(state_str)
+                self.state_refs.append(0)
+            self.state_ids[state_str] = state_id
+        self.state_refs[state_id] += 1
+        return state_id
+
+    def release(self, state_id):
+        # Called when a transition is overwritten, forgets the state once nothing refers to it
+        self.state_refs[state_id] -= 1
+        if self.state_refs[state_id] == 0:
+            del self.state_ids[self.states[state_id]]
+            self.states[state_id] = None
+            self.free_ids.append(state_id)
+
+    def add(self, state_str, action, reward, max_future_q):
+        if self.new_count == self.capacity:
+            raise RuntimeError("Replay buffer is full of transitions that were never applied, call train_step more often")
+        if self.size == self.capacity:
+            self.release(int(self.transitions["state"][self.position]))
+        # New transitions get the highest priority seen so far, so each one is likely to be replayed at least once
+        self.transitions[self.position] = (self.state_id(state_str), action, reward, max_future_q, self.max_priority)
+        self.position = (self.position + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.new_count += 1
+
+    def __len__(self):
+        return self.size
+
+    def sample(self, count):
+        # Indices of replayed transitions
+        if self.size == 0 or count == 0:
+            return np.zeros(0, dtype=np.int64)
+        if self.prioritized:
+            weights = self.transitions["priority"][:self.size] ** self.priority_exponent
+            return self.rng.choice(self.size, size=count, p=weights / weights.sum())
+        return self.rng.integers(0, self.size, size=count)
+
+    def train_step(self, store, alpha, gamma):
+        # Applies the new transitions followed by a replayed sample. Returns the (state, action) pairs written.
+        new_indices = (self.new_start + np.arange(self.new_count)) % self.capacity
+        indices = np.concatenate([new_indices, self.sample(self.replay_size if self.new_count else 0)])
+        self.new_start = self.position
+        self.new_count = 0
+        if not len(indices):
+            return []
+
+        batch = self.transitions[indices]
+        targets = batch["reward"] + gamma * batch["max_future_q"]
+
+        # Group by (state, action), keeping the recorded order inside each group
+        sequence = np.arange(len(batch))
+        order = np.lexsort((sequence, batch["action"], batch["state"]))
+        states, actions, targets = batch["state"][order], batch["action"][order], targets[order]
+        starts = np.flatnonzero(np.r_[True, (states[1:] != states[:-1]) | (actions[1:] != actions[:-1])])
+        counts = np.diff(np.r_[starts, len(order)])
+
+        # n sequential updates q <- (1 - alpha) * q + alpha * target_i collapse to
+        # (1 - alpha)^n * q0 + sum_i alpha * (1 - alpha)^(n - 1 - i) * target_i
+        group = np.repeat(np.arange(len(starts)), counts)
+        position = sequence - starts[group]
+        weights = alpha * (1 - alpha) ** (counts[group] - 1 - position)
+        target_sums = np.add.reduceat(weights * targets, starts)
+
+        pairs = [(self.states[state], int(action)) for state, action in zip(states[starts].tolist(), actions[starts].tolist())]
+        if hasattr(store, "apply_batch"):
+            # Stores shared between processes read and write each entry under a lock, so no update is lost
+            current = np.array(store.apply_batch(pairs, target_sums.tolist(), counts.tolist(), alpha))
+        else:
+            entries = store.get_many(pairs)
+            current = np.array([value for value, visits in entries], dtype=np.float64)
+            new_visits = [visits + count for (value, visits), count in zip(entries, counts.tolist())]
+            new_values = (1 - alpha) ** counts * current + target_sums
+            store.set_many((state, action, value, count)
+                           for (state, action), value, count in zip(pairs, new_values.tolist(), new_visits))
+
+        # The TD error of the first update in each group becomes the new priority of the group's transitions
+        td_errors = np.abs(targets[starts] - current)
+        self.transitions["priority"][indices[order]] = np.repeat(td_errors, counts) + 1e-3
+        self.max_priority = max(self.max_priority, float(td_errors.max()) + 1e-3)
+        return pairs
@@ -0,0 +1,131 @@
+import sys, time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from fast_engine import njit, deck_size, num_players, num_rounds, heuristic_bid, play_round, round_score
+
+# Bids by simulation instead of AIAgent.make_bid's count of high cards: the unseen cards are dealt to the opponents at
+# random, the round is played out with the default AIAgent policy (fast_engine.py), and the bid with the highest
+# average round score over these rollouts is made.
+# Since the default policy does not depend on the bid, one rollout gives the tricks and bonus points of the hand,
+# which are then scored for every possible bid at once.
+# Usage: python rollout_bidder.py [hands] [rollouts] [workers]
+#        compares rollout bids with make_bid on random hands of every round and turn position
+
+# Rollouts per bid and time budget per bid in seconds, whichever is reached first.
+# At the defaults a 10 card hand takes under a millisecond to bid with Numba.
+default_rollouts = 100
+default_time_budget = 0.002
+batch_size = 50  # Rollouts run between two checks of the time budget
+
+# Independent rollouts used by the comparison to score the bids
+evaluation_rollouts = 2000
+
+
+@njit(cache=True)
+def rollout_outcomes(hand, position, samples):
+    # Tricks taken and bonus points of the hand in each rollout, played from the given turn position
+    round_number = len(hand)
+    in_hand = np.zeros(deck_size, dtype=np.bool_)
+    for card in hand:
+        in_hand[card] = True
+    unseen = np.nonzero(~in_hand)[0]
+    hands = np.zeros((num_players, num_rounds), dtype=np.int64)
+    hand_sizes = np.zeros(num_players, dtype=np.int64)
+    bids = np.zeros(num_players, dtype=np.int64)  # The default policy plays the same whatever the bids
+    tricks_taken = np.zeros(num_players, dtype=np.int64)
+    bonus_points = np.zeros(num_players, dtype=np.int64)
+    tricks = np.zeros(samples, dtype=np.int64)
+    bonuses = np.zeros(samples, dtype=np.int64)
+    for sample in range(samples):
+        np.random.shuffle(unseen)
+        dealt = 0
+        for seat in range(num_players):
+            if seat == position:
+                hands[seat, :round_number] = hand
+            else:
+                hands[seat, :round_number] = unseen[dealt:dealt + round_number]
+                dealt += round_number
+            hand_sizes[seat] = round_number
+        tricks_taken[:] = 0
+        bonus_points[:] = 0
+        play_round(hands, hand_sizes, bids, round_number, 0, tricks_taken, bonus_points)
+        tricks[sample] = tricks_taken[position]
+        bonuses[sample] = bonus_points[position]
+    return tricks, bonuses
+
+
+@njit(cache=True)
+def expected_scores(tricks, bonuses, round_number):
+    # Average round score of each bid from 0 to round_number over the rollouts
+    scores = np.zeros(round_number + 1)
+    for bid in range(round_number + 1):
+        total = 0
+        for sample in range(len(tricks)):
+            total += round_score(bid, tricks[sample], bonuses[sample], round_number)
+        scores[bid] = total / len(tricks)
+    return scores
+
+
+def rollout_bid(hand, position, rollouts=default_rollouts, time_budget=default_time_budget):
+    # Best bid for a hand of card ids (fast_engine.hand_ids) and its expected score for every bid.
+    # position is the turn position in the first trick, 0 for the round leader.
+    hand = np.asarray(hand, dtype=np.int64)
+    deadline = time.perf_counter() + time_budget
+    tricks, bonuses = [], []
+    done = 0
+    while done < rollouts:
+        batch_tricks, batch_bonuses = rollout_outcomes(hand, position, min(batch_size, rollouts - done))
+        tricks.append(batch_tricks)
+        bonuses.append(batch_bonuses)
+        done += len(batch_tricks)
+        if time.perf_counter() >= deadline:
+            break
+    scores = expected_scores(np.concatenate(tricks), np.concatenate(bonuses), len(hand))
+    return int(np.argmax(scores)), scores
+
+
+def bid_hand(args):
+    # Worker task of bid_table()
+    hand, position, rollouts, time_budget = args
+    return rollout_bid(hand, position, rollouts, time_budget)[0]
+
+
+def bid_table(hands, rollouts=default_rollouts, time_budget=None, workers=None):
+    # Rollout bids of many (hand, position) pairs, computed offline across a process pool.
+    # Without a time budget every bid uses the full number of rollouts.
+    time_budget = float('inf') if time_budget is None else time_budget
+    tasks = [(np.asarray(hand, dtype=np.int64), position, rollouts, time_budget) for hand, position in hands]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(bid_hand, tasks, chunksize=max(len(tasks) // (4 * (workers or 1)), 1)))
+
+
+def evaluate_bids(args):
+    # Worker task of the comparison: average score of the rollout bid and of make_bid's bid on fresh rollouts
+    hand, position, rollouts = args
+    bid, _ = rollout_bid(hand, position, rollouts, float('inf'))
+    scores = expected_scores(*rollout_outcomes(hand, position, evaluation_rollouts), len(hand))
+    return scores[bid], scores[heuristic_bid(hand, len(hand))]
+
+
+if __name__ == "__main__":
+    hands = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    rollouts = int(sys.argv[2]) if len(sys.argv) > 2 else default_rollouts
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    # Time per bid in this process, after compiling
+    rollout_bid(np.arange(num_rounds), 0, rollouts)
+    for round_number in (1, 5, 10):
+        start_time = time.perf_counter()
+        for _ in range(100):
+            rollout_bid(np.random.permutation(deck_size)[:round_number], 0, rollouts, float('inf'))
+        print(f"Round {round_number}: {(time.perf_counter() - start_time) * 10:.2f} ms per bid with {rollouts} rollouts")
+
+    tasks = [(np.random.permutation(deck_size)[:round_number], position, rollouts)
+             for round_number in range(1, num_rounds + 1) for position in range(num_players) for _ in range(hands)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = np.array(list(executor.map(evaluate_bids, tasks, chunksize=hands)))
+    results = results.reshape(num_rounds, num_players * hands, 2).mean(axis=1)
+    print("Average round score of the bids against default AIAgents")
+    for round_number, (rollout_score, heuristic_score) in enumerate(results, 1):
+        print(f"Round {round_number}: rollout bid {rollout_score:.1f}, make_bid {heuristic_score:.1f}")
+    print(f"Game total: rollout bids {results[:, 0].sum():.1f}, make_bid {results[:, 1].sum():.1f}")
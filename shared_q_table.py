@@ -0,0 +1,254 @@
+import hashlib
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from q_store import batch_arrays, pad_values
+
+# Q-table held in one shared memory block, so every process in a pool reads the same table without going through
+# SQLite. It is an open addressing hash table with linear probing:
+#   keys      uint64 [capacity]               64-bit hash of the state key, 0 marks an empty slot. A slot with the
+#                                             hash only matches if its bytes in the arena are the state key too.
+#   offsets   int64  [capacity]               position of the state key's bytes in the arena
+#   lengths   int32  [capacity]               length of the state key's bytes
+#   counts    uint8  [capacity]               number of actions stored for the state
+#   values    float32[capacity, max_actions]  Q-value of each action
+#   visits    uint32 [capacity, max_actions]  number of updates each action has received
+#   arena     bytes                           state keys, needed to list the table (items) and write it back out
+# New states are inserted under a single lock, value updates take one of several striped locks chosen by key,
+# and reads take no lock at all. A slot's key is written last, so readers never see a half initialized state.
+
+# At most 10 cards in hand plus the Tigress played as an Escape
+max_actions = 11
+stripes = 64
+max_load_factor = 0.9
+# Header: capacity, max actions and arena size, followed by the live counters
+count_field = 4
+arena_used_field = 5
+header_size = 64
+
+
+def state_hash(state_str):
+    key = int.from_bytes(hashlib.blake2b(state_str.encode(), digest_size=8).digest(), 'little')
+    return key or 1  # 0 is reserved for empty slots
+
+
+def block_layout(capacity, actions, arena_bytes):
+    # Byte offsets of each array inside the shared memory block, every array is 8-byte aligned
+    layout = {}
+    position = header_size
+    for name, size in (("keys", 8 * capacity), ("offsets", 8 * capacity), ("lengths", 4 * capacity),
+                       ("counts", capacity), ("values", 4 * capacity * actions), ("visits", 4 * capacity * actions),
+                       ("arena", arena_bytes)):
+        layout[name] = position
+        position += (size + 7) // 8 * 8
+    layout["size"] = position
+    return layout
+
+
+class SharedQStore:
+    def __init__(self, shm, insert_lock, stripe_locks, owner):
+        self.shm = shm
+        self.insert_lock = insert_lock
+        self.stripe_locks = stripe_locks
+        self.owner = owner  # Only the creating process unlinks the block
+
+        self.header = np.ndarray((8,), dtype=np.int64, buffer=shm.buf)
+        capacity, actions, arena_bytes = (int(value) for value in self.header[:3])
+        layout = block_layout(capacity, actions, arena_bytes)
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.keys = np.ndarray((capacity,), dtype=np.uint64, buffer=shm.buf, offset=layout["keys"])
+        self.offsets = np.ndarray((capacity,), dtype=np.int64, buffer=shm.buf, offset=layout["offsets"])
+        self.lengths = np.ndarray((capacity,), dtype=np.int32, buffer=shm.buf, offset=layout["lengths"])
+        self.counts = np.ndarray((capacity,), dtype=np.uint8, buffer=shm.buf, offset=layout["counts"])
+        self.values = np.ndarray((capacity, actions), dtype=np.float32, buffer=shm.buf, offset=layout["values"])
+        self.visits = np.ndarray((capacity, actions), dtype=np.uint32, buffer=shm.buf, offset=layout["visits"])
+        self.arena = np.ndarray((arena_bytes,), dtype=np.uint8, buffer=shm.buf, offset=layout["arena"])
+
+    @classmethod
+    def create(cls, capacity=1 << 20, arena_bytes=None, actions=max_actions):
+        # Capacity is rounded up to a power of two so probing can mask instead of taking a modulo
+        capacity = 1 << max(capacity - 1, 1).bit_length()
+        arena_bytes = arena_bytes if arena_bytes is not None else capacity * 160
+        layout = block_layout(capacity, actions, arena_bytes)
+        shm = shared_memory.SharedMemory(create=True, size=layout["size"])
+        header = np.ndarray((8,), dtype=np.int64, buffer=shm.buf)
+        header[:] = 0
+        header[:3] = (capacity, actions, arena_bytes)
+        del header
+        locks = [multiprocessing.Lock() for _ in range(stripes)]
+        return cls(shm, multiprocessing.Lock(), locks, owner=True)
+
+    @classmethod
+    def from_store(cls, store, capacity=None, arena_bytes=None):
+        # Copy every entry of another backend (e.g. SQLiteQStore) into a new shared table
+        rows = list(store.items())
+        states = len({row[0] for row in rows})
+        shared = cls.create(capacity or max(int(states / max_load_factor * 2), 1024), arena_bytes)
+        shared.set_many(rows)
+        return shared
+
+    def handle(self):
+        # Passed to pool workers through the initializer, locks can only be shared when a process is started
+        return self.shm.name, self.insert_lock, self.stripe_locks
+
+    @classmethod
+    def attach(cls, handle):
+        name, insert_lock, stripe_locks = handle
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Before Python 3.13 the block is registered with the resource tracker again. Pool workers share the
+            # creating process' tracker, so the duplicate registration is harmless.
+            shm = shared_memory.SharedMemory(name=name)
+        return cls(shm, insert_lock, stripe_locks, owner=False)
+
+    def __len__(self):
+        return int(self.header[count_field])
+
+    def find_slot(self, state_str):
+        # Slot holding the state, or the empty slot where it would be inserted. States whose hashes collide are
+        # told apart by their key bytes and probed past like any other occupied slot.
+        key = state_hash(state_str)
+        keys = self.keys
+        slot = key & self.mask
+        encoded = None
+        while True:
+            slot_key = int(keys[slot])
+            if slot_key == 0:
+                return slot, False
+            if slot_key == key:
+                encoded = encoded or state_str.encode()
+                if self.key_bytes(slot) == encoded:
+                    return slot, True
+            slot = (slot + 1) & self.mask
+
+    def key_bytes(self, slot):
+        offset = int(self.offsets[slot])
+        return self.arena[offset:offset + int(self.lengths[slot])].tobytes()
+
+    def ensure_state(self, state_str, num_actions):
+        slot, found = self.find_slot(state_str)
+        if found:
+            return slot
+        with self.insert_lock:
+            # Another process may have inserted the state, or taken the slot, since the unlocked probe
+            slot, found = self.find_slot(state_str)
+            if found:
+                return slot
+            key = state_hash(state_str)
+            count = int(self.header[count_field])
+            if count + 1 > self.capacity * max_load_factor:
+                raise RuntimeError(f"Shared Q-table is full ({count} states), create it with a larger capacity")
+            encoded = state_str.encode()
+            arena_used = int(self.header[arena_used_field])
+            if arena_used + len(encoded) > len(self.arena):
+                raise RuntimeError("Shared Q-table state arena is full, create it with a larger arena_bytes")
+            self.arena[arena_used:arena_used + len(encoded)] = np.frombuffer(encoded, dtype=np.uint8)
+            self.offsets[slot] = arena_used
+            self.lengths[slot] = len(encoded)
+            self.values[slot] = 0
+            self.visits[slot] = 0
+            self.counts[slot] = min(num_actions, self.values.shape[1])
+            self.header[arena_used_field] = arena_used + len(encoded)
+            self.header[count_field] = count + 1
+            self.keys[slot] = key  # Published last
+        return slot
+
+    def get_action_values(self, state_str):
+        slot, found = self.find_slot(state_str)
+        if not found:
+            return []
+        return list(enumerate(self.values[slot, :self.counts[slot]].tolist()))
+
+    def get_action_array(self, state_str, size):
+        slot, found = self.find_slot(state_str)
+        if not found:
+            return None
+        return pad_values(self.values[slot, :min(int(self.counts[slot]), size)].tolist(), size)
+
+    def get_action_arrays(self, requests):
+        return batch_arrays(self.get_action_array, requests)
+
+    def get(self, state_str, action, default=0):
+        slot, found = self.find_slot(state_str)
+        if not found or action >= self.counts[slot]:
+            return default
+        return float(self.values[slot, action])
+
+    def get_many(self, pairs):
+        entries = []
+        for state, action in pairs:
+            slot, found = self.find_slot(state)
+            if not found or action >= self.counts[slot]:
+                entries.append((0, 0))
+            else:
+                entries.append((float(self.values[slot, action]), int(self.visits[slot, action])))
+        return entries
+
+    def set(self, state_str, action, value, visits=None):
+        slot = self.ensure_state(state_str, action + 1)
+        with self.stripe_locks[slot % len(self.stripe_locks)]:
+            if action >= self.counts[slot]:
+                self.counts[slot] = action + 1
+            self.values[slot, action] = value
+            if visits is not None:
+                self.visits[slot, action] = visits
+
+    def apply_q_update(self, state_str, action, target, alpha):
+        # Read-modify-write of one Q-value under its stripe lock, so concurrent trainers do not lose updates
+        slot = self.ensure_state(state_str, action + 1)
+        with self.stripe_locks[slot % len(self.stripe_locks)]:
+            if action >= self.counts[slot]:
+                self.counts[slot] = action + 1
+            new_q = (1 - alpha) * float(self.values[slot, action]) + alpha * target
+            self.values[slot, action] = new_q
+            self.visits[slot, action] += 1
+        return new_q
+
+    def apply_batch(self, pairs, target_sums, counts, alpha):
+        # Replay buffer updates (replay_buffer.py): count sequential Q-learning updates of each (state, action) folded
+        # into (1 - alpha)^count * q + target_sum, each applied under its stripe lock like apply_q_update.
+        # Returns the values read before the updates.
+        current = []
+        for (state_str, action), target_sum, count in zip(pairs, target_sums, counts):
+            slot = self.ensure_state(state_str, action + 1)
+            with self.stripe_locks[slot % len(self.stripe_locks)]:
+                if action >= self.counts[slot]:
+                    self.counts[slot] = action + 1
+                value = float(self.values[slot, action])
+                self.values[slot, action] = (1 - alpha) ** count * value + target_sum
+                self.visits[slot, action] += count
+            current.append(value)
+        return current
+
+    def state_at(self, slot):
+        return self.key_bytes(slot).decode()
+
+    def items(self):
+        for slot in np.flatnonzero(self.keys).tolist():
+            state = self.state_at(slot)
+            count = self.counts[slot]
+            for action, (value, visits) in enumerate(zip(self.values[slot, :count].tolist(),
+                                                         self.visits[slot, :count].tolist())):
+                yield state, action, value, visits
+
+    def set_many(self, rows):
+        for state, action, value, visits in rows:
+            self.set(state, action, value, visits)
+
+    def save(self):
+        pass
+
+    def close(self):
+        # The numpy views have to be released before the block can be closed
+        del self.header, self.keys, self.offsets, self.lengths, self.counts, self.values, self.visits, self.arena
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def attach_shared_q_store(handle, db_path='q_table.db'):
+    # ProcessPoolExecutor initializer, registers the shared table as this process' store for db_path
+    from q_store import open_stores
+    open_stores[db_path] = SharedQStore.attach(handle)
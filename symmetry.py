@@ -0,0 +1,89 @@
+import itertools, json
+
+# Yellow, Purple and Green are interchangeable in the rules (determine_winner, determine_legality, the bonus points),
+# only Black is special. States are keyed on a canonical relabeling of these three suits so that equivalent situations
+# share one Q-table entry: of the 6 relabelings, the one giving the smallest encoding of the state is used.
+# Actions index the cards of the canonical hand, action_order[i] is the position of canonical card i in the hand
+# the agent actually holds. The Tigress played as an Escape (action len(hand)) is not affected.
+# Works on the card_integers and suit_integers values shared by the training and evaluation scripts.
+
+first_plain_card = 3  # card_integers of the 1 of Yellow, followed by Yellow, Purple and Green from 1 to 14
+plain_suit_ranks = 14
+card_count = 62  # len(card_integers), states hold card_integers / card_count
+suit_count = 4  # len(suit_integers)
+suit_permutations = list(itertools.permutations(range(3)))
+
+
+def plain_suit(card_integer):
+    # 0, 1 or 2 for Yellow, Purple and Green cards, None for Black and special cards
+    if first_plain_card <= card_integer < first_plain_card + 3 * plain_suit_ranks:
+        return (card_integer - first_plain_card) // plain_suit_ranks
+    return None
+
+
+def relabel_card(card_integer, permutation):
+    suit = plain_suit(card_integer)
+    if suit is None:
+        return card_integer
+    return card_integer + (permutation[suit] - suit) * plain_suit_ranks
+
+
+def relabel_suit(suit_integer, permutation):
+    # suit_integers are 1 to 3 for Yellow, Purple and Green, 4 for Black and 0 for no leading suit
+    if 1 <= suit_integer <= 3:
+        return permutation[suit_integer - 1] + 1
+    return suit_integer
+
+
+def hand_order(hand, permutation):
+    # Hands are sorted by suit and rank, the plain suit cards keep their positions and are sorted again once relabeled
+    positions = [i for i, card in enumerate(hand) if plain_suit(card) is not None]
+    order = list(range(len(hand)))
+    for position, index in zip(positions, sorted(positions, key=lambda i: relabel_card(hand[i], permutation))):
+        order[position] = index
+    return order
+
+
+def canonical_hand(hand):
+    # Smallest relabeled hand and every relabeling giving it, several tie when the hand lacks some of the suits
+    best, best_permutations = None, []
+    for permutation in suit_permutations:
+        relabeled = [relabel_card(hand[i], permutation) for i in hand_order(hand, permutation)]
+        if best is None or relabeled < best:
+            best, best_permutations = relabeled, [permutation]
+        elif relabeled == best:
+            best_permutations.append(permutation)
+    return best, best_permutations
+
+
+def canonicalize(hand, winning_card=0, leading_suit=0):
+    # Returns the canonical hand, winning card and leading suit, and the action order
+    canonical, permutations = canonical_hand(hand)
+    permutation = min(permutations, key=lambda p: (relabel_card(winning_card, p), relabel_suit(leading_suit, p)))
+    return (canonical, relabel_card(winning_card, permutation), relabel_suit(leading_suit, permutation),
+            hand_order(hand, permutation))
+
+
+def canonical_contexts(hand, contexts):
+    # Canonical hand and the distinct canonical (winning card, leading suit) pairs among contexts, to enumerate the
+    # states a hand can be played from next. The relabelings of the hand are only compared once.
+    canonical, permutations = canonical_hand(hand)
+    return canonical, sorted({min((relabel_card(winning_card, p), relabel_suit(leading_suit, p)) for p in permutations)
+                              for winning_card, leading_suit in contexts})
+
+
+def canonicalize_state_key(state_str):
+    # Canonical key of a state stored by an older table, and the action order to move its values with.
+    # Handles the states of training.py (legal hand) and training_sql.py (whole hand and leading suit).
+    state = json.loads(state_str)
+    hand = [round(card * card_count) for card in state["Hand"]]
+    winning = state["Winning Card"][0]
+    leading = state["Leading Suit"][0] if "Leading Suit" in state else 0
+    canonical, winning_card, leading_suit, order = canonicalize(hand, round(winning * card_count),
+                                                                round(leading * suit_count))
+    state["Hand"] = [card / card_count for card in canonical]
+    if winning:  # 0 is written as an integer when no card has been played
+        state["Winning Card"] = [winning_card / card_count]
+    if leading:
+        state["Leading Suit"] = [leading_suit / suit_count]
+    return json.dumps(state, sort_keys=True), order
@@ -0,0 +1,145 @@
+import itertools, random, sqlite3, sys, time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import evaluate_sql
+
+# Round-robin tournament between any number of agents. Every group of 4 agents of the roster plays at one table,
+# in each of the 4 rotations of its seats so that every agent plays every seat equally often. Seatings are split into
+# small tasks that idle pool workers take from the shared queue, so fast and slow agents do not hold each other up.
+# Elo ratings are updated as the results come in: each game counts as a win, draw or loss against every other agent
+# of the table, by final score. Ratings and every game's scores are written to a SQLite results file.
+# Usage: python tournament.py <results.db> <games per seating> <name=agent> <name=agent> ... [workers]
+#   agents: random                  default AIAgent
+#           trained:<table>         TrainedAIAgent playing from a Q-table (.db, .json or .policy)
+#           rollout:<table>         TrainedAIAgent with rollout bids (rollout_bidder.py)
+#           hashed:<weights>        HashedAIAgent playing from the weights of training.py --hashed (.hashed.npz)
+#           search:<ms>[:<table>]   SearchAIAgent (ismcts.py), with the Q-table as a prior at the root
+# With fewer than 4 agents the other seats are taken by default AIAgents that are not rated.
+
+initial_rating = 1500
+k_factor = 16
+games_per_task = 25
+
+
+def make_agent(name, spec):
+    kind, *args = spec.split(':')
+    if kind == 'random':
+        return evaluate_sql.AIAgent(name)
+    if kind == 'trained':
+        return evaluate_sql.TrainedAIAgent(name, db_path=args[0])
+    if kind == 'rollout':
+        return evaluate_sql.TrainedAIAgent(name, rollout_bids=True, db_path=args[0])
+    if kind == 'hashed':
+        return evaluate_sql.HashedAIAgent(name, db_path=args[0])
+    if kind == 'search':
+        from ismcts import SearchAIAgent
+        db_path = args[1] if len(args) > 1 else None
+        return SearchAIAgent(name, float(args[0]) / 1000, q_prior=db_path is not None, db_path=db_path)
+    raise ValueError(f"Unknown agent {spec}, use random, trained:<table>, rollout:<table>, hashed:<weights> "
+                     f"or search:<ms>[:<table>]")
+
+
+def schedule(roster, games):
+    # (seating, games) tasks, a seating being the (name, spec) of each seat
+    fillers = [(f"Filler {i + 1}", 'random') for i in range(4 - len(roster))]
+    tasks = []
+    for table in itertools.combinations(roster, min(len(roster), 4)):
+        table = list(table) + fillers
+        for rotation in range(4):
+            seating = table[rotation:] + table[:rotation]
+            for start in range(0, games, games_per_task):
+                tasks.append((seating, min(games_per_task, games - start)))
+    return tasks
+
+
+def play_seating(seating, games, seed):
+    # Final scores of each game, by seat
+    random.seed(seed)
+    players = [make_agent(name, spec) for name, spec in seating]
+    scores = []
+    for _ in range(games):
+        for round_number in range(1, 11):
+            evaluate_sql.play_round(players, round_number)
+        scores.append([player.score for player in players])
+        for player in players:
+            player.score = 0
+    return scores
+
+
+def update_ratings(ratings, names, scores):
+    # Elo update for one game, every pair of rated agents of the table is a match
+    rated = [i for i, name in enumerate(names) if name in ratings]
+    changes = {names[i]: 0.0 for i in rated}
+    for i, j in itertools.combinations(rated, 2):
+        expected = 1 / (1 + 10 ** ((ratings[names[j]] - ratings[names[i]]) / 400))
+        result = 1.0 if scores[i] > scores[j] else 0.5 if scores[i] == scores[j] else 0.0
+        change = k_factor / (len(rated) - 1) * (result - expected)
+        changes[names[i]] += change
+        changes[names[j]] -= change
+    for name, change in changes.items():
+        ratings[name] += change
+
+
+def open_results(results_path, roster):
+    conn = sqlite3.connect(results_path)
+    conn.execute('CREATE TABLE IF NOT EXISTS Agents (name TEXT PRIMARY KEY, spec TEXT, rating REAL, games INTEGER)')
+    conn.execute('CREATE TABLE IF NOT EXISTS Games (game INTEGER PRIMARY KEY, task INTEGER, seats TEXT, scores TEXT)')
+    # A rating belongs to the agent it was earned by, a name cannot be reused for another agent
+    stored = dict(conn.execute('SELECT name, spec FROM Agents'))
+    for name, spec in roster:
+        if name in stored and stored[name] != spec:
+            conn.close()
+            raise ValueError(f"{name} is rated as {stored[name]} in {results_path}, use another name for {spec}")
+    conn.executemany('INSERT OR IGNORE INTO Agents (name, spec, rating, games) VALUES (?, ?, ?, 0)',
+                     ((name, spec, initial_rating) for name, spec in roster))
+    conn.commit()
+    return conn
+
+
+def run_tournament(results_path, roster, games, workers=None):
+    # Ratings carry over from earlier tournaments written to the same results file
+    conn = open_results(results_path, roster)
+    ratings = {name: rating for name, rating in conn.execute('SELECT name, rating FROM Agents')
+               if name in dict(roster)}
+    played = {name: 0 for name, _ in roster}
+    tasks = schedule(roster, games)
+    print(f"{len(tasks)} tasks of up to {games_per_task} games for {len(roster)} agents")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(play_seating, seating, task_games, random.getrandbits(32)): (task, seating)
+                   for task, (seating, task_games) in enumerate(tasks)}
+        for completed, future in enumerate(as_completed(futures), 1):
+            task, seating = futures[future]
+            names = [name for name, _ in seating]
+            results = future.result()
+            for scores in results:
+                update_ratings(ratings, names, scores)
+                conn.execute('INSERT INTO Games (task, seats, scores) VALUES (?, ?, ?)',
+                             (task, ','.join(names), ','.join(map(str, scores))))
+            for name in names:
+                if name in played:
+                    played[name] += len(results)
+            conn.executemany('UPDATE Agents SET rating = ? WHERE name = ?',
+                             ((rating, name) for name, rating in ratings.items()))
+            conn.commit()
+            print(f"Task {completed}/{len(tasks)} done: " +
+                  ", ".join(f"{name} {rating:.0f}" for name, rating in sorted(ratings.items(), key=lambda x: -x[1])))
+    conn.executemany('UPDATE Agents SET games = games + ? WHERE name = ?',
+                     ((count, name) for name, count in played.items()))
+    conn.commit()
+    conn.close()
+    return ratings
+
+
+if __name__ == "__main__":
+    multiprocessing.set_start_method('spawn')
+    start_time = time.perf_counter()
+    results_path, games = sys.argv[1], int(sys.argv[2])
+    roster = [tuple(arg.split('=', 1)) for arg in sys.argv[3:] if '=' in arg]
+    workers = next((int(arg) for arg in sys.argv[3:] if '=' not in arg), None)
+    if len({name for name, _ in roster}) != len(roster):
+        raise ValueError("Agent names have to be unique")
+    ratings = run_tournament(results_path, roster, games, workers)
+    print("Final ratings:")
+    for name, rating in sorted(ratings.items(), key=lambda x: -x[1]):
+        print(f"{name}: {rating:.0f}")
+    print(f"Elapsed time: {time.perf_counter() - start_time} seconds")
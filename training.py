@@ -1,16 +1,94 @@
 import random, json, time, sys, os
 # import matplotlib.pyplot as plt
 import numpy as np
+from q_store import JSONQStore, TieredQTable, visits_path, best_action
+from hashed_q import HashedQFunction, agent_codes, agent_actions
+from replay_buffer import ReplayBuffer
+from bid_lookup import load_bid_table
+from symmetry import canonicalize, canonical_contexts
+from trick import Trick
 
 # Number of training games
-table_file = sys.argv[2] if len(sys.argv) > 2 else "decision"
-games = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
-print(sys.argv)
-
-# Initialize q-table
-# Load q-table from the file
-with open(f'decision.json', 'r') as file:
-    q_table = json.load(file)
+# Usage: python training.py [games] [table file] [--resume] [--replay] [--prioritized] [--hashed] [--hashed-batch]
+#                           [--tiered] [--memory-budget <MB>]
+# The options are module globals set by configure() in the main block, importing the module (parallel_training.py
+# workers) leaves them at these defaults.
+table_file = "decision"
+games = 20000
+resume = False
+
+# With --replay, updates are recorded in a replay buffer and applied in batches after every game,
+# together with replayed older transitions (sampled by TD error with --prioritized)
+replay_buffer = None
+
+# With --hashed, the agents learn a linear Q-function over hashed features (hashed_q.py) instead of the table. Its
+# features include what the table key leaves out: the round, the whole hand, the cards played in earlier tricks, the
+# tricks the other players still need and the scores. The weights are saved to {table_file}.hashed.npz.
+# With --hashed-batch, the updates of a game are applied together at its end in one vectorized update.
+q_function = None
+hashed_batch = False
+hashed_updates = ([], [])  # Index rows and targets of the updates waiting for the end of the game (--hashed-batch)
+# card_integers of the cards played in the earlier tricks of the round, a feature of the hashed Q-function
+played_cards = []
+
+# Checkpointing: changed entries are appended to the delta log every checkpoint_interval games,
+# and every compaction_interval checkpoints the whole table is rewritten and the delta log is emptied
+checkpoint_interval = 100
+compaction_interval = 10
+
+# Initialize q-table, loaded in the main block below
+q_table = {}
+# Number of updates each (state, action) has received, saved next to the table in {table_file}.visits.json
+visit_counts = {}
+
+# With --tiered the table is trained in {table_file}.db through a TieredQTable, which keeps at most about
+# tiered_memory_budget bytes of it in memory. A new run continues from the states already in that file (json_sqlite.py
+# converts a JSON table), and checkpoints write the changed states to it instead of the JSON files.
+# --memory-budget <MB> sets tiered_memory_budget.
+tiered = False
+tiered_memory_budget = 512 * 2 ** 20
+
+
+def table_paths():
+    # Files of a run: delta log, checkpoint and hashed weights
+    return f'{table_file}.delta.jsonl', f'{table_file}.checkpoint.json', f'{table_file}.hashed.npz'
+
+
+delta_file, checkpoint_file, hashed_file = table_paths()
+
+
+def configure(argv):
+    global table_file, games, resume, replay_buffer, q_function, hashed_batch, tiered, q_table, visit_counts
+    global delta_file, checkpoint_file, hashed_file, tiered_memory_budget
+    print(argv)
+    options = argv[1:]
+    if '--memory-budget' in options:
+        position = options.index('--memory-budget')
+        tiered_memory_budget = int(float(options[position + 1]) * 2 ** 20)
+        del options[position:position + 2]
+    args = [arg for arg in options if not arg.startswith('--')]
+    table_file = args[1] if len(args) > 1 else "decision"
+    games = int(args[0]) if len(args) > 0 else 20000
+    resume = '--resume' in argv
+    delta_file, checkpoint_file, hashed_file = table_paths()
+    replay = '--replay' in argv or '--prioritized' in argv
+    replay_buffer = ReplayBuffer(prioritized='--prioritized' in argv) if replay else None
+    hashed = '--hashed' in argv or '--hashed-batch' in argv
+    hashed_batch = '--hashed-batch' in argv
+    if hashed and replay:
+        raise ValueError("--replay replays table entries, it cannot be combined with --hashed")
+    q_function = HashedQFunction() if hashed else None
+    tiered = '--tiered' in argv
+    if tiered:
+        q_table = TieredQTable(f'{table_file}.db', tiered_memory_budget)
+        visit_counts = q_table.visit_counts
+
+
+# (state, action) pairs changed since the last checkpoint
+changed_entries = set()
+
+# Bids precomputed by bid_lookup.py, used when the file exists. Other hands are bid by make_bid.
+bid_table_path = 'bid_table.db'
 
 # Integer representation of each unique card
 card_integers = {
@@ -147,16 +225,21 @@ class AIAgent(Player):
         self.new_state = {}  # Save new state temporarily for determining reward
         self.max_future_q = None
 
-    def get_state(self, trick=[]):
+    def get_state(self, trick=Trick()):
         # hand should already be in a sorted state, this is good because order of cards in hand does not matter
         # Combining all the features into one state representation, each element should be normalized
+        # Yellow, Purple and Green are relabeled into a canonical order (see symmetry.py), action_order maps the
+        # actions of the canonical hand back to the legal hand
+        hand = [card_integers[f"{card}"] for card in self.get_legal_hand(trick.leading_suit)]
+        winning_card = card_integers[f"{trick.winner[1]}"] if trick else 0
+        hand, winning_card, _, action_order = canonicalize(hand, winning_card)
         state = {
-            "Hand": [card_integers[f"{card}"]/len(card_integers) for card in self.get_legal_hand(determine_leading_suit(trick))],  # Needs normalized representation, would require assigning a unique integer to each unique card
-            "Winning Card": [card_integers[f"{determine_winner(trick)[1]}"]/len(card_integers) if trick else 0],
+            "Hand": [card/len(card_integers) for card in hand],  # Needs normalized representation, would require assigning a unique integer to each unique card
+            "Winning Card": [winning_card/len(card_integers) if trick else 0],
             "Tricks to Bid": [1 if self.bid - self.tricks_taken > 0 else 0.5 if self.bid - self.tricks_taken == 0 else 0]
         }
 
-        return state
+        return state, action_order
 
 
     def get_legal_hand(self, leading_suit=None):
@@ -188,7 +271,14 @@ class AIAgent(Player):
 
         return legal_indices
 
-    def make_bid(self):
+    def make_bid(self, position=None):
+        # Precomputed bid for the hand if there is one
+        bid_table = load_bid_table(bid_table_path)
+        if bid_table is not None and position is not None:
+            bid = bid_table.get_bid([card_integers[f"{card}"] for card in self.hand], position)
+            if bid is not None:
+                self.bid = bid
+                return self.bid
         # This can be further refined
         self.bid = len([card for card in self.hand if card.rank is not None and card.rank > 10])
         self.bid += len([card for card in self.hand if card.special == "Tigress" or card.special == "Pirate" or card.special == "Skull King"])
@@ -197,13 +287,24 @@ class AIAgent(Player):
         return self.bid
 
     def play_card(self, players, trick, leading_suit=None):
-        state_str = json.dumps(self.get_state(trick), sort_keys=True)
+        if q_function is not None:
+            return self.play_card_hashed(players, trick, leading_suit)
+        state, action_order = self.get_state(trick)
+        state_str = json.dumps(state, sort_keys=True)
+        num_actions = len(self.hand)
+        for card in self.hand:
+            if f"{card}" == "Tigress":
+                num_actions += 1
         if state_str not in q_table:
-            num_actions = len(self.hand)
-            for card in self.hand:
-                if f"{card}" == "Tigress":
-                    num_actions += 1
             q_table[state_str] = {f"{i}": 0 for i in range(num_actions)}
+            changed_entries.update((state_str, f"{i}") for i in range(num_actions))
+        elif len(q_table[state_str]) < num_actions:
+            # Tables compacted by compact_table.py leave out the actions still at 0, they are added back
+            actions = q_table[state_str]
+            for i in range(num_actions):
+                if f"{i}" not in actions:
+                    actions[f"{i}"] = 0
+                    changed_entries.add((state_str, f"{i}"))
 
         # Retrieve the list of legal actions for the current state.
 
@@ -225,6 +326,14 @@ class AIAgent(Player):
             # Randomly select one of the max actions
             action = random.choice(max_actions)
 
+        # The Q-table is indexed by the canonical hand, the card is taken from the legal hand
+        self.old_state = state_str
+        self.old_state_action = action
+        if action < len(action_order):
+            action = action_order[action]
+        return self.take_card(legal_hand, action)
+
+    def take_card(self, legal_hand, action):
         # check if tigress was played as a pirate or escape, and edit the corresponding card accordingly
         card_to_play = None
         if action == len(legal_hand):
@@ -239,20 +348,55 @@ class AIAgent(Player):
             card_to_play = legal_hand[action]
 
         self.hand.remove(card_to_play)
-        self.old_state = state_str
-        self.old_state_action = action
 
         return card_to_play
 
+    def hashed_codes(self, players, trick, leading_suit=None):
+        return agent_codes(self, players, trick, leading_suit, self.round_number, played_cards, card_integers)
+
+    def hashed_actions(self, hand):
+        return agent_actions(hand, card_integers)
+
+    def play_card_hashed(self, players, trick, leading_suit=None):
+        legal_hand = self.get_legal_hand(leading_suit)
+        indices = q_function.indices(self.hashed_codes(players, trick, leading_suit), self.hashed_actions(legal_hand))
+        if random.uniform(0, 1) < EPSILON:
+            action = random.randint(0, len(indices)-1)
+        else:
+            action = best_action(q_function.values(indices).tolist())
+        self.old_state = indices[action]
+        self.players = players
+        return self.take_card(legal_hand, action)
+
+    def update_hashed(self, reward):
+        # The next decision is valued as leading a trick with the cards left, the table version looks up every trick
+        # that could be in front of it instead
+        if self.max_future_q is None:
+            self.max_future_q = 0
+            if self.hand:
+                indices = q_function.indices(self.hashed_codes(self.players, Trick()), self.hashed_actions(self.hand))
+                self.max_future_q = float(q_function.values(indices).max())
+        target = reward + GAMMA * self.max_future_q
+        if hashed_batch:
+            hashed_updates[0].append(self.old_state)
+            hashed_updates[1].append(target)
+        else:
+            q_function.update(self.old_state, target)
+
     def update_q_value(self, reward):
+        if q_function is not None:
+            return self.update_hashed(reward)
         # Check turn order after trick resolution to determine how many cards will be played before next decision
         # Iterate through potential tricks that may be played before next decision and gather maximum q from those scenarios
 
         if self.max_future_q is None:
             relevant_states_values = []
             for suit in suits:
-                current_hand_normalized = [card_integers[f"{self.hand[i]}"]/len(card_integers) for i in range(len(self.hand)) if self.determine_legality(self.hand[i], suit)]
-                for i in range(len(card_integers)+1):
+                current_hand = [card_integers[f"{self.hand[i]}"] for i in range(len(self.hand)) if self.determine_legality(self.hand[i], suit)]
+                # Only the canonical states can be in the table, equivalent winning cards are looked up once
+                current_hand, winning_cards = canonical_contexts(current_hand, [(i, 0) for i in range(len(card_integers)+1)])
+                current_hand_normalized = [card/len(card_integers) for card in current_hand]
+                for i, _ in winning_cards:
                     for j in range(3):
                         potential_state = {
                             "Hand": current_hand_normalized,
@@ -265,11 +409,18 @@ class AIAgent(Player):
 
             self.max_future_q = max(relevant_states_values) if relevant_states_values else 0
 
+        if replay_buffer is not None:
+            replay_buffer.add(self.old_state, self.old_state_action, reward, self.max_future_q)
+            return
+
         current_q = q_table[self.old_state][f"{self.old_state_action}"]
 
         # Q-learning formula
         new_q = (1 - ALPHA) * current_q + ALPHA * (reward + GAMMA * self.max_future_q)
         q_table[self.old_state][f"{self.old_state_action}"] = new_q
+        state_visits = visit_counts.setdefault(self.old_state, {})
+        state_visits[f"{self.old_state_action}"] = state_visits.get(f"{self.old_state_action}", 0) + 1
+        changed_entries.add((self.old_state, f"{self.old_state_action}"))
 
 
 def sort_hand(card):
@@ -302,23 +453,25 @@ def deal_cards(players, round_number):
 
 
 def gather_bids(players):
-    for player in players:
-        player.bid = player.make_bid()  # The AI's bidding logic
+    round_number = len(players[0].hand)
+    leader = (round_number % len(players) - 1) % len(players)  # Seat leading the first trick, see determine_turn_order
+    for seat, player in enumerate(players):
+        player.bid = player.make_bid((seat - leader) % len(players))  # The AI's bidding logic
 
 
 def play_tricks(players, round_number):
     for _ in range(round_number):
-        current_trick = []
+        current_trick = Trick()
 
         for player in players:
             player.is_trick_leader = False
-            leading_suit = determine_leading_suit(current_trick)
+            leading_suit = current_trick.leading_suit
             card_played = player.play_card(players, current_trick, leading_suit)
             current_trick.append((player, card_played))
 
         # Determine the winner of the trick
-        winner = determine_winner(current_trick)
-        bonus_points = determine_bonus_points(current_trick)
+        winner = current_trick.winner
+        bonus_points = current_trick.bonus_points
         if winner[0].tricks_taken < winner[0].bid:
             winner[0].update_q_value(2)
         if winner[0].tricks_taken == winner[0].bid and winner[0].bid == 0:
@@ -330,6 +483,7 @@ def play_tricks(players, round_number):
         winner[0].tricks_taken += 1
         winner[0].bonus_points += bonus_points
         winner[0].is_trick_leader = True
+        played_cards.extend(card_integers[f"{card}"] for _, card in current_trick)
         players = determine_turn_order(players)
 
         for player in players:
@@ -442,6 +596,7 @@ def determine_turn_order(players, round_number=None):
 
 
 def play_round(players, round_number):
+    played_cards.clear()
     default_players = players
     deal_cards(players, round_number)
     gather_bids(players)
@@ -483,29 +638,152 @@ def play_round(players, round_number):
 #     plt.show()
 
 
+def save_checkpoint(games_completed):
+    # Append the entries changed since the last checkpoint, followed by a marker with the game counter.
+    # Entries after the last marker belong to an interrupted checkpoint and are ignored when resuming.
+    if tiered:
+        # The SQLite table is the checkpoint. States evicted after it are written already, a resumed run keeps them.
+        q_table.flush()
+        with open(checkpoint_file, 'w') as file:
+            json.dump({"games_completed": games_completed}, file)
+        changed_entries.clear()
+        print(f"Checkpoint at game {games_completed}: {q_table.stats()}")
+        return
+    with open(delta_file, 'a') as file:
+        for state, action in changed_entries:
+            visits = visit_counts.get(state, {}).get(action, 0)
+            file.write(json.dumps([state, action, q_table[state][action], visits]) + "\n")
+        file.write(json.dumps(["checkpoint", games_completed]) + "\n")
+        file.flush()
+        os.fsync(file.fileno())
+    changed_entries.clear()
+
+
+def compact_checkpoint(games_completed):
+    # Rewrite the full table, then record the game counter and empty the delta log.
+    # The delta log is already contained in the new table, so a crash between these steps replays it harmlessly.
+    if tiered:
+        return  # Already written by save_checkpoint
+    with open(f'{table_file}.json.tmp', 'w') as file:
+        json.dump(q_table, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(f'{table_file}.json.tmp', f'{table_file}.json')
+    with open(f'{visits_path(table_file)}.tmp', 'w') as file:
+        json.dump(visit_counts, file)
+    os.replace(f'{visits_path(table_file)}.tmp', visits_path(table_file))
+    with open(f'{checkpoint_file}.tmp', 'w') as file:
+        json.dump({"games_completed": games_completed}, file)
+    os.replace(f'{checkpoint_file}.tmp', checkpoint_file)
+    open(delta_file, 'w').close()
+
+
+def load_table(json_path):
+    # Load a table and its visit counts, tables trained before visits were recorded have no visits file
+    with open(json_path, 'r') as file:
+        q_table.update(json.load(file))
+    if os.path.exists(visits_path(json_path)):
+        with open(visits_path(json_path), 'r') as file:
+            visit_counts.update(json.load(file))
+
+
+def load_checkpoint():
+    # Returns the number of games completed by the checkpointed run, with q_table restored to that point
+    games_completed = 0
+    if os.path.exists(checkpoint_file):
+        load_table(f'{table_file}.json')
+        with open(checkpoint_file, 'r') as file:
+            games_completed = json.load(file)["games_completed"]
+    else:
+        load_table('decision.json')
+
+    if os.path.exists(delta_file):
+        pending = []
+        with open(delta_file, 'r') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break  # Partially written last line
+                if entry[0] == "checkpoint":
+                    for state, action, value, visits in pending:
+                        q_table.setdefault(state, {})[action] = value
+                        if visits:
+                            visit_counts.setdefault(state, {})[action] = visits
+                    pending = []
+                    games_completed = entry[1]
+                else:
+                    pending.append(entry)
+    return games_completed
+
+
 # No need to determine winner for Q-table
 # Log time of game, cache hits based on hand size, size of dictionary at end of each game (how many entries gained in each game)
-game_elapsed_times = []
-game_new_states = []
-
-for i in range(games):
-    start_time = time.perf_counter()
-    start_table_len = len(q_table)
-    players = [AIAgent("AI1"), AIAgent("AI2"), AIAgent("AI3"), AIAgent("AI4")]
-    for round_number in range(1, 11):
-        play_round(players, round_number)
-    end_time = time.perf_counter()
-    elapsed_time = end_time - start_time
-    new_table_entries = len(q_table) - start_table_len
-    print(f"Game {i+1} took {elapsed_time} seconds and resulted in {new_table_entries} new table entries")
-    # Adding a new tuple to each array
-    game_elapsed_times.append((i+1, elapsed_time))
-    game_new_states.append((i+1, new_table_entries))
-
-# # Plotting the data
-# plot_data_with_fit(game_elapsed_times, 'Elapsed Time')
-# plot_data_with_fit(game_new_states, 'New States')
-
-
-with open(f'{table_file}.json', 'w') as file:
-    json.dump(q_table, file, indent=4)
+if __name__ == "__main__":
+    configure(sys.argv)
+    game_elapsed_times = []
+    game_new_states = []
+
+    if q_function is not None:
+        games_completed = q_function.load(hashed_file) if resume and os.path.exists(hashed_file) else 0
+        print(f"Training hashed features from game {games_completed + 1}")
+    elif tiered:
+        games_completed = 0
+        if resume and os.path.exists(checkpoint_file):
+            with open(checkpoint_file, 'r') as file:
+                games_completed = json.load(file)["games_completed"]
+        print(f"Training {table_file}.db from game {games_completed + 1} with {len(q_table)} states")
+    elif resume:
+        games_completed = load_checkpoint()
+        print(f"Resuming from game {games_completed + 1} with {len(q_table)} states")
+    else:
+        # Load q-table from the file and start a new delta log
+        load_table('decision.json')
+        games_completed = 0
+        open(delta_file, 'w').close()
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
+
+    checkpoints = 0
+    replay_store = JSONQStore(q_table=q_table, visits=visit_counts)
+    for i in range(games_completed, games):
+        start_time = time.perf_counter()
+        start_table_len = len(q_table)
+        players = [AIAgent("AI1"), AIAgent("AI2"), AIAgent("AI3"), AIAgent("AI4")]
+        for round_number in range(1, 11):
+            play_round(players, round_number)
+        if replay_buffer is not None:
+            updated = replay_buffer.train_step(replay_store, ALPHA, GAMMA)
+            changed_entries.update((state, f"{action}") for state, action in updated)
+        if hashed_batch:
+            q_function.update_batch(*hashed_updates)
+            hashed_updates[0].clear()
+            hashed_updates[1].clear()
+        end_time = time.perf_counter()
+        elapsed_time = end_time - start_time
+        new_table_entries = len(q_table) - start_table_len
+        print(f"Game {i+1} took {elapsed_time} seconds and resulted in {new_table_entries} new table entries")
+        # Adding a new tuple to each array
+        game_elapsed_times.append((i+1, elapsed_time))
+        game_new_states.append((i+1, new_table_entries))
+
+        if (i + 1) % checkpoint_interval == 0 and q_function is not None:
+            q_function.save(hashed_file, i + 1)
+        elif (i + 1) % checkpoint_interval == 0:
+            save_checkpoint(i + 1)
+            checkpoints += 1
+            if checkpoints % compaction_interval == 0:
+                compact_checkpoint(i + 1)
+
+    # # Plotting the data
+    # plot_data_with_fit(game_elapsed_times, 'Elapsed Time')
+    # plot_data_with_fit(game_new_states, 'New States')
+
+    # Final checkpoint, then write out the complete table
+    if q_function is not None:
+        q_function.save(hashed_file, games)
+    else:
+        save_checkpoint(games)
+        compact_checkpoint(games)
+        if tiered:
+            q_table.close()
@@ -1,17 +1,36 @@
-import random, json, time, sys, sqlite3
-import matplotlib.pyplot as plt
-import numpy as np
+import random, json, time, sys, sqlite3, csv
 from concurrent.futures import ProcessPoolExecutor, as_completed
 import multiprocessing
 import traceback
+from q_store import SQLiteQStore, ensure_visits_column
+from shared_q_table import SharedQStore
+from replay_buffer import ReplayBuffer
+from bid_lookup import load_bid_table
+from symmetry import canonicalize, canonical_contexts
+from trick import Trick
 
 # Initialize q-table name and number of training games
-db_name = sys.argv[2] if len(sys.argv) > 2 else "q_table"
-games = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+# Usage: python training_sql.py [games] [table name] [--shared-memory] [--replay] [--prioritized]
+args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+db_name = args[1] if len(args) > 1 else "q_table"
+games = int(args[0]) if len(args) > 0 else 100
+
+# With --shared-memory the workers train one table held in shared memory, and it is written to the database at the end
+shared_memory = '--shared-memory' in sys.argv
+shared_table_capacity = 1 << 20  # States
+shared_table = None
+
+# With --replay, updates are recorded in a replay buffer in each worker and applied in one batch after every game,
+# together with replayed older transitions (sampled by TD error with --prioritized)
+replay = '--replay' in sys.argv or '--prioritized' in sys.argv
+replay_buffer = ReplayBuffer(prioritized='--prioritized' in sys.argv) if replay else None
 
 # Initialize q-table path
 db_path = f'{db_name}.db'
 
+# Bids precomputed by bid_lookup.py, used when the file exists. Other hands are bid by make_bid.
+bid_table_path = 'bid_table.db'
+
 # Integer representation of each unique card
 card_integers = {
     "Escape": 1,
@@ -153,17 +172,24 @@ class AIAgent(Player):
         self.max_future_q = None
         self.added_states = 0
 
-    def get_state(self, players, trick=[]):
+    def get_state(self, players, trick=Trick()):
         # hand should already be in a sorted state, this is good because order of cards in hand does not matter
         # Combining all the features into one state representation, each element should be normalized
+        # Yellow, Purple and Green are relabeled into a canonical order (see symmetry.py), action_order maps the
+        # actions of the canonical hand back to the hand
+        leading_suit = trick.leading_suit
+        hand, winning_card, leading_suit, action_order = canonicalize(
+            [card_integers[f"{card}"] for card in self.hand],
+            card_integers[f"{trick.winner[1]}"] if trick else 0,
+            suit_integers[leading_suit] if leading_suit else 0)
         state = {
-            "Hand": [card_integers[f"{self.hand[i]}"]/len(card_integers) for i in range(len(self.hand))],  # Needs normalized representation, would require assigning a unique integer to each unique card
-            "Leading Suit": [suit_integers[determine_leading_suit(trick)]/len(suit_integers) if determine_leading_suit(trick) else 0],  # Normalized representation
-            "Winning Card": [card_integers[f"{determine_winner(trick)[1]}"]/len(card_integers) if trick else 0],
+            "Hand": [card/len(card_integers) for card in hand],  # Needs normalized representation, would require assigning a unique integer to each unique card
+            "Leading Suit": [leading_suit/len(suit_integers) if leading_suit else 0],  # Normalized representation
+            "Winning Card": [winning_card/len(card_integers) if trick else 0],
             "Tricks to Bid": [(self.bid - self.tricks_taken + 10)/20],  # Normalize over round number (i.e. maxmimum allowable bid for round)
         }
 
-        return state
+        return state, action_order
 
     def get_legal_actions(self, leading_suit=None):
         legal_indices = []
@@ -182,7 +208,14 @@ class AIAgent(Player):
 
         return legal_indices
 
-    def make_bid(self):
+    def make_bid(self, position=None):
+        # Precomputed bid for the hand if there is one
+        bid_table = load_bid_table(bid_table_path)
+        if bid_table is not None and position is not None:
+            bid = bid_table.get_bid([card_integers[f"{card}"] for card in self.hand], position)
+            if bid is not None:
+                self.bid = bid
+                return self.bid
         # This can be further refined
         self.bid = len([card for card in self.hand if card.rank is not None and card.rank > 10])
         self.bid += len([card for card in self.hand if card.special == "Tigress" or card.special == "Pirate" or card.special == "Skull King"])
@@ -191,12 +224,14 @@ class AIAgent(Player):
         return self.bid
 
     def play_card(self, players, trick, leading_suit=None, db_path='q_table.db'):
-        state_str = json.dumps(self.get_state(players, trick), sort_keys=True)
+        state, action_order = self.get_state(players, trick)
+        state_str = json.dumps(state, sort_keys=True)
         num_actions = len(self.hand) + sum(1 for card in self.hand if card == "Tigress")
         ensure_state_exists(db_path, state_str, num_actions)
 
-        # Retrieve the list of legal actions for the current state.
-        legal_actions = self.get_legal_actions(leading_suit)
+        # Retrieve the list of legal actions for the current state, as positions in the canonical hand
+        canonical_actions = {index: action for action, index in enumerate(action_order)}
+        legal_actions = [canonical_actions.get(index, index) for index in self.get_legal_actions(leading_suit)]
         action_values = fetch_q_values_for_actions(db_path, state_str, legal_actions)
 
         # Epsilon-greedy strategy
@@ -209,6 +244,10 @@ class AIAgent(Player):
             max_actions = [action for action in action_values if action_values[action] == max_q_value]
             action = int(random.choice(max_actions))
 
+        self.old_state = state_str
+        self.old_state_action = action
+        if action < len(action_order):
+            action = action_order[action]
 
         # check if tigress was played as a pirate or escape, and edit the corresponding card accordingly
         card_to_play = None
@@ -224,8 +263,6 @@ class AIAgent(Player):
             card_to_play = self.hand[action]
 
         self.hand.remove(card_to_play)
-        self.old_state = state_str
-        self.old_state_action = action
 
         return card_to_play
 
@@ -233,28 +270,18 @@ class AIAgent(Player):
         # Check turn order after trick resolution to determine how many cards will be played before next decision
         # Iterate through potential tricks that may be played before next decision and gather maximum q from those scenarios
         if self.max_future_q is None:
-            current_hand_normalized = [card_integers[f"{self.hand[i]}"]/len(card_integers) for i in range(len(self.hand))]
+            self.max_future_q = self.find_max_future_q(db_path)
+
+        if replay_buffer is not None:
+            # Applied in a batch at the end of the game, see run_game
+            replay_buffer.add(self.old_state, self.old_state_action, reward, self.max_future_q)
+        elif shared_table is not None:
+            # The read-modify-write happens under the slot's lock
+            shared_table.apply_q_update(self.old_state, self.old_state_action, reward + GAMMA * self.max_future_q, ALPHA)
+        else:
             with sqlite3.connect(db_path) as conn:
                 cur = conn.cursor()
 
-                relevant_states_values = []
-
-                for i in range(len(suit_integers)+1):
-                    for j in range(len(card_integers)+1):
-                        for k in range(21):
-                            potential_state = {
-                                "Hand": current_hand_normalized,
-                                "Leading Suit": [i/len(suit_integers)],
-                                "Winning Card": [j/len(card_integers)],
-                                "Tricks to Bid": [k/20],
-                            }
-                            potential_state_str = json.dumps(potential_state, sort_keys=True)
-                            cur.execute("SELECT value FROM QTable WHERE state=?", (potential_state_str,))
-                            fetched = cur.fetchall()
-                            relevant_states_values.extend([val[0] for val in fetched])  # Extract values from fetched tuples
-
-                self.max_future_q = max(relevant_states_values) if relevant_states_values else 0
-
                 # Fetch the current Q-value
                 cur.execute("SELECT value FROM QTable WHERE state=? AND action=?",
                             (self.old_state, str(self.old_state_action)))
@@ -264,11 +291,42 @@ class AIAgent(Player):
                 # Calculate the new Q-value
                 new_q = (1 - ALPHA) * current_q + ALPHA * (reward + GAMMA * self.max_future_q)
 
-                # Update the Q-value in the database
-                cur.execute("INSERT OR REPLACE INTO QTable (state, action, value) VALUES (?, ?, ?)",
-                            (self.old_state, str(self.old_state_action), new_q))
+                # Update the Q-value in the database and count the visit
+                cur.execute('''
+                    INSERT INTO QTable (state, action, value, visits) VALUES (?, ?, ?, 1)
+                    ON CONFLICT(state, action) DO UPDATE SET value=excluded.value, visits=visits+1
+                ''', (self.old_state, str(self.old_state_action), new_q))
                 conn.commit()
 
+    def find_max_future_q(self, db_path='q_table.db'):
+        # Only the canonical states can be in the table, equivalent (winning card, leading suit) pairs are looked up once
+        current_hand, contexts = canonical_contexts([card_integers[f"{self.hand[i]}"] for i in range(len(self.hand))],
+                                                    [(j, i) for i in range(len(suit_integers)+1) for j in range(len(card_integers)+1)])
+        current_hand_normalized = [card/len(card_integers) for card in current_hand]
+        relevant_states_values = []
+        conn = sqlite3.connect(db_path) if shared_table is None else None
+        cur = conn.cursor() if conn else None
+
+        for j, i in contexts:
+            for k in range(21):
+                potential_state = {
+                    "Hand": current_hand_normalized,
+                    "Leading Suit": [i/len(suit_integers)],
+                    "Winning Card": [j/len(card_integers)],
+                    "Tricks to Bid": [k/20],
+                }
+                potential_state_str = json.dumps(potential_state, sort_keys=True)
+                if shared_table is not None:
+                    relevant_states_values.extend(value for action, value in shared_table.get_action_values(potential_state_str))
+                else:
+                    cur.execute("SELECT value FROM QTable WHERE state=?", (potential_state_str,))
+                    fetched = cur.fetchall()
+                    relevant_states_values.extend([val[0] for val in fetched])  # Extract values from fetched tuples
+
+        if conn:
+            conn.close()
+        return max(relevant_states_values) if relevant_states_values else 0
+
 
 def sort_hand(card):
     # Define an order for colors and specials
@@ -300,31 +358,33 @@ def deal_cards(players, round_number):
 
 
 def gather_bids(players):
-    for player in players:
-        player.bid = player.make_bid()  # The AI's bidding logic
+    round_number = len(players[0].hand)
+    leader = (round_number % len(players) - 1) % len(players)  # Seat leading the first trick, see determine_turn_order
+    for seat, player in enumerate(players):
+        player.bid = player.make_bid((seat - leader) % len(players))  # The AI's bidding logic
 
 
 def play_tricks(players, round_number, db_path='q_table.db'):
     for _ in range(round_number):
-        current_trick = []
+        current_trick = Trick()
 
         for player in players:
             player.is_trick_leader = False
-            leading_suit = determine_leading_suit(current_trick)
+            leading_suit = current_trick.leading_suit
             card_played = player.play_card(players, current_trick, leading_suit, db_path)
             current_trick.append((player, card_played))
 
         # Determine the winner of the trick
-        winner = determine_winner(current_trick)
-        bonus_points = determine_bonus_points(current_trick)
+        winner = current_trick.winner
+        bonus_points = current_trick.bonus_points
         if winner[0].tricks_taken < winner[0].bid:
-            winner[0].update_q_value(5)
+            winner[0].update_q_value(5, db_path)
         if winner[0].tricks_taken == winner[0].bid and winner[0].bid == 0:
-            winner[0].update_q_value(-10)
+            winner[0].update_q_value(-10, db_path)
         if winner[0].tricks_taken >= winner[0].bid and winner[0].bid > 0:
-            winner[0].update_q_value(-2)
+            winner[0].update_q_value(-2, db_path)
         if bonus_points:
-            winner[0].update_q_value(bonus_points/10)
+            winner[0].update_q_value(bonus_points/10, db_path)
         winner[0].tricks_taken += 1
         winner[0].bonus_points += bonus_points
         winner[0].is_trick_leader = True
@@ -401,25 +461,25 @@ def determine_winner(trick):
     return highest_special or highest_suit_card
 
 
-def score_round(players, round_number, db_path='q_table'):
+def score_round(players, round_number, db_path='q_table.db'):
     for player in players:
         player.max_future_q = 0
         if player.bid == 0:
             if player.bid == player.tricks_taken:
                 player.score += 10 * round_number
                 player.score += player.bonus_points
-                player.update_q_value(10)
+                player.update_q_value(10, db_path)
             else:
                 player.score -= 10 * round_number
-                player.update_q_value(-10)
+                player.update_q_value(-10, db_path)
         else:
             if player.bid == player.tricks_taken:
                 player.score += 20 * player.bid
                 player.score += player.bonus_points
-                player.update_q_value(10)
+                player.update_q_value(10, db_path)
             else:
                 player.score -= 10 * abs(player.bid - player.tricks_taken)
-                player.update_q_value(-5)
+                player.update_q_value(-5, db_path)
         player.tricks_taken = 0
         player.bonus_points = 0
         player.max_future_q = None
@@ -446,39 +506,7 @@ def play_round(players, round_number, db_path='q_table.db'):
     players = determine_turn_order(players, round_number)
     play_tricks(players, round_number, db_path=db_path)
     players = default_players
-    score_round(players, round_number)
-
-
-# Function to plot data and a line of best fit
-def plot_data_with_fit(data, title, degree=2):
-    # Unzip the data into separate lists
-    games, times = zip(*data)
-
-    # Convert lists into numpy arrays for numerical operations
-    games = np.array(games)
-    times = np.array(times)
-
-    # Create a scatter plot
-    plt.figure(figsize=(10, 5))
-    plt.scatter(games, times, color='b', label='Data Points')
-
-    # Fit a line to the data
-    p = np.poly1d(np.polyfit(games, times, 1))  # Polynomial of degree 1 (linear)
-
-    # Plot the line of best fit
-    plt.plot(games, p(games), 'r-', label=f'Line of Best Fit: {p}')
-
-    # Add titles and labels
-    plt.title(title)
-    plt.xlabel('Game Number')
-    plt.ylabel(title)
-    plt.legend()
-
-    # Save the plot to a file
-    plt.savefig(f"{title}.png", format='png', dpi=300)  # Save as PNG with 300 DPI
-
-    # Show the plot
-    plt.show()
+    score_round(players, round_number, db_path=db_path)
 
 
 def run_game(players, game_number, db_path='q_table.db'):
@@ -488,6 +516,11 @@ def run_game(players, game_number, db_path='q_table.db'):
         print(f'Game {game_number} has started')
         for round_number in range(1, 11):
             play_round(players, round_number, db_path=db_path)
+        if replay_buffer is not None:
+            replay_store = shared_table if shared_table is not None else SQLiteQStore(db_path, read_only=False)
+            replay_buffer.train_step(replay_store, ALPHA, GAMMA)
+            if replay_store is not shared_table:
+                replay_store.close()
         for player in players:
             game_added_states += player.added_states
         end_time = time.perf_counter()
@@ -501,6 +534,21 @@ def run_game(players, game_number, db_path='q_table.db'):
         raise
 
 
+def attach_shared_table(handle):
+    # ProcessPoolExecutor initializer for --shared-memory runs
+    global shared_table
+    shared_table = SharedQStore.attach(handle)
+
+
+def save_training_results(file_path, game_elapsed_times, game_new_states):
+    new_states = dict(game_new_states)
+    with open(file_path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['game', 'elapsed_time', 'new_states'])
+        for game_number, elapsed_time in sorted(game_elapsed_times):
+            writer.writerow([game_number, elapsed_time, new_states[game_number]])
+
+
 def create_database(db_path='q_table.db'):
     # Connect to SQLite database (or create it if it doesn't exist)
     conn = sqlite3.connect(db_path)
@@ -512,9 +560,11 @@ def create_database(db_path='q_table.db'):
         state TEXT,
         action TEXT,
         value REAL,
+        visits INTEGER NOT NULL DEFAULT 0,
         PRIMARY KEY (state, action)
     )
     ''')
+    ensure_visits_column(cur)
     conn.commit()
     conn.close()
 
@@ -529,6 +579,9 @@ def initialize_database(db_path):
 
 
 def ensure_state_exists(db_path, state_str, num_actions):
+    if shared_table is not None:
+        shared_table.ensure_state(state_str, num_actions)
+        return
     with sqlite3.connect(db_path) as conn:
         cur = conn.cursor()
         for i in range(num_actions):
@@ -540,6 +593,9 @@ def ensure_state_exists(db_path, state_str, num_actions):
 
 
 def fetch_q_values_for_actions(db_path, state_str, legal_actions):
+    if shared_table is not None:
+        stored_values = dict(shared_table.get_action_values(state_str))
+        return {str(action): stored_values[action] for action in legal_actions if action in stored_values}
     with sqlite3.connect(db_path) as conn:
         cur = conn.cursor()
         cur.execute('''
@@ -568,7 +624,13 @@ if __name__ == "__main__":
     create_database(db_path)
     initialize_database(db_path)
     players = [AIAgent("AI1"), AIAgent("AI2"), AIAgent("AI3"), AIAgent("AI4")]
-    with ProcessPoolExecutor() as executor:
+    initializer, initargs, table = None, (), None
+    if shared_memory:
+        sqlite_table = SQLiteQStore(db_path)
+        table = SharedQStore.from_store(sqlite_table, capacity=shared_table_capacity)
+        sqlite_table.close()
+        initializer, initargs = attach_shared_table, (table.handle(),)
+    with ProcessPoolExecutor(initializer=initializer, initargs=initargs) as executor:
         # Submit all games to the executor
         future_to_session = {executor.submit(run_game, players, game, db_path): game for game in
                              range(1, games + 1)}
@@ -583,7 +645,14 @@ if __name__ == "__main__":
             except Exception as exc:
                 print(f"Game {game_number} generated an exception: {exc}")
 
-
-    # Plotting the data
-    plot_data_with_fit(game_elapsed_times, 'Elapsed Time')
-    plot_data_with_fit(game_new_states, 'New States')
+    if table is not None:
+        # Write the trained table back to the database in one transaction
+        sqlite_table = SQLiteQStore(db_path, read_only=False)
+        sqlite_table.set_many(table.items())
+        sqlite_table.close()
+        table.close()
+
+    # Plots are rendered separately from the results file by plot_scores.py
+    results_path = f'training_{db_name}.csv'
+    save_training_results(results_path, game_elapsed_times, game_new_states)
+    print(f"Results written to {results_path}, render them with: python plot_scores.py {results_path}")
@@ -0,0 +1,122 @@
+import sys
+
+# Trick that keeps the values derived from its cards up to date as they are played, instead of determine_leading_suit,
+# determine_winner and determine_bonus_points going over the whole trick again at every decision.
+# It is still a list of (player, card) pairs. The rules are those of the determine_* functions in the game scripts,
+# python trick.py checks the two against each other on random tricks.
+
+special_ranks = {
+    "Skull King": 3,
+    "Pirate": 2,
+    "Escape": 1,
+}
+
+
+def special_rank(card):
+    # If the card is a Tigress, use its played_as attribute to determine its rank
+    return special_ranks[card.played_as] if card.special == 'Tigress' else special_ranks[card.special]
+
+
+class Trick(list):
+    def __init__(self, plays=()):
+        super().__init__()
+        self.clear_derived()
+        for play in plays:
+            self.append(play)
+
+    def clear_derived(self):
+        self.leading_suit = None
+        self.winning_suit = None  # Suit the highest suit card is ranked in, Black once the trick has been trumped
+        self.highest_special = None
+        self.highest_suit_card = None
+        self.only_escapes = True
+        self.king_played = False
+        self.pirates = 0
+        self.fourteens_bonus = 0
+        # The Tigress and the mode it was played in, the derived values are recomputed if played_as changes
+        self.tigress = None
+        self.tigress_played_as = None
+
+    def append(self, play):
+        super().append(play)
+        self.add_derived(play)
+
+    def add_derived(self, play):
+        player, card = play
+        if self.leading_suit is None and (not card.special or (card.special != "Escape" and card.suit is not None)):
+            self.leading_suit = self.winning_suit = card.suit
+        if card.special == 'Tigress':
+            self.tigress, self.tigress_played_as = card, card.played_as
+        self.only_escapes = self.only_escapes and (card.special == 'Escape' or card.played_as == 'Escape')
+
+        if card.special:
+            if not self.highest_special or special_rank(card) > special_rank(self.highest_special[1]):
+                self.highest_special = play
+        elif card.suit == self.winning_suit:
+            if not self.highest_suit_card or card.rank > self.highest_suit_card[1].rank:
+                self.highest_suit_card = play
+        elif card.suit == "Black" and self.highest_suit_card[1].suit != "Black":
+            self.highest_suit_card = play
+            self.winning_suit = card.suit
+
+        if card.special == "Skull King":
+            self.king_played = True
+        elif card.special == "Pirate" or (card.special == "Tigress" and card.played_as == "Pirate"):
+            self.pirates += 1
+        if card.rank == 14:
+            self.fourteens_bonus += 10 if card.suit != "Black" else 20
+
+    def refresh(self):
+        # Recomputes the derived values if the Tigress' played_as was set after it joined the trick
+        if self.tigress is not None and self.tigress.played_as != self.tigress_played_as:
+            plays = list(self)
+            self.clear_derived()
+            for play in plays:
+                self.add_derived(play)
+
+    @property
+    def winner(self):
+        # (player, card) winning the trick so far, None for an empty trick
+        self.refresh()
+        highest_special, highest_suit_card = self.highest_special, self.highest_suit_card
+        if highest_special:
+            if (highest_special[1].special == 'Escape' or highest_special[1].played_as == 'Escape') and not self.only_escapes:
+                return highest_suit_card or highest_special
+        return highest_special or highest_suit_card
+
+    @property
+    def bonus_points(self):
+        self.refresh()
+        return self.fourteens_bonus + (self.pirates * 30 if self.king_played else 0)  # For each pirate captured by the king
+
+
+if __name__ == "__main__":
+    # Equivalence check against the reference rules: python trick.py [tricks]
+    import random
+    import evaluate_sql as rules
+    tricks = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    colors = ["Black", "Yellow", "Purple", "Green"]
+    specials = [("Escape", 5), ("Pirate", 5), ("Tigress", 1), ("Skull King", 1)]
+    mismatches = 0
+    for _ in range(tricks):
+        deck = [rules.Card(color, rank) for color in colors for rank in range(1, 15)] + \
+               [rules.Card(None, None, special) for special, count in specials for _ in range(count)]
+        random.shuffle(deck)
+        trick = Trick()
+        for player in range(random.randint(1, 6)):
+            card = deck.pop()
+            if card.special == "Tigress":
+                card.played_as = random.choice(["Pirate", "Escape"])
+            trick.append((f"Player {player + 1}", card))
+            plain = list(trick)
+            if (trick.leading_suit, trick.winner, trick.bonus_points) != \
+                    (rules.determine_leading_suit(plain), rules.determine_winner(plain), rules.determine_bonus_points(plain)):
+                mismatches += 1
+        if trick.tigress is not None:
+            # Switching the Tigress' mode after it was played must be picked up
+            trick.tigress.played_as = "Escape" if trick.tigress.played_as == "Pirate" else "Pirate"
+            plain = list(trick)
+            if (trick.winner, trick.bonus_points) != (rules.determine_winner(plain), rules.determine_bonus_points(plain)):
+                mismatches += 1
+    print(f"{tricks} random tricks, {mismatches} mismatches against the reference rules")
+    sys.exit(1 if mismatches else 0)
@@ -0,0 +1,330 @@
+import json, os, random, sys, time
+import numpy as np
+from q_store import open_q_store, best_action
+from symmetry import card_count
+
+# Small value network standing in for a Q-table: Q(state, action) from a multilayer perceptron in plain NumPy, with
+# a few ten thousand weights (tens of kilobytes) where the table takes an entry per state seen. It is distilled from
+# a table's visited entries, and can then be fine-tuned by self-play.
+# Unlike a table it gives values for states it has never seen. The network file opens like a Q-table through
+# q_store.open_q_store (.npz), so TrainedAIAgent(db_path="network.npz"), the tournament and the game server play
+# from it as they do from a table, and get_action_arrays() evaluates the actions of a batch of states in one pass.
+# Inputs of a (state, action) pair, one-hot or counts over the card_integers of the scripts:
+#   cards of the canonical legal hand, winning card (0 for none), tricks to bid (3 values), card played
+# Usage: python value_network.py <table.json|table.db> <network.npz> [epochs]    (distill)
+#        python value_network.py <network.npz> <network.npz> [games]           (fine-tune by self-play)
+#        python value_network.py <network.npz> <table> [games]                 (benchmark against the table agent)
+
+magic = 'SKVALUENET'
+hidden_sizes = (64, 32)
+input_size = 3 * card_count + 4
+escape_card = 2  # card_integers["Tigress as Escape"], the card of the last action when the hand holds the Tigress
+tigress_card = 61
+learning_rate = 0.001
+batch_size = 256
+validation_split = 0.1
+# Self-play
+epsilon = 0.1
+gamma = 0.9  # Discount per card left to play in the round, as in training.py
+update_games = 50  # Games played between updates
+
+
+def parse_state(state_str):
+    # (hand, winning card, tricks to bid index) of a state key written by get_state
+    state = json.loads(state_str)
+    hand = [round(card * card_count) for card in state["Hand"]]
+    return hand, round(state["Winning Card"][0] * card_count), round(2 - 2 * state["Tricks to Bid"][0])
+
+
+def action_count(hand):
+    return len(hand) + (tigress_card in hand)
+
+
+def encode(pairs, parsed=None):
+    # Input matrix of (state_str, action) pairs, parsed caches the states already decoded
+    parsed = {} if parsed is None else parsed
+    rows, columns = [], []
+    for row, (state_str, action) in enumerate(pairs):
+        state = parsed.get(state_str)
+        if state is None:
+            state = parsed[state_str] = parse_state(state_str)
+        hand, winning_card, tricks = state
+        card = hand[action] if action < len(hand) else escape_card
+        columns.extend(card - 1 for card in hand)
+        columns.extend((card_count + winning_card, 2 * card_count + 1 + tricks, 2 * card_count + 3 + card))
+        rows.extend([row] * (len(hand) + 3))
+    features = np.zeros((len(pairs), input_size), dtype=np.float32)
+    np.add.at(features, (rows, columns), 1)
+    return features
+
+
+class ValueNetwork:
+    def __init__(self, params=None, seed=0):
+        if params is None:
+            rng = np.random.default_rng(seed)
+            sizes = (input_size,) + hidden_sizes + (1,)
+            params = []
+            for fan_in, fan_out in zip(sizes[:-1], sizes[1:]):
+                params.append((rng.standard_normal((fan_in, fan_out)) * np.sqrt(2 / fan_in)).astype(np.float32))
+                params.append(np.zeros(fan_out, dtype=np.float32))
+        self.params = params
+        self.moments = None  # Adam moment estimates, created by the first update
+        self.steps = 0
+        self.state_inputs = {}  # {state: (first layer sum of the state's inputs, input column of each action)}
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if str(data.get('format')) != magic:
+                raise ValueError(f"{path} is not a value network")
+            return cls([data[f'param{i}'] for i in range(len(data.files) - 1)])
+
+    def save(self, path):
+        with open(path, 'wb') as file:
+            np.savez(file, format=magic, **{f'param{i}': param for i, param in enumerate(self.params)})
+
+    def nbytes(self):
+        return sum(param.nbytes for param in self.params)
+
+    def forward(self, features):
+        # Output of each layer, the last one is the value of each row
+        activations = [features]
+        for layer in range(0, len(self.params), 2):
+            output = activations[-1] @ self.params[layer] + self.params[layer + 1]
+            activations.append(np.maximum(output, 0) if layer + 2 < len(self.params) else output)
+        return activations
+
+    def predict(self, features):
+        return self.forward(features)[-1][:, 0]
+
+    def update(self, features, targets):
+        # One Adam step on the mean squared error of a minibatch, returns the loss before the step
+        self.state_inputs.clear()
+        activations = self.forward(features)
+        error = activations[-1][:, 0] - targets
+        gradient = (2 * error / len(targets))[:, None].astype(np.float32)
+        gradients = [None] * len(self.params)
+        for layer in range(len(self.params) - 2, -1, -2):
+            gradients[layer] = activations[layer // 2].T @ gradient
+            gradients[layer + 1] = gradient.sum(axis=0)
+            if layer:
+                gradient = (gradient @ self.params[layer].T) * (activations[layer // 2] > 0)
+        if self.moments is None:
+            self.moments = [(np.zeros_like(param), np.zeros_like(param)) for param in self.params]
+        self.steps += 1
+        beta1, beta2 = 0.9, 0.999
+        correction = np.sqrt(1 - beta2 ** self.steps) / (1 - beta1 ** self.steps)
+        for param, grad, (m, v) in zip(self.params, gradients, self.moments):
+            m += (1 - beta1) * (grad - m)
+            v += (1 - beta2) * (grad * grad - v)
+            param -= learning_rate * correction * m / (np.sqrt(v) + 1e-8)
+        return float(np.mean(error ** 2))
+
+    def fit(self, features, targets, epochs):
+        # Minibatch training, returns the loss of the last epoch
+        loss = 0.0
+        for _ in range(epochs):
+            order = np.random.permutation(len(targets))
+            losses = [self.update(features[batch], targets[batch])
+                      for batch in np.array_split(order, max(1, len(order) // batch_size))]
+            loss = float(np.mean(losses))
+        return loss
+
+    # Q-store interface, read-only
+
+    def warm(self):
+        return self
+
+    def state_input(self, state_str):
+        # The first layer is linear, the inputs of a state are summed once for all its actions
+        entry = self.state_inputs.get(state_str)
+        if entry is None:
+            if len(self.state_inputs) > 100000:
+                self.state_inputs.clear()
+            hand, winning_card, tricks = parse_state(state_str)
+            columns = [card - 1 for card in hand] + [card_count + winning_card, 2 * card_count + 1 + tricks]
+            entry = self.state_inputs[state_str] = (
+                self.params[0][columns].sum(axis=0) + self.params[1],
+                [2 * card_count + 3 + card for card in hand + [escape_card]])
+        return entry
+
+    def get_action_arrays(self, requests):
+        # Values of the first size actions of each (state, size) request, all evaluated in one forward pass
+        if not requests:
+            return []
+        sizes = [size for _, size in requests]
+        entries = [self.state_input(state_str) for state_str, _ in requests]
+        columns = [column for (_, actions), size in zip(entries, sizes) for column in actions[:size]]
+        hidden = np.repeat(np.array([state for state, _ in entries]), sizes, axis=0) + self.params[0][columns]
+        for layer in range(2, len(self.params), 2):
+            hidden = np.maximum(hidden, 0) @ self.params[layer] + self.params[layer + 1]
+        values = hidden[:, 0].tolist()
+        arrays, start = [], 0
+        for _, size in requests:
+            arrays.append(values[start:start + size])
+            start += size
+        return arrays
+
+    def get_action_array(self, state_str, size):
+        return self.get_action_arrays([(state_str, size)])[0]
+
+    def get_action_values(self, state_str):
+        return list(enumerate(self.get_action_array(state_str, action_count(parse_state(state_str)[0]))))
+
+    def get_many(self, pairs):
+        return [(value, 0) for value in self.predict(encode(pairs)).tolist()]
+
+    def items(self):
+        raise ValueError("A value network holds no table entries")
+
+    def close(self):
+        pass
+
+
+def table_samples(store):
+    # (state, action) pairs and values of a table's entries. Only visited entries are used when the table keeps visit
+    # counts, the others still hold their initial value. Actions past the legal ones of the state are left out.
+    entries = [(state, int(action), value, visits) for state, action, value, visits in store.items()]
+    if any(visits for _, _, _, visits in entries):
+        entries = [entry for entry in entries if entry[3]]
+    parsed = {}
+    pairs, targets = [], []
+    for state, action, value, _ in entries:
+        if state not in parsed:
+            parsed[state] = parse_state(state)
+        if action < action_count(parsed[state][0]):
+            pairs.append((state, action))
+            targets.append(value)
+    return pairs, np.array(targets, dtype=np.float32), parsed
+
+
+def best_action_agreement(network, pairs, targets):
+    # Fraction of states with several visited actions where the network's best action is one the table ranks first,
+    # None when the table has no such state
+    table_values = {}
+    for (state, action), value in zip(pairs, targets):
+        table_values.setdefault(state, {})[action] = value
+    states = [state for state, values in table_values.items() if len(values) > 1]
+    if not states:
+        return None
+    agreed = 0
+    for state in states:
+        actions = sorted(table_values[state])
+        values = network.predict(encode([(state, action) for action in actions]))
+        best = max(table_values[state].values())
+        agreed += table_values[state][actions[int(np.argmax(values))]] == best
+    return agreed / len(states)
+
+
+def distill(table_path, epochs=30, seed=0):
+    np.random.seed(seed)
+    pairs, targets, parsed = table_samples(open_q_store(table_path))
+    if not pairs:
+        raise ValueError(f"{table_path} has no entries to distill")
+    features = encode(pairs, parsed)
+    order = np.random.permutation(len(pairs))
+    held_out = order[:int(len(order) * validation_split)]
+    trained = order[len(held_out):]
+    network = ValueNetwork(seed=seed)
+    for epoch in range(1, epochs + 1):
+        loss = network.fit(features[trained], targets[trained], 1)
+        if epoch % 10 == 0 or epoch == epochs:
+            validation = float(np.mean((network.predict(features[held_out]) - targets[held_out]) ** 2))
+            print(f"Epoch {epoch}: training loss {loss:.3f}, validation loss {validation:.3f}")
+    agreement = best_action_agreement(network, pairs, targets)
+    print(f"{len(pairs)} entries of {len(parsed)} states, best action agreement with the table: "
+          f"{'n/a (no state with several visited actions)' if agreement is None else f'{agreement:.1%}'}")
+    return network
+
+
+def self_play(network, games):
+    # Fine-tunes the network on the outcomes of its own games, with the rewards training.py gives at the end of a
+    # round, discounted by the cards left to play after each decision
+    import evaluate_sql
+    from evaluate_sql import TrainedAIAgent
+
+    class SelfPlayAgent(TrainedAIAgent):
+        def play_card(self, players, trick, leading_suit=None, db_path=None):
+            decision = self.decision(trick, leading_suit)
+            state_str, legal_actions = decision[0], decision[1]
+            if random.random() < epsilon:
+                action = random.randrange(legal_actions)
+            else:
+                action = best_action(network.get_action_array(state_str, legal_actions))
+            self.decisions.append((state_str, action, len(self.hand) - 1))
+            values = [0.0] * legal_actions
+            values[action] = 1.0
+            return self.play_decision(decision, values)
+
+    evaluate_sql.print_logs = False
+    players = [SelfPlayAgent(f"Network {seat + 1}") for seat in range(4)]
+    for player in players:
+        player.decisions = []
+    pairs, targets = [], []
+    for game in range(1, games + 1):
+        for round_number in range(1, 11):
+            scores = [player.score for player in players]
+            evaluate_sql.play_round(players, round_number)
+            for player, score in zip(players, scores):
+                reward = 10 if player.score > score else -10 if player.bid == 0 else -5
+                for state_str, action, cards_left in player.decisions:
+                    pairs.append((state_str, action))
+                    targets.append(reward * gamma ** cards_left)
+                player.decisions = []
+        for player in players:
+            player.score = 0
+        if game % update_games == 0 or game == games:
+            loss = network.fit(encode(pairs), np.array(targets, dtype=np.float32), 1)
+            print(f"Game {game}: {len(pairs)} decisions, loss {loss:.3f}")
+            pairs, targets = [], []
+    return network
+
+
+def benchmark(network_path, table_path, games):
+    # Strength: network and table agents in alternate seats, rotated every game. Speed: the lookups of those games
+    # replayed against the table one by one, and against the network one by one and in batches.
+    import evaluate_sql
+    from evaluate_sql import TrainedAIAgent
+    from policy_service import record_lookups
+    evaluate_sql.print_logs = False
+    players = [TrainedAIAgent(f"{kind} {seat // 2 + 1}", db_path=path)
+               for seat, (kind, path) in enumerate([("Network", network_path), ("Table", table_path)] * 2)]
+    totals = {"Network": 0, "Table": 0}
+    for game in range(games):
+        seating = players[game % 4:] + players[:game % 4]
+        for round_number in range(1, 11):
+            evaluate_sql.play_round(seating, round_number)
+        for player in players:
+            totals[player.name.split()[0]] += player.score
+            player.score = 0
+    print(f"Average score over {games} games: network {totals['Network'] / (2 * games):.1f}, "
+          f"table {totals['Table'] / (2 * games):.1f}")
+
+    lookups = [lookup for game in record_lookups(table_path, max(1, games // 10)) for lookup in game]
+    network, table = ValueNetwork.load(network_path), open_q_store(table_path).warm()
+    for name, store, batch in (("Table", table, 1), ("Network", network, 1), ("Network", network, batch_size)):
+        start_time = time.perf_counter()
+        if batch == 1:
+            for state_str, size in lookups:
+                store.get_action_array(state_str, size)
+        else:
+            for start in range(0, len(lookups), batch):
+                store.get_action_arrays(lookups[start:start + batch])
+        elapsed_time = time.perf_counter() - start_time
+        print(f"{name}, batches of {batch}: {len(lookups) / elapsed_time:.0f} decisions/s")
+    unseen = sum(values is None for values in table.get_action_arrays(lookups))
+    print(f"The table has no entry for {unseen} of {len(lookups)} decisions, the network evaluates all of them")
+    print(f"Network: {network.nbytes()} bytes of weights, table: {os.path.getsize(table_path)} bytes")
+
+
+if __name__ == "__main__":
+    source, destination = sys.argv[1], sys.argv[2]
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    start_time = time.perf_counter()
+    if not source.endswith('.npz'):
+        distill(source, count or 30).save(destination)
+    elif destination.endswith('.npz'):
+        self_play(ValueNetwork.load(source), count or 500).save(destination)
+    else:
+        benchmark(source, destination, count or 200)
+    print(f"Elapsed time: {time.perf_counter() - start_time} seconds")